@@ -1,22 +1,49 @@
 #!/usr/bin/env python3
 ''' Stream OpenAddresses data mapped to shapefile areas to stdout.
 
-Downloads data from 1x1 degree OpenAddresses tile index, checks for overlap
-with each shapefile area, and outputs to stdout:
+Downloads data from 1x1 degree OpenAddresses tile index to a local cache,
+checks for overlap with each shapefile area, and outputs to stdout. Several
+tiles are downloaded in threads and parsed in processes at once, with output
+in the same order as a serial run:
 
     {geoid 1} [{source}, {hash}, {lon}, {lat}, {x}, {y}, {number}, {street}, {unit}, ...]
     {geoid 2} [{source}, {hash}, {lon}, {lat}, {x}, {y}, {number}, {street}, {unit}, ...]
     {geoid 3} [{source}, {hash}, {lon}, {lat}, {x}, {y}, {number}, {street}, {unit}, ...]
     ...
+
+Binary records with the same keys can be written instead; see records.py.
 '''
-from osgeo import ogr, osr
-from expand import Address
-import argparse, itertools, zipfile, csv, requests, io, sys
+from osgeo import ogr
+from tilecache import TileCache, OfflineMiss
+import argparse, itertools, json, sys, os, shutil, tempfile, collections, \
+    concurrent.futures, multiprocessing, requests, requests.adapters, records, ingest, metrics
 
 def feature_box_key(feature):
     '''
     '''
     return feature.GetField('lon'), feature.GetField('lat')
+
+def iterate_boxes(areas_features):
+    ''' Generate 1x1 degree box keys with dictionaries of area WKB by geoid.
+    '''
+    for (box_key, features) in itertools.groupby(areas_features, feature_box_key):
+        yield box_key, {feat.GetField('geoid'): bytes(feat.GetGeometryRef().ExportToWkb())
+                        for feat in features if feat.GetGeometryRef()}
+
+def fetch_tile(tile_cache, url, run_metrics):
+    ''' Return a local path to a tile download, or None if offline and not cached.
+    '''
+    try:
+        with run_metrics.stage('download'):
+            return tile_cache.fetch(url)
+    except OfflineMiss:
+        return None
+
+def state_filename(dirname, box_key, fingerprint, format):
+    ''' Return a path for saved records of a tile with a given fingerprint.
+    '''
+    lon, lat = box_key
+    return os.path.join(dirname, '{}_{}-{}{}'.format(lon, lat, fingerprint, records.extension(format)))
     
 parser = argparse.ArgumentParser(description='Stream addresses for area shapes to stdout.')
 
@@ -24,50 +51,145 @@ parser.add_argument('--areas', default='geodata/areas.shp',
                     help='Datasource containing areas to use for groups. '
                          'Default value "geodata/areas.shp".')
 
+parser.add_argument('--format', default='json', choices=records.FORMATS,
+                    help='Format of output address records, JSON text lines or binary. '
+                         'Default value "json".')
+
+parser.add_argument('--cache', default='geodata/tmp/tiles',
+                    help='Directory for cached tile downloads. '
+                         'Default value "geodata/tmp/tiles".')
+
+parser.add_argument('--cache-size', default=10240, type=int,
+                    help='Maximum size of tile cache in megabytes. '
+                         'Default value 10240.')
+
+parser.add_argument('--offline', action='store_true',
+                    help='Use only previously cached tiles, without network access.')
+
+parser.add_argument('--concurrency', default=4, type=int,
+                    help='Number of tiles to download and parse at once. '
+                         'Default value 4.')
+
+parser.add_argument('--state',
+                    help='Directory for records of each tile from previous runs. Tiles '
+                         'whose download and areas are unchanged are not parsed again.')
+
 parser.add_argument('output', help='Output file.')
 
+metrics.add_arguments(parser)
+
 args = parser.parse_args()
+run_metrics = metrics.Metrics('address-areas.py', args.profile)
+
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
 
-sref4326 = osr.SpatialReference(); sref4326.ImportFromEPSG(4326)
-sref900913 = osr.SpatialReference(); sref900913.ImportFromProj4('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs')
-mercator = osr.CoordinateTransformation(sref4326, sref900913)
+tile_cache = TileCache(args.cache, args.cache_size * 1024**2, args.offline, session)
 
 openaddr_url = 'https://results.openaddresses.io/index.json'
-url_template = requests.get(openaddr_url).json().get('tileindex_url')
+with run_metrics.stage('index'):
+    index_path = tile_cache.fetch(openaddr_url)
+    with open(index_path) as file:
+        url_template = json.load(file).get('tileindex_url')
+    tile_cache.release(index_path)
+
+with run_metrics.stage('areas'):
+    areas_ds = ogr.Open(args.areas)
+    areas_features = sorted(areas_ds.GetLayer(0), key=feature_box_key)
+boxes = iterate_boxes(areas_features)
+
+output = open(args.output, 'wb')
+tmpdir = tempfile.mkdtemp(prefix='address-areas-')
 
-areas_ds = ogr.Open(args.areas)
-areas_features = sorted(areas_ds.GetLayer(0), key=feature_box_key)
+if args.state:
+    os.makedirs(args.state, exist_ok=True)
 
-output = open(args.output, 'w')
+# Fork all parser processes now, before any download threads are running to
+# leave locks held in the children. This script has no main guard, so spawned
+# or forkserver workers would run it again from the top.
+parsers = concurrent.futures.ProcessPoolExecutor(args.concurrency, mp_context=multiprocessing.get_context('fork'))
+parsers.submit(int).result()
 
-for ((lon, lat), features) in itertools.groupby(areas_features, feature_box_key):
-    areas = {feat.GetField('geoid'): feat.GetGeometryRef() for feat in features if feat.GetGeometryRef()}
+with parsers, concurrent.futures.ThreadPoolExecutor(args.concurrency) as downloads:
 
-    print('Downloading', (lon, lat), 'with', len(areas), 'areas', file=sys.stderr)
-    addr_resp = requests.get(url_template.format(lon=lon, lat=lat))
-    addr_zip = zipfile.ZipFile(io.BytesIO(addr_resp.content))
-    addr_buff = addr_zip.open('addresses.csv')
-    addr_rows = csv.DictReader(io.TextIOWrapper(addr_buff))
+    # Tiles move through download and parse queues in order, with a bounded
+    # number of each in flight, so output order matches a serial run.
+    downloading, parsing = collections.deque(), collections.deque()
     
-    for row in addr_rows:
-        if not row['NUMBER'] and not row['STREET']:
-            # Skip blank addresses
-            continue
+    def start_downloads():
+        while len(downloading) < args.concurrency:
+            box = next(boxes, None)
+            if box is None:
+                break
+            (lon, lat), areas_wkb = box
+            print('Downloading', (lon, lat), 'with', len(areas_wkb), 'areas', file=sys.stderr)
+            url = url_template.format(lon=lon, lat=lat)
+            downloading.append((box, downloads.submit(fetch_tile, tile_cache, url, run_metrics)))
     
-        addr_geom = ogr.Geometry(wkt='POINT({LON} {LAT})'.format(**row))
+    start_downloads()
+    
+    while downloading or parsing:
+        if downloading:
+            ((lon, lat), areas_wkb), future = downloading.popleft()
+            with run_metrics.stage('wait for download'):
+                addr_path = future.result()
+            start_downloads()
+            
+            if addr_path is None:
+                print('Skipping', (lon, lat), 'not cached', file=sys.stderr)
+                run_metrics.count('tiles not cached')
+                continue
+
+            saved_path = None
+            if args.state:
+                with run_metrics.stage('fingerprint'):
+                    fingerprint = ingest.tile_fingerprint(addr_path, areas_wkb, args.format)
+                saved_path = state_filename(args.state, (lon, lat), fingerprint, args.format)
+
+            if saved_path and os.path.exists(saved_path):
+                tile_cache.release(addr_path)
+                parsing.append((addr_path, saved_path, None))
+                run_metrics.count('tiles reused')
+            else:
+                parsing.append((addr_path, saved_path, parsers.submit(ingest.process_tile,
+                    addr_path, areas_wkb, args.format, tmpdir, bool(args.profile))))
         
-        for (area_geoid, area_geom) in areas.items():
-            if not addr_geom.Within(area_geom):
-                # Skip addresses outside the local area
+        if parsing and (len(parsing) >= args.concurrency or not downloading):
+            addr_path, saved_path, future = parsing.popleft()
+
+            if future is None:
+                with run_metrics.stage('write'):
+                    with open(saved_path, 'rb') as file:
+                        shutil.copyfileobj(file, output)
+                print('Wrote saved addresses from', saved_path, file=sys.stderr)
                 continue
+
+            # Parsing happens in other processes, counted as children in reports.
+            with run_metrics.stage('wait for parse'):
+                filename, counts, profile_filename = future.result()
+            if profile_filename:
+                run_metrics.add_profile(profile_filename)
+            tile_cache.release(addr_path)
+            run_metrics.update(counts)
+            run_metrics.count('tiles parsed')
             
-            lon, lat = addr_geom.GetX(), addr_geom.GetY()
-            addr_geom.Transform(mercator)
-            x, y = round(addr_geom.GetX(), 1), round(addr_geom.GetY(), 1)
-        
-            address = Address(
-                row['OA:Source'], row['HASH'], lon, lat, x, y,
-                row['NUMBER'], row['STREET'], row['UNIT']
-                )
+            with run_metrics.stage('write'):
+                with open(filename, 'rb') as file:
+                    shutil.copyfileobj(file, output)
+
+            if saved_path:
+                # Keep only the newest records for each tile.
+                prefix = os.path.basename(saved_path).rsplit('-', 1)[0] + '-'
+                for name in os.listdir(args.state):
+                    if name.startswith(prefix):
+                        os.remove(os.path.join(args.state, name))
+                shutil.move(filename, saved_path)
+            else:
+                os.remove(filename)
+            print('Wrote', counts['rows out'], 'addresses from', addr_path, file=sys.stderr)
 
-            print(area_geoid, address.tojson(), file=output)
+output.close()
+os.rmdir(tmpdir)
+run_metrics.write(args.report)
@@ -1,39 +1,140 @@
 #!/usr/bin/env python3
-''' Map OpenAddresses data to nearby zoom=19 web mercator tiles.
+''' Map OpenAddresses data to zoom=19 web mercator tiles.
 
-Uses a simple quadtile implementation to output (tile key, JSON) lines of text
-suitable for sorting in a map/reduce implementation. Optimized for and tested
-with simple commandline implementations like bashreduce:
+Outputs (tile key, JSON) lines of text with each address keyed once by its own
+tile, for expand-reduce.py to find nearby matches by radius. With --quadtiles,
+uses a simple quadtile implementation to output each address under four tile
+keys instead, suitable for sorting in a map/reduce implementation. Optimized
+for and tested with simple commandline implementations like bashreduce:
 
     http://blog.last.fm/2009/04/06/mapreduce-bash-script
 
 Assumes that named file contains space-delimited lines with a meaningful
-alphanumeric key at the beginning. Writes groupings to output files,
-and emits unsorted filenames to stdout.
+alphanumeric key at the beginning, or binary records with the same keys.
+Writes groupings to output files in the same format, and emits unsorted
+filenames to stdout. Input does not need to be grouped by key: writes are
+buffered per file, with a bounded number of files open at once.
+
+Parallel mappers can each write their own shard files with --shard, which are
+appended to area files in one pass with --merge once all mappers are done:
+
+    parallel ./address-map.py --shard '{#}' '{}' ::: a.txt b.txt > shards.txt
+    ./address-map.py --merge shards.txt > area-filenames.txt
 '''
-from expand import Address
-import sys, json, itertools, operator, argparse, os, fcntl
+from expand import tile, quadtiles
+import sys, itertools, operator, argparse, os, fcntl, shutil, collections, records, metrics
+
+def shard_target(shard_name):
+    ''' Return the name of the area file that a shard file is merged into.
+
+        >>> shard_target('data/addresses-06037.txt.3')
+        'data/addresses-06037.txt'
+    '''
+    return shard_name.rsplit('.', 1)[0]
+
+def merge_shards(shard_names):
+    ''' Append shard files to their area files, remove them, and return area file names.
+    '''
+    filenames = list()
+
+    for (filename, names) in itertools.groupby(sorted(shard_names, key=shard_target), key=shard_target):
+        with open(filename, 'ab') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            for shard_name in names:
+                with open(shard_name, 'rb') as shard:
+                    shutil.copyfileobj(shard, file)
+                os.remove(shard_name)
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_UN)
+        filenames.append(filename)
+
+    return filenames
 
 parser = argparse.ArgumentParser(description='Map addresses to files named for areas.')
-parser.add_argument('input', help='Text file containing area-prefixed address data.')
+parser.add_argument('input', help='File containing area-prefixed address data, '
+                                  'or a list of shard file names with --merge.')
+
+parser.add_argument('--format', default='json', choices=records.FORMATS,
+                    help='Format of input and output address records, JSON text '
+                         'lines or binary. Default value "json".')
+
+parser.add_argument('--quadtiles', action='store_true',
+                    help='Output each address four times under overlapping quadtile '
+                         'keys, for expand-reduce.py --reduce sort.')
+
+parser.add_argument('--shard',
+                    help='Name for this mapper, unique among parallel mappers. Records '
+                         'are written without locks to shard files named like '
+                         '"addresses-{geoid}.txt.{shard}", to be merged with --merge.')
+
+parser.add_argument('--merge', action='store_true',
+                    help='Append shard files listed in input to their area files, '
+                         'remove the shards, and emit area file names.')
+
+parser.add_argument('--max-open', default=64, type=int,
+                    help='Maximum number of output files open at once. Default value 64.')
+
+metrics.add_arguments(parser)
 
 args = parser.parse_args()
+run_metrics = metrics.Metrics('address-map.py', args.profile)
+
+if args.shard and ('.' in args.shard or os.sep in args.shard):
+    parser.error('Shard names cannot contain "." or "{}".'.format(os.sep))
+
+if args.merge:
+    with open(args.input) as file:
+        shard_names = {line.strip() for line in file if line.strip()}
+
+    with run_metrics.stage('merge'):
+        filenames = merge_shards(shard_names)
+
+    run_metrics.count('shards in', len(shard_names))
+    run_metrics.count('files out', len(filenames))
+
+    for filename in filenames:
+        print(filename, file=sys.stdout)
+
+    run_metrics.write(args.report)
+    sys.exit()
+
 dirname = os.path.dirname(args.input)
+addresses = records.read(args.input, args.format)
 
-with open(args.input) as file:
-    lines = (line.split(' ', 1) for line in file)
+# Without shards, batches are appended under a lock in case other mappers
+# write to the same area files.
+pool = records.WriterPool(args.format, args.max_open, lock=not args.shard)
+counts = collections.Counter()
 
-    for (key, lines) in itertools.groupby(lines, key=operator.itemgetter(0)):
-        count, filename = 0, os.path.join(dirname, 'addresses-{}.txt'.format(key))
-    
-        with open(filename, 'a') as file:
-            fcntl.flock(file, fcntl.LOCK_EX)
-            for (_, line) in lines:
-                address = Address(*json.loads(line))
-                addr_json = address.tojson()
-                for tile in address.quadtiles(zoom=19):
-                    print(tile, addr_json, file=file)
-                count += 1
-            print('Added', count, 'addresses to', filename, file=sys.stderr)
-            print(filename, file=sys.stdout)
-            fcntl.flock(file, fcntl.LOCK_UN)
+with run_metrics.stage('map', hot=True):
+    for (key, addr_args) in addresses:
+        basename = 'addresses-{}{}'.format(key, records.extension(args.format))
+        filename = os.path.join(dirname, basename)
+        if args.shard:
+            filename += '.' + args.shard
+
+        # Read Mercator x, y without building an Address for each row.
+        x, y = addr_args[4], addr_args[5]
+        if args.quadtiles:
+            for tile_key in quadtiles(x, y, zoom=19):
+                pool.write(filename, tile_key, addr_args)
+        else:
+            pool.write(filename, tile(x, y, zoom=19), addr_args)
+        counts[filename] += 1
+
+with run_metrics.stage('flush'):
+    pool.close()
+
+run_metrics.count('rows in', sum(counts.values()))
+run_metrics.count('rows out', sum(pool.counts.values()))
+run_metrics.count('files out', len(counts))
+
+for filename in pool.filenames():
+    print('Added', counts[filename], 'addresses to', filename, file=sys.stderr)
+    print(filename, file=sys.stdout)
+
+run_metrics.write(args.report)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
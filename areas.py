@@ -0,0 +1,160 @@
+''' Spatial index for assigning address points to shapefile areas.
+
+Areas in a 1x1 degree box are rasterized into a grid of cells by recursive
+quadtree subdivision. Cells entirely inside an area are assigned to it with no
+geometry test at all. Only cells crossed by an area boundary keep a piece of
+that area clipped to the cell, and points there are tested against the small
+clipped piece with a vectorized even-odd ray casting test in NumPy.
+'''
+from osgeo import ogr
+import collections, numpy
+
+# Points tested at once against the edges of a boundary cell.
+CHUNK_POINTS = 1024
+
+def create_cell_geom(xmin, ymin, xmax, ymax):
+    ''' Return a rectangular OGR polygon for a grid cell.
+    '''
+    wkt_tpl = 'POLYGON(({x1!r} {y1!r},{x1!r} {y2!r},{x2!r} {y2!r},{x2!r} {y1!r},{x1!r} {y1!r}))'
+    return ogr.CreateGeometryFromWkt(wkt_tpl.format(x1=xmin, y1=ymin, x2=xmax, y2=ymax))
+
+def iterate_rings(geom):
+    ''' Generate arrays of x, y ring coordinates for polygons in a geometry.
+
+        Points and lines left over from clipping have no area and are skipped.
+    '''
+    geom_type = ogr.GT_Flatten(geom.GetGeometryType())
+
+    if geom_type == ogr.wkbPolygon:
+        for i in range(geom.GetGeometryCount()):
+            points = geom.GetGeometryRef(i).GetPoints()
+            if points and len(points) >= 4:
+                yield numpy.array(points, dtype=numpy.float64)[:, :2]
+
+    elif geom_type in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geom.GetGeometryCount()):
+            yield from iterate_rings(geom.GetGeometryRef(i))
+
+def points_in_rings(xs, ys, rings, chunk_size=CHUNK_POINTS):
+    ''' Return a boolean array of points inside polygon rings.
+
+        Uses the even-odd rule across all rings, so holes are handled too.
+        Points are sorted by latitude and tested chunk_size at a time against
+        only the edges that span their latitudes, so memory stays bounded for
+        large cells.
+
+        >>> square = numpy.array([(0, 0), (0, 2), (2, 2), (2, 0), (0, 0)], dtype=float)
+        >>> hole = numpy.array([(.5, .5), (.5, 1), (1, 1), (1, .5), (.5, .5)], dtype=float)
+        >>> points_in_rings(numpy.array([1.5, .75, 3]), numpy.array([1.5, .75, 1]), [square, hole])
+        array([ True, False, False])
+        >>> points_in_rings(numpy.array([1.5, .75, 3]), numpy.array([1.5, .75, 1]), [square, hole], chunk_size=1)
+        array([ True, False, False])
+    '''
+    inside = numpy.zeros(len(xs), dtype=bool)
+    edges = numpy.concatenate([numpy.hstack((ring[:-1], ring[1:])) for ring in rings]) \
+        if rings else numpy.zeros((0, 4))
+    edge_ymin, edge_ymax = numpy.minimum(edges[:, 1], edges[:, 3]), numpy.maximum(edges[:, 1], edges[:, 3])
+
+    order = numpy.argsort(ys)
+
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        px, py = xs[chunk, numpy.newaxis], ys[chunk, numpy.newaxis]
+
+        # An edge can only cross rays from points with y in [ymin, ymax).
+        spanning = (edge_ymax > py.min()) & (edge_ymin <= py.max())
+        x1, y1, x2, y2 = edges[spanning].T
+        crosses = (y1 > py) != (y2 > py)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x_intersect = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+
+        inside[chunk] = numpy.logical_xor.reduce(crosses & (px < x_intersect), axis=1)
+
+    return inside
+
+class AreaIndex:
+    ''' Grid index over a dictionary of area geometries keyed on geoid.
+
+        Cells are 1/2^depth of the combined area envelope on each side.
+    '''
+    def __init__(self, areas, depth=6):
+        self.geoids = list(areas.keys())
+        envelopes = [geom.GetEnvelope() for geom in areas.values()] or [(0, 0, 0, 0)]
+
+        self.xmin = min(xmin for (xmin, _, _, _) in envelopes)
+        self.xmax = max(xmax for (_, xmax, _, _) in envelopes)
+        self.ymin = min(ymin for (_, _, ymin, _) in envelopes)
+        self.ymax = max(ymax for (_, _, _, ymax) in envelopes)
+        self.size = 2**depth
+        self.width = (self.xmax - self.xmin) / self.size or 1
+        self.height = (self.ymax - self.ymin) / self.size or 1
+
+        # Map (col, row) to lists of area indexes that contain the cell
+        # entirely, and lists of (area index, clipped rings) on boundaries.
+        self.inside = collections.defaultdict(list)
+        self.boundary = collections.defaultdict(list)
+
+        for (index, geom) in enumerate(areas.values()):
+            self._add_area(index, geom, 0, 0, self.size)
+
+    def _add_area(self, index, geom, col, row, span):
+        ''' Recursively add an area clipped to a square span of grid cells.
+        '''
+        xmin, ymin = self.xmin + col * self.width, self.ymin + row * self.height
+        cell_geom = create_cell_geom(xmin, ymin, xmin + span * self.width, ymin + span * self.height)
+
+        if not geom.Intersects(cell_geom):
+            return
+
+        if geom.Contains(cell_geom):
+            for col1 in range(col, col + span):
+                for row1 in range(row, row + span):
+                    self.inside[(col1, row1)].append(index)
+            return
+
+        piece = geom.Intersection(cell_geom)
+
+        if span == 1:
+            rings = list(iterate_rings(piece))
+            if rings:
+                self.boundary[(col, row)].append((index, rings))
+            return
+
+        half = span // 2
+        for (col1, row1) in ((col, row), (col + half, row), (col, row + half), (col + half, row + half)):
+            self._add_area(index, piece, col1, row1, half)
+
+    def assign(self, lons, lats):
+        ''' Return lists of geoids containing each of a chunk of points.
+
+            Accepts sequences of longitudes and latitudes. Geoids for each
+            point are listed in the order areas were given to the index.
+        '''
+        xs, ys = numpy.asarray(lons, dtype=numpy.float64), numpy.asarray(lats, dtype=numpy.float64)
+        cols = numpy.floor((xs - self.xmin) / self.width).astype(numpy.int64)
+        rows = numpy.floor((ys - self.ymin) / self.height).astype(numpy.int64)
+        matches = [list() for _ in range(len(xs))]
+
+        cell_points = collections.defaultdict(list)
+        for (i, cell) in enumerate(zip(cols.tolist(), rows.tolist())):
+            cell_points[cell].append(i)
+
+        for (cell, points) in cell_points.items():
+            for index in self.inside.get(cell, ()):
+                for i in points:
+                    matches[i].append(index)
+
+            if cell not in self.boundary:
+                continue
+
+            points = numpy.array(points)
+            for (index, rings) in self.boundary[cell]:
+                for i in points[points_in_rings(xs[points], ys[points], rings)].tolist():
+                    matches[i].append(index)
+
+        return [[self.geoids[index] for index in sorted(indexes)] for indexes in matches]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+''' Benchmark pieces of the dedupe pipeline on synthetic address data.
+
+Each subcommand generates its own data with a fixed random seed and prints a
+short report to stdout, for example:
+
+    $ ./benchmark.py memory --count 100000
+    $ ./benchmark.py blocking --count 100000
+    $ ./benchmark.py projection --count 1000000
+    $ ./benchmark.py normalize --count 1000000
+    $ ./benchmark.py matcher --count 100000
+    $ ./benchmark.py reduce-memory --counts 100000 1000000 5000000
+    $ ./benchmark.py mapping --count 1000000 --mappers 1 2 4
+    $ ./benchmark.py workers --count 1000000 --workers 1 2 4
+    $ ./benchmark.py ingest --count 1000000
+    $ ./benchmark.py generate --count 100000 --format zip tile.zip
+    $ ./benchmark.py suite --sizes 100000 1000000 --output results.json
+    $ ./benchmark.py suite --baseline results.json
+'''
+import argparse, collections, csv, hashlib, io, itertools, json, os, random, subprocess, sys, tempfile, time, tracemalloc, zipfile
+
+from expand import Address, AddressBatch, token_map, mercator, mercator_arrays, tile, quadtiles
+from synthetic import street_names
+import normalize, blocking, clusters, ingest, matchers, records, synthetic
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+
+class PlainAddress:
+    ''' Address as originally written, with an instance dict and no interning.
+    '''
+    def __init__(self, source, hash, lon, lat, x, y, number, street, unit, city=None, district=None, region=None, postcode=None):
+        self.source = source
+        self.hash = hash
+        self.lon = lon
+        self.lat = lat
+        self.x = x
+        self.y = y
+
+        self.number = number
+        self.street = street
+        self.street_normal = ''.join([token_map.get(s, s) for s in street.lower().split()])
+        self.unit = unit
+        self.city = city
+        self.district = district
+        self.region = region
+        self.postcode = postcode
+
+def synthetic_rows(args, count):
+    ''' Generate synthetic OpenAddresses rows with options from the command line.
+    '''
+    return synthetic.iterate_rows(count, args.seed, density=args.density, duplicates=args.duplicates,
+                                  sources=args.sources, variation=args.variation, blanks=args.blanks)
+
+def synthetic_lines(args, count):
+    ''' Generate JSON Address arguments like those found in mapped files, with options from the command line.
+    '''
+    for (_, addr_args) in synthetic.iterate_records(synthetic_rows(args, count), args.geoid):
+        yield json.dumps(addr_args)
+
+def traced_size(build, lines):
+    ''' Return retained bytes and seconds taken to build a store from lines.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = build(lines)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+
+    return size, elapsed
+
+def bench_memory(args):
+    ''' Compare memory held by plain, slotted, and columnar address stores.
+    '''
+    lines = list(synthetic_lines(args, args.count))
+
+    def build_batch(lines):
+        batch = AddressBatch()
+        for line in lines:
+            batch.append(*json.loads(line))
+        return batch
+
+    builders = [
+        ('plain', lambda lines: [PlainAddress(*json.loads(line)) for line in lines]),
+        ('slots', lambda lines: [Address(*json.loads(line)) for line in lines]),
+        ('batch', build_batch),
+        ]
+
+    print('store', 'bytes', 'bytes/row', 'seconds', sep='\t')
+
+    for (name, build) in builders:
+        size, elapsed = traced_size(build, lines)
+        print(name, size, round(size / len(lines)), round(elapsed, 2), sep='\t')
+
+def run_script(*arguments):
+    ''' Run one of the pipeline scripts and return seconds taken.
+    '''
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(dirname, arguments[0])] + list(arguments[1:]),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def measure_script(*arguments):
+    ''' Run one of the pipeline scripts and return seconds taken and peak RSS in megabytes.
+    '''
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(dirname, arguments[0])] + list(arguments[1:]),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, arguments)
+    return time.perf_counter() - start, usage.ru_maxrss / 1024
+
+def count_lines(filename):
+    ''' Return the number of lines in a text file.
+    '''
+    with open(filename) as file:
+        return sum(1 for line in file)
+
+def bench_blocking(args):
+    ''' Compare quadtile and single-emit blocking on a dense synthetic city.
+    '''
+    schemes = [
+        ('quadtile-sort', ['--quadtiles'], ['--reduce', 'sort']),
+        ('quadtile-hash', ['--quadtiles'], ['--reduce', 'hash']),
+        ('single-hash', [], ['--reduce', 'hash']),
+        ]
+
+    print('scheme', 'lines', 'map seconds', 'reduce seconds', 'clusters', sep='\t')
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        for (name, map_args, reduce_args) in schemes:
+            workdir = os.path.join(tmpdir, name)
+            os.mkdir(workdir)
+            input_name, mapped_name, output_name = [os.path.join(workdir, basename)
+                for basename in ('areas.txt', 'addresses-{}.txt'.format(args.geoid), 'output.csv')]
+
+            with open(input_name, 'wb') as file:
+                synthetic.write_records(synthetic_rows(args, args.count), args.geoid, file, 'json')
+
+            map_time = run_script('address-map.py', *(map_args + [input_name]))
+            reduce_time = run_script('expand-reduce.py', *(reduce_args + [mapped_name, output_name]))
+            print(name, count_lines(mapped_name), round(map_time, 2), round(reduce_time, 2),
+                  count_lines(output_name) - 1, sep='\t')
+
+def bench_reduce_memory(args):
+    ''' Compare peak memory and time of in-memory and memory-limited reduce.
+    '''
+    print('addresses', 'mode', 'seconds', 'peak RSS MB', 'clusters', sep='\t')
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        input_name, output_name = os.path.join(tmpdir, 'addresses.txt'), os.path.join(tmpdir, 'output.csv')
+
+        for count in args.counts:
+            with open(input_name, 'wb') as file:
+                # Density stays constant as the area grows.
+                synthetic.write_records(synthetic_rows(args, count), args.geoid, file, 'json')
+
+            modes = [('in-memory', []), ('max-memory', ['--max-memory', str(args.max_memory)])]
+
+            for (name, reduce_args) in modes:
+                seconds, peak = measure_script('expand-reduce.py', *(reduce_args + [input_name, output_name]))
+                print(count, name, round(seconds, 2), round(peak), count_lines(output_name) - 1, sep='\t')
+
+def bench_workers(args):
+    ''' Compare reduce and match stage times of expand-reduce.py across numbers of workers.
+    '''
+    print('workers', 'seconds', 'match seconds', 'match speedup', 'clusters', sep='\t')
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        input_name, output_name, report_name = [os.path.join(tmpdir, basename)
+            for basename in ('addresses.txt', 'output.csv', 'report.json')]
+
+        with open(input_name, 'wb') as file:
+            synthetic.write_records(synthetic_rows(args, args.count), args.geoid, file, 'json')
+
+        serial_time = None
+
+        for workers in args.workers:
+            seconds = run_script('expand-reduce.py', '--workers', str(workers), '--matcher', args.matcher,
+                                 '--report', report_name, input_name, output_name)
+            with open(report_name) as file:
+                match_time = json.load(file)['stages']['match']['wall']
+            serial_time = serial_time or match_time
+            print(workers, round(seconds, 2), round(match_time, 2), round(serial_time / match_time, 2),
+                  count_lines(output_name) - 1, sep='\t')
+
+def bench_mapping(args):
+    ''' Compare parallel mappers appending under locks with sharded mappers.
+    '''
+    print('mappers', 'mode', 'seconds', 'addresses/second', sep='\t')
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        rand = random.Random(args.seed)
+        lines = ['{:05d} {}'.format(rand.randrange(args.areas), line)
+                 for line in synthetic_lines(args, args.count)]
+
+        for mappers in args.mappers:
+            for mode in ('lock', 'shard'):
+                workdir = os.path.join(tmpdir, '{}-{}'.format(mode, mappers))
+                os.mkdir(workdir)
+                input_names = [os.path.join(workdir, 'input-{}.txt'.format(i)) for i in range(mappers)]
+
+                for (i, input_name) in enumerate(input_names):
+                    with open(input_name, 'w') as file:
+                        file.write(''.join(line + '\n' for line in lines[i::mappers]))
+
+                start = time.perf_counter()
+                processes = [subprocess.Popen([sys.executable, os.path.join(dirname, 'address-map.py')]
+                                              + (['--shard', str(i)] if mode == 'shard' else []) + [input_name],
+                                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                             for (i, input_name) in enumerate(input_names)]
+                outputs = [process.communicate()[0] for process in processes]
+
+                if mode == 'shard':
+                    shards_name = os.path.join(workdir, 'shards.txt')
+                    with open(shards_name, 'wb') as file:
+                        file.write(b''.join(outputs))
+                    run_script('address-map.py', '--merge', shards_name)
+
+                elapsed = time.perf_counter() - start
+                print(mappers, mode, round(elapsed, 2), round(len(lines) / elapsed), sep='\t')
+
+def bench_projection(args):
+    ''' Compare points per second projected by NumPy, math, and OGR.
+    '''
+    rand = random.Random(args.seed)
+    lons = [-125 + rand.random() * 58 for _ in range(args.count)]
+    lats = [25 + rand.random() * 24 for _ in range(args.count)]
+
+    def project_numpy():
+        xs, ys = mercator_arrays(lons, lats)
+        return xs.round(1).tolist(), ys.round(1).tolist()
+
+    def project_math():
+        return [mercator(lon, lat) for (lon, lat) in zip(lons, lats)]
+
+    methods = [('numpy', project_numpy), ('math', project_math)]
+
+    try:
+        from osgeo import ogr, osr
+    except ImportError:
+        print('Skipping OGR, osgeo is not installed', file=sys.stderr)
+    else:
+        sref4326 = osr.SpatialReference(); sref4326.ImportFromEPSG(4326)
+        sref4326.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        sref900913 = osr.SpatialReference(); sref900913.ImportFromProj4('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs')
+        transform = osr.CoordinateTransformation(sref4326, sref900913)
+
+        def project_ogr():
+            points = list()
+            for (lon, lat) in zip(lons, lats):
+                geom = ogr.Geometry(wkt='POINT({!r} {!r})'.format(lon, lat))
+                geom.Transform(transform)
+                points.append((geom.GetX(), geom.GetY()))
+            return points
+
+        methods.append(('ogr', project_ogr))
+
+    print('method', 'seconds', 'points/second', sep='\t')
+
+    for (name, project) in methods:
+        start = time.perf_counter()
+        project()
+        elapsed = time.perf_counter() - start
+        print(name, round(elapsed, 3), round(args.count / elapsed), sep='\t')
+
+def bench_normalize(args):
+    ''' Compare street normalizations per second with and without caching.
+    '''
+    streets = street_names(args.count, args.seed)
+
+    def uncached():
+        return [normalize.normalize_street_uncached(street) for street in streets]
+
+    def cached():
+        normalize.normalize_street.cache_clear()
+        return [normalize.normalize_street(street) for street in streets]
+
+    def batch():
+        normalize.normalize_street.cache_clear()
+        return normalize.normalize_streets(streets)
+
+    print('method', 'seconds', 'streets/second', sep='\t')
+
+    for (name, run) in (('uncached', uncached), ('cached', cached), ('batch', batch)):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(name, round(elapsed, 3), round(args.count / elapsed), sep='\t')
+
+    print(len(set(streets)), 'distinct of', args.count, 'streets;',
+          normalize.normalize_street.cache_info(), file=sys.stderr)
+
+def bench_matcher(args):
+    ''' Compare precision, recall, and pairs per second of each matcher, and whole-tile matching.
+    '''
+    rows = list(synthetic_rows(args, args.count))
+    entities = {row['HASH']: row['ID'] for row in rows}
+    addresses = [addr_args for (_, addr_args) in synthetic.iterate_records(rows, args.geoid)]
+    labels = [entities[addr_args[1]] for addr_args in addresses]
+    pairs2 = lambda n: n * (n - 1) // 2
+    true_pairs = sum(pairs2(n) for n in collections.Counter(labels).values())
+
+    print('matcher', 'candidates', 'pairs/second', 'precision', 'recall', sep='\t')
+
+    for (name, Matcher) in sorted(matchers.MATCHERS.items()):
+        matcher, batch = Matcher(), AddressBatch()
+        blocks = blocking.group_blocks((('', a) for a in addresses), batch, matcher)
+        candidates = sum(1 for rows in blocks for _ in blocking.candidate_pairs(batch, rows, args.radius))
+
+        start = time.perf_counter()
+        matched = blocking.matched_pairs(batch, blocks, args.radius, matcher)
+        elapsed = time.perf_counter() - start
+
+        address_clusters = clusters.Clusters()
+        address_clusters.extend(len(batch))
+        for (row1, row2) in matched:
+            address_clusters.union(row1, row2)
+
+        found_pairs, correct_pairs = 0, 0
+        for cluster in address_clusters.iterate():
+            found_pairs += pairs2(len(cluster))
+            correct_pairs += sum(pairs2(n) for n in collections.Counter(labels[row] for row in cluster).values())
+
+        print(name, candidates, round(candidates / elapsed),
+              round(correct_pairs / (found_pairs or 1), 4),
+              round(correct_pairs / (true_pairs or 1), 4), sep='\t')
+
+    # Whole quadtiles as in expand-reduce.py --reduce sort, against the original Address loop
+    tile_addresses = addresses[:args.tile_count]
+    matcher, batch = matchers.ExactMatcher(), AddressBatch()
+    tiles, objects = collections.defaultdict(list), list()
+
+    for addr_args in tile_addresses:
+        row = batch.append(*addr_args)
+        objects.append(Address(*addr_args))
+        for key in quadtiles(addr_args[4], addr_args[5], 19):
+            tiles[key].append(row)
+
+    def address_pairs(rows):
+        return [(row1, row2) for (row1, row2) in itertools.combinations(rows, 2) if objects[row1].matches(objects[row2])]
+
+    def batch_pairs(rows):
+        return [pair for pair in itertools.combinations(rows, 2) if matcher.matches(batch, *pair)]
+
+    compared = sum(pairs2(len(rows)) for rows in tiles.values())
+    print()
+    print('tile pairs', 'compared', 'matches', 'seconds', 'pairs/second', sep='\t')
+
+    for (name, pairs) in (('address', address_pairs), ('batch', batch_pairs),
+                          ('blocked', lambda rows: blocking.tile_pairs(batch, rows, matcher))):
+        start = time.perf_counter()
+        matches = sum(len(pairs(rows)) for rows in tiles.values())
+        elapsed = time.perf_counter() - start
+        print(name, compared, matches, round(elapsed, 3), round(compared / elapsed), sep='\t')
+
+def bench_generate(args):
+    ''' Write synthetic OpenAddresses data to a file, as CSV, a zipped tile, or area records.
+    '''
+    rows = synthetic_rows(args, args.count)
+
+    if args.format == 'zip':
+        synthetic.write_zip(rows, args.output)
+    elif args.format == 'csv':
+        with open(args.output, 'w', newline='') as file:
+            synthetic.write_csv(rows, file)
+    else:
+        with open(args.output, 'wb') as file:
+            synthetic.write_records(rows, args.geoid, file, args.format)
+
+def read_dict_rows(addr_buff):
+    ''' Generate Address arguments from a binary CSV file as ingest.py once did, with a dictionary per row.
+    '''
+    for chunk in ingest.iterate_chunks(csv.DictReader(io.TextIOWrapper(addr_buff))):
+        rows, lons, lats = list(), list(), list()
+        for row in chunk:
+            if not row['NUMBER'] and not row['STREET']:
+                continue
+            try:
+                lon, lat = float(row['LON']), float(row['LAT'])
+            except ValueError:
+                continue
+            else:
+                rows.append(row)
+                lons.append(lon)
+                lats.append(lat)
+
+        xs, ys = mercator_arrays(lons, lats)
+        xs, ys = xs.round(1).tolist(), ys.round(1).tolist()
+
+        for (row, lon, lat, x, y) in zip(rows, lons, lats, xs, ys):
+            yield [row['OA:Source'], row['HASH'], lon, lat, x, y, row['NUMBER'], row['STREET'], row['UNIT']]
+
+def read_column_rows(addr_buff, iterate_columns):
+    ''' Generate Address arguments from a binary CSV file with a chunked column reader from ingest.py.
+    '''
+    for (_, columns) in iterate_columns(addr_buff):
+        lons, lats, (sources, hashes, numbers, streets, units) = ingest.filter_chunk(columns)
+        xs, ys = mercator_arrays(lons, lats)
+        xs, ys = xs.round(1).tolist(), ys.round(1).tolist()
+
+        for addr_args in zip(sources, hashes, lons.tolist(), lats.tolist(), xs, ys, numbers, streets, units):
+            yield list(addr_args)
+
+def bench_ingest(args):
+    ''' Compare rows per second read from a zipped tile by dictionary, tuple, and Arrow readers.
+
+        Each reader filters and projects addresses as ingest.py does, without
+        assigning them to areas, and all must produce the same addresses.
+    '''
+    methods = [
+        ('dict', read_dict_rows),
+        ('tuple', lambda addr_buff: read_column_rows(addr_buff, ingest.iterate_tuple_columns)),
+        ]
+
+    try:
+        import pyarrow.csv
+    except ImportError:
+        print('Skipping Arrow, pyarrow is not installed', file=sys.stderr)
+    else:
+        methods.append(('arrow', lambda addr_buff: read_column_rows(addr_buff, ingest.iterate_arrow_columns)))
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        addr_path = os.path.join(tmpdir, 'tile.zip')
+        synthetic.write_zip(synthetic_rows(args, args.count), addr_path)
+
+        with zipfile.ZipFile(addr_path) as addr_zip, addr_zip.open('addresses.csv') as addr_buff:
+            row_count = sum(1 for line in csv.reader(io.TextIOWrapper(addr_buff))) - 1
+
+        print('reader', 'rows', 'addresses', 'seconds', 'rows/second', sep='\t')
+        digests = set()
+
+        for (name, read) in methods:
+            digest, address_count = hashlib.sha1(), 0
+            start = time.perf_counter()
+            with zipfile.ZipFile(addr_path) as addr_zip, addr_zip.open('addresses.csv') as addr_buff:
+                for addr_args in read(addr_buff):
+                    digest.update(repr(addr_args).encode('utf8'))
+                    address_count += 1
+            elapsed = time.perf_counter() - start
+            digests.add(digest.hexdigest())
+            print(name, row_count, address_count, round(elapsed, 2), round(row_count / elapsed), sep='\t')
+
+    if len(digests) > 1:
+        print('Readers produced different addresses', file=sys.stderr)
+        sys.exit(1)
+
+def time_pieces(addresses):
+    ''' Return seconds taken by core pieces of mapping for a list of Address arguments.
+    '''
+    def build_batch():
+        batch = AddressBatch()
+        for addr_args in addresses:
+            batch.append(*addr_args)
+
+    pieces = [
+        ('address', lambda: [Address(*addr_args) for addr_args in addresses]),
+        ('batch', build_batch),
+        ('tile', lambda: [tile(addr_args[4], addr_args[5], 19) for addr_args in addresses]),
+        ('quadtiles', lambda: [quadtiles(addr_args[4], addr_args[5], 19) for addr_args in addresses]),
+        ]
+
+    for (name, run) in pieces:
+        start = time.perf_counter()
+        run()
+        yield name, time.perf_counter() - start
+
+def bench_suite(args):
+    ''' Measure throughput and peak memory of mapping and reducing at several sizes.
+
+        Core pieces are timed in this process, and address-map.py and
+        expand-reduce.py are run on synthetic areas of each size with their
+        own --report output. Results can be saved and compared to a baseline,
+        exiting with an error if any throughput drops or any peak memory grows
+        by more than a tolerance.
+    '''
+    results = list()
+
+    addresses = [addr_args for (_, addr_args)
+                 in synthetic.iterate_records(synthetic_rows(args, args.pieces), args.geoid)]
+
+    for (name, seconds) in time_pieces(addresses):
+        results.append(dict(name=name, rows=len(addresses), seconds=round(seconds, 3),
+                            rows_per_second=round(len(addresses) / seconds), peak_rss_mb=None))
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        for size in args.sizes:
+            workdir = os.path.join(tmpdir, str(size))
+            os.mkdir(workdir)
+            extension = records.extension(args.format)
+            input_name, output_name = os.path.join(workdir, 'areas' + extension), os.path.join(workdir, 'output.csv')
+            mapped_name = os.path.join(workdir, 'addresses-{}{}'.format(args.geoid, extension))
+            map_report, reduce_report = os.path.join(workdir, 'map.json'), os.path.join(workdir, 'reduce.json')
+
+            with open(input_name, 'wb') as file:
+                count = synthetic.write_records(synthetic_rows(args, size), args.geoid, file, args.format)
+
+            run_script('address-map.py', '--format', args.format, '--report', map_report, input_name)
+            run_script('expand-reduce.py', '--format', args.format, '--matcher', args.matcher,
+                       '--report', reduce_report, mapped_name, output_name)
+
+            for (name, report_name) in (('map', map_report), ('reduce', reduce_report)):
+                with open(report_name) as file:
+                    report = json.load(file)
+                results.append(dict(name=name, rows=count, seconds=report['wall'],
+                                    rows_per_second=round(count / report['wall']),
+                                    peak_rss_mb=report['peak_rss_mb']))
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {(result['name'], result['rows']): result for result in json.load(file)}
+
+    print('name', 'rows', 'seconds', 'rows/second', 'peak RSS MB', 'change', sep='\t')
+    regressions = 0
+
+    for result in results:
+        change, old = '', baseline.get((result['name'], result['rows']))
+
+        if old:
+            speed = result['rows_per_second'] / old['rows_per_second'] - 1
+            change = '{:+.0%} speed'.format(speed)
+            slower = speed < -args.tolerance
+            bigger = False
+            if result['peak_rss_mb'] and old['peak_rss_mb']:
+                growth = result['peak_rss_mb'] / old['peak_rss_mb'] - 1
+                change += ', {:+.0%} memory'.format(growth)
+                bigger = growth > args.tolerance
+            if slower or bigger:
+                change += ', REGRESSION'
+                regressions += 1
+
+        print(result['name'], result['rows'], result['seconds'], result['rows_per_second'],
+              '' if result['peak_rss_mb'] is None else round(result['peak_rss_mb']), change, sep='\t')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if regressions:
+        print(regressions, 'regressions beyond', '{:.0%}'.format(args.tolerance), file=sys.stderr)
+        sys.exit(1)
+
+def add_synthetic_arguments(subparser, density=2000, duplicates=.3, variation=.2):
+    ''' Add options for the shape of synthetic OpenAddresses data to a subcommand.
+
+        Subcommands can choose their own defaults for the main knobs.
+    '''
+    subparser.add_argument('--density', default=density, type=float,
+                           help='Addresses per square kilometer. Default value {:g}.'.format(density))
+    subparser.add_argument('--duplicates', default=duplicates, type=float,
+                           help='Fraction of addresses repeated by other sources. Default value {:g}.'.format(duplicates))
+    subparser.add_argument('--sources', default=3, type=int,
+                           help='Number of sources that can repeat an address. Default value 3.')
+    subparser.add_argument('--variation', default=variation, type=float,
+                           help='Fraction of repeats spelled differently. Default value {:g}.'.format(variation))
+    subparser.add_argument('--blanks', default=.01, type=float,
+                           help='Fraction of rows with no address or point. Default value 0.01.')
+    subparser.add_argument('--geoid', default='06075',
+                           help='Area geoid for every address record. Default value "06075".')
+
+parser = argparse.ArgumentParser(description='Benchmark pieces of the dedupe pipeline.')
+parser.add_argument('--seed', default=0, type=int, help='Random seed. Default value 0.')
+subparsers = parser.add_subparsers(dest='command')
+
+memory_parser = subparsers.add_parser('memory', help=bench_memory.__doc__.strip())
+memory_parser.add_argument('--count', default=100000, type=int, help='Number of distinct addresses. Default value 100000.')
+add_synthetic_arguments(memory_parser)
+memory_parser.set_defaults(func=bench_memory)
+
+blocking_parser = subparsers.add_parser('blocking', help=bench_blocking.__doc__.strip())
+blocking_parser.add_argument('--count', default=100000, type=int, help='Number of distinct addresses. Default value 100000.')
+add_synthetic_arguments(blocking_parser, density=25000, duplicates=.5)
+blocking_parser.set_defaults(func=bench_blocking)
+
+projection_parser = subparsers.add_parser('projection', help=bench_projection.__doc__.strip())
+projection_parser.add_argument('--count', default=1000000, type=int, help='Number of points. Default value 1000000.')
+projection_parser.set_defaults(func=bench_projection)
+
+normalize_parser = subparsers.add_parser('normalize', help=bench_normalize.__doc__.strip())
+normalize_parser.add_argument('--count', default=1000000, type=int, help='Number of street names. Default value 1000000.')
+normalize_parser.set_defaults(func=bench_normalize)
+
+matcher_parser = subparsers.add_parser('matcher', help=bench_matcher.__doc__.strip())
+matcher_parser.add_argument('--count', default=100000, type=int, help='Number of distinct addresses. Default value 100000.')
+matcher_parser.add_argument('--radius', default=blocking.DEFAULT_RADIUS, type=float,
+                            help='Match radius in web mercator meters. Default value {}.'.format(blocking.DEFAULT_RADIUS))
+matcher_parser.add_argument('--tile-count', default=20000, type=int,
+                            help='Number of addresses to compare in whole quadtiles. Default value 20000.')
+add_synthetic_arguments(matcher_parser, density=25000, duplicates=.5, variation=.5)
+matcher_parser.set_defaults(func=bench_matcher)
+
+mapping_parser = subparsers.add_parser('mapping', help=bench_mapping.__doc__.strip())
+mapping_parser.add_argument('--count', default=1000000, type=int, help='Number of distinct addresses. Default value 1000000.')
+mapping_parser.add_argument('--areas', default=1000, type=int, help='Number of areas. Default value 1000.')
+mapping_parser.add_argument('--mappers', default=[1, 2, 4], type=int, nargs='+',
+                            help='Numbers of parallel mappers. Default values 1, 2, and 4.')
+add_synthetic_arguments(mapping_parser)
+mapping_parser.set_defaults(func=bench_mapping)
+
+workers_parser = subparsers.add_parser('workers', help=bench_workers.__doc__.strip())
+workers_parser.add_argument('--count', default=1000000, type=int, help='Number of distinct addresses. Default value 1000000.')
+workers_parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='+',
+                            help='Numbers of matching worker processes, compared to the first. Default values 1, 2, and 4.')
+workers_parser.add_argument('--matcher', default='exact', choices=sorted(matchers.MATCHERS),
+                            help='Rules for matching addresses. Default value "exact".')
+add_synthetic_arguments(workers_parser, density=25000, duplicates=.5)
+workers_parser.set_defaults(func=bench_workers)
+
+reduce_memory_parser = subparsers.add_parser('reduce-memory', help=bench_reduce_memory.__doc__.strip())
+reduce_memory_parser.add_argument('--counts', default=[100000, 1000000, 5000000], type=int, nargs='+',
+                                  help='Numbers of addresses. Default values 100000, 1000000, and 5000000.')
+reduce_memory_parser.add_argument('--max-memory', default=100, type=int,
+                                  help='Memory limit in megabytes for expand-reduce.py. Default value 100.')
+add_synthetic_arguments(reduce_memory_parser, duplicates=.5)
+reduce_memory_parser.set_defaults(func=bench_reduce_memory)
+
+ingest_parser = subparsers.add_parser('ingest', help=bench_ingest.__doc__.strip().split('\n')[0])
+ingest_parser.add_argument('--count', default=1000000, type=int, help='Number of distinct addresses. Default value 1000000.')
+add_synthetic_arguments(ingest_parser)
+ingest_parser.set_defaults(func=bench_ingest)
+
+generate_parser = subparsers.add_parser('generate', help=bench_generate.__doc__.strip())
+generate_parser.add_argument('output', help='File to write synthetic data to.')
+generate_parser.add_argument('--count', default=100000, type=int, help='Number of distinct addresses. Default value 100000.')
+generate_parser.add_argument('--format', default='zip', choices=('csv', 'zip') + records.FORMATS,
+                             help='CSV, zipped tile for ingest.py, or area records for address-map.py. Default value "zip".')
+add_synthetic_arguments(generate_parser)
+generate_parser.set_defaults(func=bench_generate)
+
+suite_parser = subparsers.add_parser('suite', help=bench_suite.__doc__.strip().split('\n')[0])
+suite_parser.add_argument('--sizes', default=[10000, 100000, 1000000], type=int, nargs='+',
+                          help='Numbers of distinct addresses. Default values 10000, 100000, and 1000000.')
+suite_parser.add_argument('--pieces', default=100000, type=int,
+                          help='Number of distinct addresses for timing core pieces. Default value 100000.')
+suite_parser.add_argument('--format', default='json', choices=records.FORMATS,
+                          help='Record format for the pipeline scripts. Default value "json".')
+suite_parser.add_argument('--matcher', default='exact', choices=sorted(matchers.MATCHERS),
+                          help='Matcher for expand-reduce.py. Default value "exact".')
+suite_parser.add_argument('--output', help='JSON file to save results to, for a later --baseline.')
+suite_parser.add_argument('--baseline', help='JSON file of results from an earlier run to compare to.')
+suite_parser.add_argument('--tolerance', default=.2, type=float,
+                          help='Fraction of throughput lost or peak memory gained that counts '
+                               'as a regression. Default value 0.2.')
+add_synthetic_arguments(suite_parser)
+suite_parser.set_defaults(func=bench_suite)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('A benchmark command is required.')
+    args.func(args)
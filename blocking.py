@@ -0,0 +1,290 @@
+''' Group mapped address records into blocks of candidates without sorting.
+
+Addresses can only match when they share a blocking key from a matcher, such
+as number, token-normalized street name, and unit for exact matching, so
+candidates are gathered into hash buckets on that key instead of sorting
+every line by tile. Within each block, a grid of cells
+as wide as the match radius finds nearby pairs in Mercator meters, so each
+address needs to be mapped only once regardless of its tile.
+
+Large inputs can be spilled to a number of on-disk hash partitions, so that
+only one partition's worth of blocks is held in memory at a time. Since every
+member of a block lands in the same partition, partitions can also be reduced
+one at a time with separate batches, keeping memory use within a fixed limit.
+'''
+import os, math, tempfile, zlib, collections, itertools, multiprocessing
+
+import records
+from expand import tile_width
+
+# Default match radius in Mercator meters, one zoom=19 tile width.
+DEFAULT_RADIUS = round(tile_width, 1)
+
+# Approximate peak bytes of memory for each address in a reduced partition,
+# and a conservative guess of input bytes for each address record.
+ROW_MEMORY, RECORD_SIZE = 600, 100
+
+# Strings in each stream of a spilled binary partition file.
+SPILL_STRINGS = 2**12
+
+# Most partition files open at once when spilling to bounded partitions,
+# well within the usual limit of 1024 open files.
+MAX_PARTITIONS = 256
+
+def partition_index(addr_args, partitions, matcher, salt=''):
+    ''' Return a stable partition index for Address arguments.
+
+        Uses CRC32 of the matcher's partition key rather than hash() so that
+        every member of a block lands in the same partition, and assignments
+        survive restarts. A salt gives independent assignments for splitting
+        a partition again.
+    '''
+    key = salt + matcher.partition_key(addr_args)
+    return zlib.crc32(key.encode('utf8')) % partitions
+
+def group_blocks(lines, batch, matcher):
+    ''' Return lists of batch rows grouped by blocking key, in first-seen order.
+
+        Accepts an iterable of (tile key, Address arguments) pairs, and
+        appends each address to an AddressBatch. Tile keys are ignored.
+
+        >>> from expand import AddressBatch
+        >>> from matchers import ExactMatcher
+        >>> group_blocks([('19/1/1', ['src', 'abc', 0, 0, 0, 0, '123', 'Main Street', '']),
+        ...               ('19/1/1', ['src', 'def', 0, 0, 0, 0, '123', 'MAIN ST', ''])],
+        ...              AddressBatch(), ExactMatcher())
+        [[0, 1]]
+    '''
+    blocks = collections.OrderedDict()
+
+    for (_, addr_args) in lines:
+        try:
+            row = batch.append(*addr_args)
+        except:
+            continue
+        else:
+            # Blocks are ordered sets, since legacy quadtile input repeats rows.
+            blocks.setdefault(matcher.block_key(batch, row), dict())[row] = None
+
+    return [list(rows) for rows in blocks.values()]
+
+def iterate_blocks(lines, batch, matcher, partitions=1, tmpdir=None):
+    ''' Generate lists of AddressBatch rows sharing a matcher's blocking key.
+
+        Accepts an iterable of (tile key, Address arguments) pairs. With more
+        than one partition, addresses are first spilled to temporary files of
+        binary records by blocking key and each partition file is grouped separately.
+    '''
+    if partitions <= 1:
+        yield from group_blocks(lines, batch, matcher)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='blocks-', dir=tmpdir) as dirname:
+        for (filename, _) in spill_partitions(lines, partitions, matcher, dirname):
+            yield from group_blocks(records.read_binary(filename), batch, matcher)
+
+def spill_partitions(lines, partitions, matcher, dirname, salt=''):
+    ''' Write Address arguments to binary partition files by blocking key.
+
+        Accepts an iterable of (tile key, Address arguments) pairs. Returns a
+        list of partition file names with counts of addresses in each.
+    '''
+    filenames = [os.path.join(dirname, 'partition-{}{}.bin'.format(salt, i))
+                 for i in range(partitions)]
+    files = [open(filename, 'wb') for filename in filenames]
+    writers = [records.BinaryWriter(file, SPILL_STRINGS) for file in files]
+    counts = [0] * partitions
+
+    for (tile, addr_args) in lines:
+        try:
+            index = partition_index(addr_args, partitions, matcher, salt)
+            writers[index].write(tile, addr_args)
+        except:
+            continue
+        else:
+            counts[index] += 1
+
+    for file in files:
+        file.close()
+
+    return list(zip(filenames, counts))
+
+def bounded_partitions(lines, max_rows, matcher, dirname, partitions):
+    ''' Generate names of binary partition files with at most max_rows addresses.
+
+        Accepts an iterable of (tile key, Address arguments) pairs and an
+        initial number of partitions, up to MAX_PARTITIONS. Partitions that
+        turn out too large are split again with a new salt, except for single
+        blocks that cannot be. Callers may remove each file once it has been read.
+    '''
+    pending = collections.deque(spill_partitions(lines, min(partitions, MAX_PARTITIONS), matcher, dirname))
+
+    while pending:
+        filename, count = pending.popleft()
+
+        if count <= max_rows:
+            yield filename
+            continue
+
+        salt = os.path.basename(filename)[len('partition-'):-len('.bin')] + '-'
+        split = spill_partitions(records.read_binary(filename), min(math.ceil(count / max_rows) + 1, MAX_PARTITIONS),
+                                 matcher, dirname, salt)
+        os.remove(filename)
+
+        for (filename, subcount) in reversed(split):
+            if subcount == count:
+                # A single block larger than max_rows cannot be split further.
+                yield filename
+            else:
+                pending.appendleft((filename, subcount))
+
+def candidate_pairs(batch, rows, radius):
+    ''' Generate pairs of rows in a block within radius Mercator meters.
+
+        Rows are bucketed into square grid cells as wide as the radius, so
+        only the eight neighboring cells need to be checked for each row.
+
+        >>> from expand import AddressBatch
+        >>> batch = AddressBatch()
+        >>> rows = [batch.append('src', h, 0, 0, x, 0, '1', 'Main St', '')
+        ...         for (h, x) in (('a', 0), ('b', 50), ('c', 120), ('d', 500))]
+        >>> sorted(candidate_pairs(batch, rows, 76.4))
+        [(0, 1), (1, 2)]
+    '''
+    if len(rows) < 2:
+        return
+
+    xs, ys, cells = batch.xs, batch.ys, collections.defaultdict(list)
+    radius2 = radius * radius
+
+    for row2 in rows:
+        x2, y2 = xs[row2], ys[row2]
+        col, row = math.floor(x2 / radius), math.floor(y2 / radius)
+
+        for dcol in (-1, 0, 1):
+            for drow in (-1, 0, 1):
+                for row1 in cells.get((col + dcol, row + drow), ()):
+                    dx, dy = xs[row1] - x2, ys[row1] - y2
+                    if dx * dx + dy * dy <= radius2:
+                        yield (row1, row2)
+
+        cells[(col, row)].append(row2)
+
+def matched_pairs(batch, blocks, radius, matcher, counts=None):
+    ''' Return a list of matched row pairs from candidates in a list of blocks.
+
+        Adds numbers of pairs compared and matched to an optional Counter.
+    '''
+    pairs, compared = list(), 0
+
+    for rows in blocks:
+        for (row1, row2) in candidate_pairs(batch, rows, radius):
+            compared += 1
+            if matcher.matches(batch, row1, row2):
+                pairs.append((row1, row2))
+
+    if counts is not None:
+        counts['pairs compared'] += compared
+        counts['matches'] += len(pairs)
+
+    return pairs
+
+def tile_pairs(batch, rows, matcher, counts=None):
+    ''' Return matched pairs among all rows of a whole tile, as in legacy sort reduce mode.
+
+        Pairs are in the order of itertools.combinations(rows, 2), but only
+        rows with equal blocking keys can match, so only those are compared.
+        Adds numbers of all pairs in the tile and pairs matched to an
+        optional Counter.
+
+        >>> from expand import AddressBatch
+        >>> from matchers import ExactMatcher
+        >>> batch = AddressBatch()
+        >>> rows = [batch.append('src', h, 0, 0, 0, 0, n, s, '') for (h, n, s) in
+        ...         (('a', '1', 'Main St'), ('b', '2', 'Main St'), ('c', '1', 'MAIN STREET'), ('d', '1', 'Main St'))]
+        >>> tile_pairs(batch, rows, ExactMatcher())
+        [(0, 2), (0, 3), (2, 3)]
+    '''
+    groups = collections.defaultdict(list)
+
+    for (index, row) in enumerate(rows):
+        groups[matcher.block_key(batch, row)].append(index)
+
+    pairs = sorted((index1, index2) for indexes in groups.values() if len(indexes) > 1
+                   for (index1, index2) in itertools.combinations(indexes, 2)
+                   if matcher.matches(batch, rows[index1], rows[index2]))
+
+    if counts is not None:
+        counts['pairs compared'] += len(rows) * (len(rows) - 1) // 2
+        counts['matches'] += len(pairs)
+
+    return [(rows[index1], rows[index2]) for (index1, index2) in pairs]
+
+# Batch, blocks, radius, and matcher shared with forked worker processes.
+_shared_blocks = None
+
+def iterate_tasks(blocks, size=10000):
+    ''' Generate (start, stop) ranges of block indexes with about size rows each.
+
+        Single-row blocks have no pairs, and should be removed beforehand.
+
+        >>> list(iterate_tasks([[0, 1], [2, 3, 4], [5, 6]], size=4))
+        [(0, 2), (2, 3)]
+    '''
+    start, rows = 0, 0
+
+    for (index, block) in enumerate(blocks):
+        rows += len(block)
+
+        if rows >= size:
+            yield (start, index + 1)
+            start, rows = index + 1, 0
+
+    if start < len(blocks):
+        yield (start, len(blocks))
+
+def run_task(task):
+    ''' Return matched pairs of batch rows and counts for one range of shared blocks.
+    '''
+    (start, stop), (batch, blocks, radius, matcher) = task, _shared_blocks
+    counts = collections.Counter()
+    pairs = matched_pairs(batch, blocks[start:stop], radius, matcher, counts)
+    return pairs, counts
+
+def parallel_pairs(batch, blocks, radius, matcher, workers, counts=None):
+    ''' Generate matched pairs from blocks of batch rows across a pool of processes.
+
+        Workers are forked once the batch and blocks are complete and share
+        them, so each task sent to a worker is only a range of block indexes.
+        Results are yielded in task order, with a bounded number of tasks in
+        flight. Adds numbers of pairs compared and matched to an optional Counter.
+    '''
+    global _shared_blocks
+
+    def results(result):
+        pairs, task_counts = result.get()
+        if counts is not None:
+            counts.update(task_counts)
+        return pairs
+
+    _shared_blocks = batch, [rows for rows in blocks if len(rows) > 1], radius, matcher
+
+    # Fork explicitly, since scripts calling this have no main guard to
+    # protect them from being re-run by the spawn or forkserver methods.
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            pending = collections.deque()
+
+            for task in iterate_tasks(_shared_blocks[1]):
+                pending.append(pool.apply_async(run_task, (task, )))
+                if len(pending) >= workers * 2:
+                    yield from results(pending.popleft())
+
+            while pending:
+                yield from results(pending.popleft())
+    finally:
+        _shared_blocks = None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
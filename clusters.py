@@ -0,0 +1,124 @@
+''' Disjoint-set clustering of matched OpenAddresses data.
+
+Match edges between addresses are consumed as they are produced, and merged
+transitively so that chains of pairwise matches end up in a single cluster.
+Centroids, radii, and source counts of many clusters are then computed at once
+with NumPy group-by reductions over the batch's coordinate arrays.
+'''
+import array, collections, itertools
+
+class Clusters:
+    ''' Union-find forest over AddressBatch rows, which are unique on Address.hash.
+
+        >>> clusters = Clusters()
+        >>> [clusters.add() for _ in range(4)]
+        [0, 1, 2, 3]
+        >>> clusters.union(0, 1)
+        >>> clusters.union(2, 1)
+        >>> list(clusters.iterate())
+        [[0, 1, 2], [3]]
+    '''
+    def __init__(self):
+        self.parents = array.array('L')
+        self.sizes = array.array('L')
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self):
+        ''' Add a new row as its own cluster and return its index.
+        '''
+        row = len(self.parents)
+        self.parents.append(row)
+        self.sizes.append(1)
+        return row
+
+    def extend(self, count):
+        ''' Add rows as their own clusters until there are count rows.
+        '''
+        while len(self.parents) < count:
+            self.add()
+
+    def find(self, row):
+        ''' Return the root row of the cluster containing a row.
+        '''
+        parents = self.parents
+
+        while parents[row] != row:
+            # Path halving keeps trees shallow without recursion.
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+
+        return row
+
+    def union(self, row1, row2):
+        ''' Merge the clusters containing two matched rows.
+
+            Rows not yet seen are first added as their own clusters.
+        '''
+        self.extend(max(row1, row2) + 1)
+        root1, root2 = self.find(row1), self.find(row2)
+
+        if root1 == root2:
+            return
+
+        if self.sizes[root1] < self.sizes[root2]:
+            root1, root2 = root2, root1
+
+        self.parents[root2] = root1
+        self.sizes[root1] += self.sizes[root2]
+
+    def iterate(self):
+        ''' Generate lists of clustered rows in one linear pass.
+
+            Clusters and their members are ordered by first insertion, so
+            output is independent of the order that edges were seen.
+        '''
+        members = collections.OrderedDict()
+
+        for row in range(len(self.parents)):
+            members.setdefault(self.find(row), []).append(row)
+
+        yield from members.values()
+
+def statistics(batch, row_lists):
+    ''' Return a dictionary of NumPy arrays of statistics for lists of clustered rows.
+
+        Each cluster has a mean lon, lat, x, and y, a count of members, a
+        mean and maximum distance of members from its Mercator centroid, and
+        a count of distinct member sources. Runs no Python code for each member.
+
+        >>> from expand import AddressBatch
+        >>> batch = AddressBatch()
+        >>> rows = [batch.append(s, h, 0, 0, x, y, '1', 'Main St', '') for (s, h, x, y)
+        ...         in (('a', 'a', 0, 0), ('b', 'b', 6, 8), ('a', 'c', 3, 4), ('a', 'd', 9, 9))]
+        >>> stats = statistics(batch, [[0, 1, 2], [3]])
+        >>> stats['x'].tolist(), stats['radius'].tolist(), stats['max_radius'].tolist(), stats['sources'].tolist()
+        ([3.0, 9.0], [3.3333333333333335, 0.0], [5.0, 0.0], [2, 1])
+    '''
+    import numpy
+
+    sizes = numpy.fromiter(map(len, row_lists), dtype=numpy.int64, count=len(row_lists))
+    rows = numpy.fromiter(itertools.chain.from_iterable(row_lists), dtype=numpy.int64, count=int(sizes.sum()))
+    labels = numpy.repeat(numpy.arange(len(row_lists)), sizes)
+    starts = numpy.cumsum(sizes) - sizes
+
+    def mean(values):
+        return numpy.bincount(labels, values, len(row_lists)) / sizes
+
+    lons, lats, xs, ys = (column[rows] for column in batch.coordinates())
+    stats = dict(count=sizes, lon=mean(lons), lat=mean(lats), x=mean(xs), y=mean(ys))
+    distances = numpy.hypot(xs - stats['x'][labels], ys - stats['y'][labels])
+    stats.update(radius=mean(distances), max_radius=numpy.maximum.reduceat(distances, starts))
+
+    # Count distinct (cluster, source) pairs for each cluster.
+    codes = batch.columns['source'].codes
+    sources = numpy.frombuffer(codes, dtype='u{}'.format(codes.itemsize))[rows].astype(numpy.int64)
+    width = len(batch.columns['source'].values)
+    stats['sources'] = numpy.bincount(numpy.unique(labels * width + sources) // width, minlength=len(row_lists))
+
+    return stats
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
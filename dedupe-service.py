@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+''' Serve duplicate lookups and inserts for deduped areas over local HTTP.
+
+Loads mapped address files from address-map.py into an in-memory index,
+clustered just as expand-reduce.py would in hash reduce mode, and then answers
+whether incoming addresses are duplicates of an existing cluster. New
+addresses can be inserted as they arrive, so that streaming feeds are deduped
+between nightly batch runs without running expand-reduce.py again:
+
+    $ ./dedupe-service.py --port 8080 addresses-06075.txt
+    $ curl -d '{"LON": -122.4194, "LAT": 37.7749, "NUMBER": "1", "STREET": "Main St"}' \\
+        http://127.0.0.1:8080/lookup
+
+See service.py for requests and responses.
+'''
+import argparse, math, sys, blocking, matchers, metrics, records, service
+
+parser = argparse.ArgumentParser(description='Serve duplicate lookups and inserts for deduped areas over local HTTP.')
+
+parser.add_argument('inputs', nargs='*', help='Files containing tile-prefixed address data.')
+
+parser.add_argument('--radius', default=blocking.DEFAULT_RADIUS, type=float,
+                    help='Maximum distance in web mercator meters between matched '
+                         'addresses. Default value {}, one zoom=19 tile width.'.format(blocking.DEFAULT_RADIUS))
+
+parser.add_argument('--format', default='json', choices=records.FORMATS,
+                    help='Format of input address records, JSON text lines or binary. '
+                         'Default value "json".')
+
+parser.add_argument('--matcher', default='exact', choices=sorted(matchers.MATCHERS),
+                    help='Rules for matching addresses, as in expand-reduce.py. '
+                         'Default value "exact".')
+
+parser.add_argument('--host', default='127.0.0.1',
+                    help='Address to listen on. Default value "127.0.0.1".')
+
+parser.add_argument('--port', default=8080, type=int,
+                    help='Port to listen on. Default value 8080.')
+
+metrics.add_arguments(parser)
+
+args = parser.parse_args()
+
+if not (args.radius > 0 and math.isfinite(args.radius)):
+    parser.error('Radius must be a positive number of meters.')
+
+run_metrics = metrics.Metrics('dedupe-service.py', args.profile)
+index = service.DedupeIndex(matchers.MATCHERS[args.matcher](), args.radius)
+
+with run_metrics.stage('load', hot=True):
+    for filename in args.inputs:
+        print('Loading', filename, '...', file=sys.stderr)
+        run_metrics.count('rows in', index.load(records.read(filename, args.format)))
+
+print('-', len(index), 'addresses in', len(index.members), 'clusters at',
+      run_metrics.elapsed(), file=sys.stderr)
+
+server = service.make_server(index, args.host, args.port, run_metrics)
+print('Listening on http://{}:{}'.format(*server.server_address[:2]), file=sys.stderr)
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    run_metrics.write(args.report)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 ''' Reduce mapped OpenAddresses duplicates to a new GeoJSON file.
 
-Accepts sorted input from expand-map.py and iterates over address rows within
-named web mercator tiles. Optimized for and tested with simple commandline
-implementations like bashreduce:
+Accepts input from address-map.py, groups address rows into blocks with equal
+number, normalized street, and unit, and compares rows within a block that are
+no more than a given radius apart in web mercator meters. The original sorted
+tile reducer remains available for quadtile input, and is optimized for and
+tested with simple commandline implementations like bashreduce:
 
     http://blog.last.fm/2009/04/06/mapreduce-bash-script
 
@@ -16,155 +18,281 @@ Certain U.S.-specific street name tokens like "Av"/"Ave"/"Avenue", "E"/"East",
 or "2nd"/"Second" are treated as identical to maximize matches.
 '''
 import argparse, itertools, pprint, re, json, hashlib, datetime, \
-    sys, operator, subprocess, io, math, statistics, csv, sqlite3
+    sys, operator, subprocess, io, math, os, tempfile
 
-from expand import Address
+from expand import AddressBatch
+import blocking, clusters, incremental, matchers, metrics, outputs, records
 
-def iterate_addresses(db):
+def iterate_sorted_groups(filename, batch):
+    ''' Generate lists of batch rows from whole tiles of externally-sorted lines.
     '''
+    sorter = subprocess.Popen(['sort', '-k', '1,20', filename], stdout=subprocess.PIPE)
+    lines = (line.split(' ', 1) for line in io.TextIOWrapper(sorter.stdout))
+
+    for (key, rows) in itertools.groupby(lines, key=operator.itemgetter(0)):
+        #print('.', sep='', end='', file=sys.stderr)
+
+        key_rows = list()
+        for row in rows:
+            try:
+                _, addr_args = row
+                key_rows.append(batch.append(*json.loads(addr_args)))
+            except:
+                pass
+        
+        yield key_rows
+
+    sorter.wait()
+
+def iterate_sorted_pairs(batch, groups):
+    ''' Generate matched pairs of batch rows from all pairs in whole tiles.
     '''
-    while True:
-        try:
-            res = db.execute('select args_list from addrs limit 1')
-            (addr_args, ) = res.fetchone()
-        except TypeError:
-            break
-        else:
-            yield Address(*json.loads(addr_args))
+    for rows in groups:
+        yield from blocking.tile_pairs(batch, rows, matcher, run_metrics.counters)
 
-def load_neighbors(db, hash):
+def iterate_pairs(batch, groups):
+    ''' Generate matched pairs of batch rows from groups of candidate rows.
     '''
+    if args.workers > 1:
+        # Workers share the batch, so groups must be fully read before they fork.
+        return blocking.parallel_pairs(batch, groups, args.radius, matcher,
+                                       args.workers, run_metrics.counters)
+
+    return (pair for rows in groups for pair
+            in blocking.matched_pairs(batch, [rows], args.radius, matcher, run_metrics.counters))
+
+def reduce_partitions(filenames):
+    ''' Generate CSV output rows from binary partition files one at a time.
+
+        Each partition has its own batch, which is released before the next
+        partition is read. Partition files are removed after reading.
     '''
-    neighbors = dict()
-    
-    res1 = db.execute('''select edges.hash2, addrs.args_list from edges, addrs
-                         where edges.hash1 = ? and addrs.hash = edges.hash2''', (hash, ))
+    filenames = iter(filenames)
 
-    res2 = db.execute('''select edges.hash1, addrs.args_list from edges, addrs
-                         where edges.hash2 = ? and addrs.hash = edges.hash1''', (hash, ))
+    while True:
+        with run_metrics.stage('spill'):
+            filename = next(filenames, None)
 
-    for (h, a) in res1:
-        neighbors[h] = Address(*json.loads(a))
-    
-    for (h, a) in res2:
-        neighbors[h] = Address(*json.loads(a))
+        if filename is None:
+            break
 
-    return neighbors
+        batch = AddressBatch()
+        with run_metrics.stage('read'):
+            groups = blocking.group_blocks(records.read_binary(filename), batch, matcher)
+        run_metrics.count('rows in', len(batch))
+        address_clusters = clusters.Clusters()
 
-def delete_address(db, hash):
-    '''
-    '''
-    db.execute('delete from addrs where hash = ?', (hash, ))
+        with run_metrics.stage('match', hot=True):
+            for (row1, row2) in iterate_pairs(batch, groups):
+                address_clusters.union(row1, row2)
 
-def add_address(db, hash, args_list):
-    '''
+        address_clusters.extend(len(batch))
+        os.remove(filename)
+
+        yield from iterate_summaries(batch, address_clusters.iterate())
+
+def summarize_clusters(batch, row_lists):
+    ''' Return a list of output dictionaries for lists of clustered batch rows.
+
+        Single addresses keep their own point. When there are matching nearby
+        neighbors, record the center of the identified point cluster, counts
+        of duplicate points and distinct sources, and mean and maximum
+        distance from the center in web mercator meters.
     '''
-    try:
-        db.execute('insert into raw_addrs (hash, args_list) values (?, ?)',
-                   (hash, args_list))
-    except sqlite3.IntegrityError:
-        pass
-    else:
-        pass # print('insert addrs', (hash))
+    stats = clusters.statistics(batch, row_lists)
+    columns = [stats[name].tolist() for name in ('lon', 'lat', 'count', 'radius', 'max_radius', 'sources')]
+    numbers, streets, units = [batch.columns[field] for field in ('number', 'street', 'unit')]
+    hashes, summaries = batch.hashes, list()
 
-def add_edge(db, hash1, hash2):
+    for (rows, lon, lat, count, radius, max_radius, sources) in zip(row_lists, *columns):
+        row = rows[0]
+        summaries.append({
+            'NUMBER': numbers[row],
+            'STREET': streets[row],
+            'UNIT': units[row],
+            'LON': lon,
+            'LAT': lat,
+            'OA:COUNT': count,
+            'OA:RADIUS': int(radius) if count > 1 else None,
+            'OA:MAX_RADIUS': int(max_radius) if count > 1 else None,
+            'OA:SOURCES': sources,
+            'OA:HASHES': [hashes[row] for row in rows],
+            })
+
+    return summaries
+
+def iterate_summaries(batch, row_lists, size=2**14):
+    ''' Generate output dictionaries for clusters, summarized size clusters at a time.
     '''
+    row_lists = iter(row_lists)
+
+    while True:
+        chunk = list(itertools.islice(row_lists, size))
+        if not chunk:
+            break
+        yield from summarize_clusters(batch, chunk)
+
+def write_clusters(out, summaries):
+    ''' Write output dictionaries for clusters in batches, and close the writer.
     '''
-    try:
-        db.execute('insert into edges (hash1, hash2) values (?, ?)', (hash1, hash2))
-    except sqlite3.IntegrityError:
-        pass
-    else:
-        pass # print('insert edges', (hash1, hash2))
+    merged_count = 0
+
+    for output in summaries:
+        out.write(output)
+        run_metrics.observe('cluster size', output['OA:COUNT'])
+        merged_count += 1
+
+    out.close()
 
-db = sqlite3.connect(':memory:')
-db.execute('create table raw_addrs ( hash text, args_list text )')
-db.execute('create table addrs ( hash text, args_list text, primary key (hash) )')
-db.execute('create table edges ( hash1 text, hash2 text, primary key (hash1, hash2) )')
+    run_metrics.count('rows out', merged_count)
+    print(merged_count, 'merged addresses at', run_metrics.elapsed(), file=sys.stderr)
 
 parser = argparse.ArgumentParser(description='Reduce mapped OpenAddresses duplicates to a new GeoJSON file.')
 
-parser.add_argument('input', help='Text file containing tile-prefixed address data.')
-parser.add_argument('output', help='CSV file for deduped addresses.')
+parser.add_argument('input', help='File containing tile-prefixed address data.')
+parser.add_argument('output', help='File for deduped addresses.')
+
+parser.add_argument('--reduce', default='hash', choices=('hash', 'sort'),
+                    help='Group candidates into hash buckets on a blocking key, '
+                         'or externally sort lines and compare whole tiles of '
+                         'input from address-map.py --quadtiles. Default value "hash".')
+
+parser.add_argument('--radius', default=blocking.DEFAULT_RADIUS, type=float,
+                    help='Maximum distance in web mercator meters between matched '
+                         'addresses in hash reduce mode. Default value {}, '
+                         'one zoom=19 tile width.'.format(blocking.DEFAULT_RADIUS))
+
+parser.add_argument('--partitions', default=1, type=int,
+                    help='Number of on-disk hash partitions to spill to in hash '
+                         'reduce mode. Default value 1 keeps all blocks in memory.')
+
+parser.add_argument('--format', default='json', choices=records.FORMATS,
+                    help='Format of input address records, JSON text lines or binary. '
+                         'Default value "json".')
+
+parser.add_argument('--matcher', default='exact', choices=sorted(matchers.MATCHERS),
+                    help='Rules for matching addresses: exact number, normalized '
+                         'street, and unit, or fuzzy house number, unit, and street '
+                         'name spelling. Default value "exact".')
+
+parser.add_argument('--workers', default=1, type=int,
+                    help='Number of processes matching candidate pairs in hash '
+                         'reduce mode. Default value 1.')
+
+parser.add_argument('--max-memory', type=int,
+                    help='Approximate limit in megabytes on memory used in hash reduce '
+                         'mode. Addresses are spilled to as many on-disk partitions as '
+                         'needed, and each is reduced on its own. Output is ordered '
+                         'by partition.')
+
+parser.add_argument('--state',
+                    help='SQLite file of tile fingerprints and clusters from a previous '
+                         'run, to re-reduce only changed tiles in hash reduce mode. '
+                         'Created if missing. Partitions and workers are not used.')
+
+parser.add_argument('--output-format', choices=outputs.FORMATS,
+                    help='Format of output file: CSV, newline-delimited GeoJSON, '
+                         'GeoPackage, Parquet, or Arrow IPC. All but CSV include '
+                         'member address hashes. Default value is guessed from '
+                         'the output file extension, or "csv".')
+
+metrics.add_arguments(parser)
 
 args = parser.parse_args()
 
-start = datetime.datetime.now()
-print('Sorting lines from', args.input, '...', file=sys.stderr)
-sorter = subprocess.Popen(['sort', '-k', '1,20', args.input], stdout=subprocess.PIPE)
-lines = (line.split(' ', 1) for line in io.TextIOWrapper(sorter.stdout))
-
-for (key, rows) in itertools.groupby(lines, key=operator.itemgetter(0)):
-    #print('.', sep='', end='', file=sys.stderr)
-
-    key_addresses = list()
-    for row in rows:
-        try:
-            _, addr_args = row
-            addr = Address(*json.loads(addr_args))
-        except:
-            pass
-        else:
-            key_addresses.append(addr)
-            add_address(db, addr.hash, addr_args)
-    
-    for (addr1, addr2) in itertools.combinations(key_addresses, 2):
-        if addr1.matches(addr2):
-            add_edge(db, min(addr1.hash, addr2.hash), max(addr1.hash, addr2.hash))
-
-sorter.wait()
-
-(count, ) = db.execute('select count(*) from addrs').fetchone()
-print('-', count, 'addresses at', (datetime.datetime.now() - start), file=sys.stderr)
-
-db.execute('insert into addrs select distinct hash, args_list from raw_addrs')
-db.execute('create index edge1 on edges (hash1)')
-db.execute('create index edge2 on edges (hash2)')
-print('Indexed edges at', (datetime.datetime.now() - start), file=sys.stderr)
-
-merged_count = 0
-
-with open(args.output, 'w') as file:
-    out = csv.DictWriter(file, ('NUMBER', 'STREET', 'UNIT', 'LAT', 'LON', 'OA:COUNT', 'OA:RADIUS'))
-    out.writeheader()
-    
-    for address in iterate_addresses(db):
-        neighbors = load_neighbors(db, address.hash)
-        longitude, latitude = address.lon, address.lat
-        neighbor_count, neighbor_radius = 1, None
-        
-        if len(neighbors) > 0:
-            # When there are matching nearby neighbors, record the center of
-            # the identified point cluster and note count of duplicate points.
-            xs, ys = [address.x], [address.y]
-            lons, lats = [address.lon], [address.lat]
-            for (neighbor_hash, neighbor) in neighbors.items():
-                lons.append(neighbor.lon)
-                lats.append(neighbor.lat)
-                xs.append(neighbor.x)
-                ys.append(neighbor.y)
-                neighbor_count += 1
-                delete_address(db, neighbor_hash)
-            longitude = statistics.mean(lons)
-            latitude = statistics.mean(lats)
-            x, y = statistics.mean(xs), statistics.mean(ys)
-            hypots = [math.hypot(x - x1, y - y1) for (x1, y1) in zip(xs, ys)]
-            neighbor_radius = int(statistics.mean(hypots))
-    
-        delete_address(db, address.hash)
-        merged_count += 1
+if args.reduce == 'sort' and args.format != 'json':
+    parser.error('Sort reduce mode requires JSON text input.')
 
-        out.writerow({
-            'NUMBER': address.number,
-            'STREET': address.street,
-            'UNIT': address.unit,
-            'LON': longitude,
-            'LAT': latitude,
-            'OA:COUNT': neighbor_count,
-            'OA:RADIUS': neighbor_radius,
-            })
+if args.reduce == 'sort' and args.workers > 1:
+    parser.error('Sort reduce mode does not support multiple workers.')
+
+if args.reduce == 'sort' and args.state:
+    parser.error('Sort reduce mode does not support a state file.')
+
+if args.max_memory and (args.reduce == 'sort' or args.state or args.partitions > 1):
+    parser.error('Memory limit is only supported in plain hash reduce mode.')
+
+if not (args.radius > 0 and math.isfinite(args.radius)):
+    parser.error('Radius must be a positive number of meters.')
+
+if args.state and args.radius > incremental.MAX_RADIUS:
+    parser.error('Radius with a state file must be at most {:.1f}, one zoom={} tile width.'.format(
+        incremental.MAX_RADIUS, incremental.DEFAULT_ZOOM))
+
+output_format = args.output_format or outputs.guess_format(args.output)
+
+try:
+    # Open output first, so a missing optional package fails before any work.
+    out = outputs.writer(args.output, output_format)
+except ImportError as error:
+    parser.error('Output format "{}" requires {}.'.format(output_format, error.name))
+
+run_metrics = metrics.Metrics('expand-reduce.py', args.profile)
+batch = AddressBatch()
+matcher = matchers.MATCHERS[args.matcher]()
+
+if args.state:
+    print('Reading lines from', args.input, '...', file=sys.stderr)
+    with run_metrics.stage('read'):
+        for (_, addr_args) in records.read(args.input, args.format):
+            try:
+                batch.append(*addr_args)
+            except:
+                pass
+    run_metrics.count('rows in', len(batch))
+
+    store = incremental.StateStore(args.state, matcher, args.radius)
+    with run_metrics.stage('incremental', hot=True):
+        dirty_count, tile_count = store.update(batch, summarize_clusters, run_metrics.counters)
+    run_metrics.count('tiles re-reduced', dirty_count)
+    print('-', dirty_count, 'of', tile_count, 'tiles re-reduced at', run_metrics.elapsed(), file=sys.stderr)
+    with run_metrics.stage('write'):
+        write_clusters(out, store.iterate_outputs())
+    store.close()
+
+elif args.max_memory:
+    max_rows = args.max_memory * 1024**2 // blocking.ROW_MEMORY
+    partitions = math.ceil(os.path.getsize(args.input) / blocking.RECORD_SIZE / max_rows)
+    partitions = min(max(partitions, 1), blocking.MAX_PARTITIONS)
+    print('Spilling lines from', args.input, 'to', partitions, 'partitions ...', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix='reduce-', dir=os.path.dirname(args.output) or None) as dirname:
+        filenames = blocking.bounded_partitions(records.read(args.input, args.format),
+                                                max_rows, matcher, dirname, partitions)
+        # Spilling, reading, and matching each partition are nested in this stage.
+        with run_metrics.stage('reduce'):
+            write_clusters(out, reduce_partitions(filenames))
+
+else:
+    if args.reduce == 'sort':
+        print('Sorting lines from', args.input, '...', file=sys.stderr)
+        with run_metrics.stage('sort'):
+            groups = list(iterate_sorted_groups(args.input, batch))
+        pairs = iterate_sorted_pairs(batch, groups)
+    else:
+        print('Blocking lines from', args.input, '...', file=sys.stderr)
+        groups = blocking.iterate_blocks(records.read(args.input, args.format),
+                                         batch, matcher, args.partitions, os.path.dirname(args.output) or None)
+        if args.partitions <= 1 or args.workers > 1:
+            with run_metrics.stage('read'):
+                groups = list(groups)
+        pairs = iterate_pairs(batch, groups)
+
+    address_clusters = clusters.Clusters()
+
+    # With partitions, reading is interleaved with matching.
+    with run_metrics.stage('match', hot=True):
+        for (row1, row2) in pairs:
+            address_clusters.union(row1, row2)
+
+    address_clusters.extend(len(batch))
+    run_metrics.count('rows in', len(batch))
+    print('-', len(address_clusters), 'addresses at', run_metrics.elapsed(), file=sys.stderr)
+
+    with run_metrics.stage('write'):
+        write_clusters(out, iterate_summaries(batch, address_clusters.iterate()))
 
-    print(merged_count, 'merged addresses at', (datetime.datetime.now() - start), file=sys.stderr)
+run_metrics.write(args.report)
 
 if __name__ == '__main__':
     import doctest
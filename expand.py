@@ -1,121 +1,120 @@
 ''' Utility class for deduplicating OpenAddresses data.
 '''
-import json, hashlib, math, sys
-
-# Living on borrowed data.
-tokens = [
-    ["10th","Tenth"],["11th","Eleventh"],["12th","Twelfth"],["13th","Thirteenth"],
-    ["14th","Fourteenth"],["15th","Fifteenth"],["16th","Sixteenth"],["17th","Seventeenth"],
-    ["18th","Eighteenth"],["19th","Nineteenth"],["1st","First"],["20th","Twentieth"],
-    ["2nd","Second"],["3rd","Third"],["4th","Fourth"],["5th","Fifth"],["6th","Sixth"],
-    ["7th","Seventh"],["8th","Eighth"],["9th","Ninth"],["Accs","Access"],["Alwy","Alleyway"],
-    ["Aly","Ally","Alley"],["Ambl","Amble"],["App","Approach"],["Apt","Apartment"],
-    ["Apts","Apartments"],["Arc","Arcade"],["Artl","Arterial"],["Arty","Artery"],
-    ["Ave","Avenue","Av"],["Ba","Banan"],["Bch","Beach"],["Bg","Burg"],["Bgs","Burgs"],
-    ["Blf","Bluff"],["Blk","Block"],["Br","Brace","Branch"],["Brg","Bridge"],
-    ["Brk","Break","Brook"],["Brks","Brooks"],["Btm","Bottom"],["Bvd","Blvd","Boulevard"],
-    ["Bwlk","Boardwalk"],["Byp","Bypa","Bypass"],["Byu","Bayou"],["Bywy","Byway"],
-    ["Bzr","Bazaar"],["Cantt","Cantonment"],["Cct","Circuit"],["Ch","Chase","Church"],
-    ["Chk","Chowk"],["Cir","Circle"],["Cirs","Circles"],["Cl","Close","Clinic"],
-    ["Clb","Club"],["Clf","Cliff"],["Clfs","Cliffs"],["Cll","Calle"],["Cly","Colony"],
-    ["Cmn","Common"],["Cnl","Canal"],["Cnr","Cor","Corner"],["Coll","College"],
-    ["Con","Concourse"],["Const","Constituency"],["Corpn","Corporation"],["Cp","Camp"],
-    ["Cpe","Cape"],["Cplx","Complex"],["Cps","Copse"],["Crcs","Circus"],["Crk","Creek"],
-    ["Crse","Course"],["Crst","Crest"],["Csac","Cul-de-sac"],["Cswy","Causeway"],
-    ["Ct","Court"],["Ctr","Center","Centre"],["Ctrs","Centers"],["Cts","Courts"],
-    ["Ctyd","Courtyard"],["Curv","Curve"],["Cutt","Cutting"],["Cv","Cove"],["Cyn","Canyon"],
-    ["Dl","Dale"],["Dm","Dam"],["Dr","Drive"],["Drs","Drives"],["Dt","District"],
-    ["Dv","Divide"],["Dvwy","Driveway"],["E","East"],["Elb","Elbow"],["Ent","Entrance"],
-    ["Esp","Esplanade"],["Est","Estate"],["Ests","Estates"],["Exp","Expy","Expressway"],
-    ["Ext","Extension"],["Exts","Extensions"],["Fawy","Fairway"],["Fld","Field"],
-    ["Flds","Fields"],["Fls","Falls"],["Flt","Flat"],["Flts","Flats"],["Folw","Follow"],
-    ["Form","Formation"],["Frd","Ford"],["Frg","Forge"],["Frgs","Forges"],["Frk","Fork"],
-    ["Frst","Forest"],["Frtg","Frontage"],["Fry","Ferry"],["Ft","Feet","Fort"],
-    ["Ftwy","Footway"],["Fwy","Freeway"],["Gdns","Gardens"],["Gen","General"],["Gl","Galli"],
-    ["Glde","Glade"],["Govt","Government"],["Gr","Grove"],["Gra","Grange"],["Grd","Grade"],
-    ["Grn","Green"],["Gte","Gate"],["Hbr","Harbor"],["Hbrs","Harbors"],["Hird","Highroad"],
-    ["Hl","Hill"],["Hls","Hills"],["Holw","Hollow"],["Hosp","Hospital"],["Htl","Hotel"],
-    ["Hts","Heights"],["Hvn","Haven"],["Hwy","Highway"],["I","Interstate"],
-    ["Ind","Industrial"],["Intg","Interchange"],["Is","Island"],["Iss","Islands"],
-    ["Jcts","Junctions"],["Jn","Jct","Jnc","Junction"],["Jr","Junior"],["Knl","Knoll"],
-    ["Knls","Knolls"],["Ky","Key"],["Kys","Keys"],["Lck","Lock"],["Lcks","Locks"],
-    ["Ldg","Lodge"],["Lf","Loaf"],["Lgt","Light"],["Lgts","Lights"],["Lk","Lake"],
-    ["Lks","Lakes"],["Lkt","Lookout"],["Ln","Lane"],["Lndg","Landing"],["Lnwy","Laneway"],
-    ["Lt","Lieutenant"],["Lyt","Layout"],["Maj","Major"],["Mal","Mall"],
-    ["Mcplty","Municpality"],["Mdw","Meadow"],["Mdws","Meadows"],["Mg","Marg"],
-    ["Mhd","Moorhead"],["Mkt","Market"],["Ml","Mill"],["Mndr","Meander"],["Mnr","Manor"],
-    ["Mnrs","Manors"],["Mq","Mosque"],["Msn","Mission"],["Mt","Mount"],["Mtn","Mountain"],
-    ["Mtwy","Motorway"],["N","North"],["Nck","Neck"],["NE","Northeast"],["Ngr","Nagar"],
-    ["Nl","Nalla"],["NW","Northwest"],["Off","Office"],["Orch","Orchard"],["Otlk","Outlook"],
-    ["Ovps","Overpass"],["Pchyt","Panchayat"],["Pde","Parade"],["Pf","Platform"],
-    ["Ph","Phase"],["Piaz","Piazza"],["Pk","Peak"],["Pkt","Pocket"],["Pl","Place"],
-    ["Pln","Plain"],["Plns","Plains"],["Plz","Plza","Plaza"],["Pr","Prairie"],
-    ["Prom","Promenade"],["Prt","Port"],["Prts","Ports"],["Psge","Passage"],
-    ["Pt","Pnt","Point"],["Pts","Points"],["Pvt","Private"],["Pway","Pathway"],
-    ["Pwy","Pkwy","Parkway"],["Qdrt","Quadrant"],["Qtrs","Quarters"],["Qys","Quays"],
-    ["R","Riv","River"],["Radl","Radial"],["Rd","Road"],["Rdg","Rdge","Ridge"],
-    ["Rdgs","Ridges"],["Rds","Roads"],["Rly","Railway"],["Rmbl","Ramble"],["Rnch","Ranch"],
-    ["Rpd","Rapid"],["Rpds","Rapids"],["Rst","Rest"],["Rt","Restaurant"],["Rte","Route"],
-    ["Rtt","Retreat"],["Rty","Rotary"],["S","South"],["Sbwy","Subway"],["Sch","School"],
-    ["SE","Southeast"],["Sgt","Sergeant"],["Shl","Shoal"],["Shls","Shoals"],["Shr","Shore"],
-    ["Shrs","Shores"],["Shun","Shunt"],["Skwy","Skyway"],["Smt","Summit"],["Spg","Spring"],
-    ["Spgs","Springs"],["Sq","Square"],["Sqs","Squares"],["Sr","Senior"],
-    ["St","Saint","Street"],["Sta","Stn","Station"],["Std","Stadium"],["Stg","Stage"],
-    ["Strm","Stream"],["Sts","Streets"],["Svwy","Serviceway"],["SW","Southwest"],
-    ["Tce","Ter","Terrace"],["Tfwy","Trafficway"],["Thfr","Thoroughfare"],["Thwy","Thruway"],
-    ["Tlwy","Tollway"],["Tpke","Turnpike"],["Tpl","Temple"],["Trce","Trace"],["Trk","Track"],
-    ["Trl","Trail","Tr"],["Tunl","Tunnel"],["Twn","Town"],["Un","Union"],["Univ","University"],
-    ["Unp","Upas","Underpass"],["Uns","Unions"],["Via","Viad","Viaduct"],["Vis","Vsta","Vista"],
-    ["Vl","Ville"],["Vlg","Vill","Village"],["Vlgs","Villages"],["Vly","Valley"],
-    ["Vlys","Valleys"],["Vw","View"],["Vws","Views"],["W","West"],["Whrf","Wharf"],
-    ["Wkwy","Walkway"],["X","Cr","Cres","Crss","Cross","Crescent"],["Xing","Crossing"],
-    ["Wy","Way"],
-    ]
-
-# Prepare a map from common street name tokens to opaque hashed values.
-token_map = dict()
-
-for token in tokens:
-    normal = ', '.join(sorted(token)).encode('utf8')
-    value = hashlib.sha1(normal).hexdigest()[:5]
-    token_map.update({opt.lower(): value for opt in token})
+import json, math, sys, array
+
+from normalize import tokens, token_map, normalize_street
+
+def intern(value):
+    ''' Intern repeated string values so that many addresses share one copy.
+    '''
+    return sys.intern(value) if isinstance(value, str) else value
+
+# Spherical web mercator radius and circumference in meters, latitude limit
+# in degrees of a square world, and width of a zoom=19 tile in meters.
+earth_radius = 6378137
+circumference = earth_radius * 2 * math.pi
+max_latitude = math.degrees(math.atan(math.sinh(math.pi)))
+tile_width = circumference / 2**19
+
+def mercator(lon, lat):
+    ''' Return spherical web mercator x and y meters for a longitude and latitude.
+
+        >>> [round(v, 1) for v in mercator(-122.271, 37.804)]
+        [-13611145.5, 4551774.5]
+    '''
+    lat = max(-max_latitude, min(max_latitude, lat))
+    x = earth_radius * math.radians(lon)
+    y = earth_radius * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return x, y
+
+def mercator_arrays(lons, lats):
+    ''' Return NumPy arrays of web mercator x and y meters for many points.
+
+        Uses the same closed-form formula as mercator(), one chunk at a time.
+
+        >>> xs, ys = mercator_arrays([-122.271, -112.5], [37.804, 46.0])
+        >>> xs.round(1).tolist(), ys.round(1).tolist()
+        ([-13611145.5, -12523442.7], [4551774.5, 5780349.2])
+    '''
+    import numpy
+
+    lons, lats = numpy.asarray(lons, dtype=numpy.float64), numpy.asarray(lats, dtype=numpy.float64)
+    lats = numpy.clip(lats, -max_latitude, max_latitude)
+    xs = earth_radius * numpy.radians(lons)
+    ys = earth_radius * numpy.log(numpy.tan(math.pi / 4 + numpy.radians(lats) / 2))
+    return xs, ys
+
+def tile_coordinates(x, y, zoom):
+    ''' Return row and column of the tile containing Mercator x and y meters.
+    '''
+    factor = math.pow(2, zoom)
+    row0, col0 = (.5 - y / circumference), (.5 + x / circumference)
+    return int(row0 * factor), int(col0 * factor)
+
+def tile(x, y, zoom):
+    ''' Return the single tile coordinate containing Mercator x and y meters.
+
+        >>> tile(0, 0, 1)
+        '1/1/1'
+    '''
+    row, col = tile_coordinates(x, y, zoom)
+    return '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row, x=col, z=zoom)
+
+def quadtiles(x, y, zoom):
+    ''' Return four possible quadtile coordinates for comparison purposes.
+    
+        Assume x and y are given in Mercator meters.
+
+        >>> quadtiles(0, 0, 1)
+        ('1/1/1', '1/2/1', '1/1/2', '1/2/2')
+    '''
+    row, col = tile_coordinates(x, y, zoom)
+    
+    return (
+        '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 0, x=col + 0, z=zoom),
+        '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 0, x=col + 1, z=zoom),
+        '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 1, x=col + 0, z=zoom),
+        '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 1, x=col + 1, z=zoom),
+        )
 
 class Address:
     ''' A single OA address.
     '''
+    __slots__ = (
+        'source', 'hash', 'lon', 'lat', 'x', 'y', 'number', 'street',
+        'street_normal', 'unit', 'city', 'district', 'region', 'postcode',
+        )
+
     def __init__(self, source, hash, lon, lat, x, y, number, street, unit, city=None, district=None, region=None, postcode=None):
-        street_normal = ''.join([token_map.get(s, s) for s in street.lower().split()])
-        self.source = source
+        self.source = intern(source)
         self.hash = hash
         self.lon = lon
         self.lat = lat
         self.x = x
         self.y = y
 
-        self.number = number
-        self.street = street
-        self.street_normal = street_normal
-        self.unit = unit
-        self.city = city
-        self.district = district
-        self.region = region
-        self.postcode = postcode
+        self.number = intern(number)
+        self.street = intern(street)
+        self.street_normal = normalize_street(street)
+        self.unit = intern(unit)
+        self.city = intern(city)
+        self.district = intern(district)
+        self.region = intern(region)
+        self.postcode = intern(postcode)
     
     def quadtiles(self, zoom):
         ''' Return four possible quadtile coordinates for comparison purposes.
         
             Assume x and y are given in Mercator meters.
         '''
-        factor, circumference = math.pow(2, zoom), (6378137 * 2 * math.pi)
-        row0, col0 = (.5 - self.y / circumference), (.5 + self.x / circumference)
-        row, col = int(row0 * factor), int(col0 * factor)
+        return quadtiles(self.x, self.y, zoom)
+    
+    def tile(self, zoom):
+        ''' Return the single tile coordinate containing this address.
         
-        return (
-            '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 0, x=col + 0, z=zoom),
-            '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 0, x=col + 1, z=zoom),
-            '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 1, x=col + 0, z=zoom),
-            '{z:.0f}/{x:.0f}/{y:.0f}'.format(y=row + 1, x=col + 1, z=zoom),
-            )
+            Assume x and y are given in Mercator meters.
+        '''
+        return tile(self.x, self.y, zoom)
     
     def matches(self, other):
         ''' Return true if this address matches another.
@@ -128,18 +127,199 @@ class Address:
             and self.unit == other.unit
             )
     
-    def tojson(self):
-        ''' Output a JSON array that can be passed directly to constructor.
+    def tolist(self):
+        ''' Output a list of arguments that can be passed directly to constructor.
         '''
-        return json.dumps([
+        return [
             self.source, self.hash, self.lon, self.lat, self.x, self.y,
             self.number, self.street, self.unit, self.city, self.district,
             self.region, self.postcode
-            ])
+            ]
+    
+    def tojson(self):
+        ''' Output a JSON array that can be passed directly to constructor.
+        '''
+        return json.dumps(self.tolist())
     
     def __str__(self):
         return self.number + ' ' + self.street + ', ' + self.unit
 
+class StringColumn:
+    ''' Dictionary-encoded column of repeated string values.
+
+        >>> column = StringColumn()
+        >>> [column.append(v) for v in ('Main St', 'Oak Dr', 'Main St')]
+        [0, 1, 0]
+        >>> column[2], column.values
+        ('Main St', ['Main St', 'Oak Dr'])
+    '''
+    def __init__(self):
+        self.values = list()
+        self.codes = array.array('L')
+        self.index = dict()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+    def encode(self, value):
+        ''' Return the dictionary code for a value, adding it if needed.
+        '''
+        try:
+            return self.index[value]
+        except KeyError:
+            code = self.index[value] = len(self.values)
+            self.values.append(intern(value))
+            return code
+
+    def append(self, value):
+        ''' Append a value to the column and return its dictionary code.
+        '''
+        code = self.encode(value)
+        self.codes.append(code)
+        return code
+
+class AddressBatch:
+    ''' Columnar store for many OA addresses, unique on address hash.
+
+        Coordinates live in flat arrays of doubles and repeated strings in
+        dictionary-encoded columns, so rows can be read by index without
+        materializing an Address object for each one.
+
+        >>> batch = AddressBatch()
+        >>> batch.append('src', 'a', -122.2, 37.8, -13600000, 4550000, '1', 'Main St', '')
+        0
+        >>> batch.append('src', 'b', -122.2, 37.8, -13600010, 4550000, '1', 'MAIN STREET', '')
+        1
+        >>> batch.append('src', 'a', -122.2, 37.8, -13600000, 4550000, '1', 'Main St', '')
+        0
+        >>> len(batch), batch.matches(0, 1), batch.address(1).street
+        (2, True, 'MAIN STREET')
+
+        Rows with bad values are not added at all:
+
+        >>> batch.append('src', 'c', None, 37.8, -13600000, 4550000, '1', 'Main St', '')
+        Traceback (most recent call last):
+        TypeError: must be real number, not NoneType
+        >>> batch.append('src', 'd', -122.2, 37.8, -13600000, 4550000, '1', None, '')
+        Traceback (most recent call last):
+        AttributeError: 'NoneType' object has no attribute 'lower'
+        >>> batch.append('src', 'e', -122.2, 37.8, -13600000, 4550000, '2', 'Oak St', '')
+        2
+        >>> len(batch), len(batch.lons), batch.street_normal(2) == normalize_street('Oak Street')
+        (3, 3, True)
+    '''
+    string_fields = ('source', 'number', 'street', 'unit', 'city',
+                     'district', 'region', 'postcode')
+
+    def __init__(self):
+        self.hashes = list()
+        self.hash_index = dict()
+        self.lons, self.lats = array.array('d'), array.array('d')
+        self.xs, self.ys = array.array('d'), array.array('d')
+        self.columns = {field: StringColumn() for field in self.string_fields}
+
+        # Street names are normalized once per distinct value.
+        self.street_normals = list()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def append(self, source, hash, lon, lat, x, y, number, street, unit, city=None, district=None, region=None, postcode=None):
+        ''' Add an address row and return its index.
+
+            Accepts the same arguments as Address. A row whose hash is
+            already present is not added again, and its index is returned.
+        '''
+        if hash in self.hash_index:
+            return self.hash_index[hash]
+
+        # Check and convert every value before any column changes, so that
+        # a bad row raises an error without leaving the batch out of step.
+        coordinates = array.array('d', (lon, lat, x, y))
+        streets = self.columns['street']
+        if street not in streets.index:
+            normalize_street(street)
+
+        values = (source, number, street, unit, city, district, region, postcode)
+        codes = [self.columns[field].encode(value) for (field, value) in zip(self.string_fields, values)]
+
+        row = self.hash_index[hash] = len(self.hashes)
+        self.hashes.append(hash)
+        for (column, value) in zip((self.lons, self.lats, self.xs, self.ys), coordinates):
+            column.append(value)
+
+        for (field, code) in zip(self.string_fields, codes):
+            self.columns[field].codes.append(code)
+
+        while len(self.street_normals) < len(streets.values):
+            self.street_normals.append(normalize_street(streets.values[len(self.street_normals)]))
+
+        return row
+
+    def subset(self, rows):
+        ''' Return a new batch with just the given rows, in the given order.
+
+            Row i of the new batch is rows[i] of this one, which keeps the
+            batch small enough to send to another process.
+        '''
+        subset = AddressBatch()
+
+        for row in rows:
+            subset.append(
+                self.get('source', row), self.hashes[row],
+                self.lons[row], self.lats[row], self.xs[row], self.ys[row],
+                self.get('number', row), self.get('street', row), self.get('unit', row),
+                self.get('city', row), self.get('district', row),
+                self.get('region', row), self.get('postcode', row),
+                )
+
+        return subset
+
+    def get(self, field, row):
+        ''' Return a single string field value for a row.
+        '''
+        return self.columns[field][row]
+
+    def street_normal(self, row):
+        ''' Return the token-normalized street name for a row.
+        '''
+        return self.street_normals[self.columns['street'].codes[row]]
+
+    def matches(self, row1, row2):
+        ''' Return true if two rows match, with the same rules as Address.matches().
+        '''
+        number, unit = self.columns['number'].codes, self.columns['unit'].codes
+
+        return bool(
+            number[row1] == number[row2]
+            and self.street_normal(row1) == self.street_normal(row2)
+            and unit[row1] == unit[row2]
+            )
+
+    def address(self, row):
+        ''' Materialize a single row as an Address.
+        '''
+        return Address(
+            self.get('source', row), self.hashes[row],
+            self.lons[row], self.lats[row], self.xs[row], self.ys[row],
+            self.get('number', row), self.get('street', row), self.get('unit', row),
+            self.get('city', row), self.get('district', row),
+            self.get('region', row), self.get('postcode', row),
+            )
+
+    def coordinates(self):
+        ''' Return lon, lat, x, y columns as NumPy arrays sharing batch memory.
+
+            The batch cannot grow while the returned arrays are still referenced.
+        '''
+        import numpy
+
+        return tuple(numpy.frombuffer(column, dtype=numpy.float64)
+                     for column in (self.lons, self.lats, self.xs, self.ys))
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
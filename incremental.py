@@ -0,0 +1,257 @@
+''' Persistent state for re-deduping only the parts of an area that changed.
+
+Addresses in an area are divided into coarse zoom=15 tiles, about 1.2km wide,
+much wider than a match radius. Each tile has a content fingerprint, a SHA-1
+hash of its address rows sorted by hash. A SQLite state file keeps these
+fingerprints along with every output cluster from the previous run, anchored to
+the tile of the cluster's first row, and the anchor of every member address.
+
+On a new run, tiles whose fingerprints differ are dirty. Clusters are matched
+again only from addresses in dirty tiles and their neighbors, and output for
+clusters anchored in clean tiles is reused as-is. Dirty tiles grow to include
+any anchor whose old or new clusters share a member with a dirty tile, so that
+results are the same as a full run.
+
+    >>> import tempfile, os
+    >>> from expand import AddressBatch, mercator
+    >>> from matchers import ExactMatcher
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'state.db')
+    >>> def load(rows):
+    ...     batch = AddressBatch()
+    ...     for (hash, lon, number) in rows:
+    ...         batch.append('src', hash, lon, 37., *mercator(lon, 37.), number, 'Main St', '')
+    ...     return batch
+    >>> summarize = lambda batch, row_lists: [{'NUMBER': batch.get('number', rows[0]),
+    ...                                         'OA:COUNT': len(rows)} for rows in row_lists]
+    >>> addresses = [('a', -122., '1'), ('b', -122.0001, '1'), ('c', -121.9, '2')]
+    >>> with StateStore(filename, ExactMatcher(), 76.4) as store:
+    ...     store.update(load(addresses), summarize)
+    ...     list(store.iterate_outputs())
+    (2, 2)
+    [{'NUMBER': '1', 'OA:COUNT': 2}, {'NUMBER': '2', 'OA:COUNT': 1}]
+    >>> with StateStore(filename, ExactMatcher(), 76.4) as store:
+    ...     store.update(load(addresses + [('d', -121.9001, '2')]), summarize)
+    ...     list(store.iterate_outputs())
+    (1, 2)
+    [{'NUMBER': '1', 'OA:COUNT': 2}, {'NUMBER': '2', 'OA:COUNT': 2}]
+'''
+import collections, hashlib, json, sqlite3
+
+import blocking, clusters
+from expand import circumference, tile_coordinates
+
+# Zoom level of fingerprinted tiles; tiles must be wider than the match radius.
+DEFAULT_ZOOM = 15
+
+# Widest match radius in Mercator meters, one tile width at DEFAULT_ZOOM.
+MAX_RADIUS = circumference / 2**DEFAULT_ZOOM
+
+# Version of the cluster outputs saved in state files, to be increased
+# whenever summary fields change so that older saved outputs are not reused.
+SCHEMA = 2
+
+def tile_rows(batch, zoom):
+    ''' Return lists of batch rows keyed on (row, col) tile coordinates.
+    '''
+    tiles = collections.defaultdict(list)
+
+    for (row, x, y) in zip(range(len(batch)), batch.xs, batch.ys):
+        tiles[tile_coordinates(x, y, zoom)].append(row)
+
+    return tiles
+
+def fingerprint(batch, rows):
+    ''' Return a hex digest of address rows independent of their order.
+    '''
+    digest, columns = hashlib.sha1(), [batch.columns[field] for field in batch.string_fields]
+
+    for row in sorted(rows, key=batch.hashes.__getitem__):
+        values = [batch.hashes[row], batch.lons[row], batch.lats[row], batch.xs[row], batch.ys[row]]
+        values.extend(column[row] for column in columns)
+        digest.update(repr(values).encode('utf8'))
+
+    return digest.hexdigest()
+
+def neighbors(tiles):
+    ''' Return a set of tiles with all eight neighbors of each tile added.
+
+        >>> sorted(neighbors({(0, 0)}))[:4]
+        [(-1, -1), (-1, 0), (-1, 1), (0, -1)]
+    '''
+    return {(row + drow, col + dcol) for (row, col) in tiles
+            for drow in (-1, 0, 1) for dcol in (-1, 0, 1)}
+
+def group_rows(batch, rows, matcher):
+    ''' Return lists of batch rows grouped by blocking key, in first-seen order.
+    '''
+    blocks = collections.OrderedDict()
+
+    for row in rows:
+        blocks.setdefault(matcher.block_key(batch, row), list()).append(row)
+
+    return list(blocks.values())
+
+def cluster_rows(batch, rows, matcher, radius, counts=None):
+    ''' Return lists of clustered batch rows from a sorted list of rows.
+    '''
+    index = {row: i for (i, row) in enumerate(rows)}
+    row_clusters = clusters.Clusters()
+    row_clusters.extend(len(rows))
+
+    for (row1, row2) in blocking.matched_pairs(batch, group_rows(batch, rows, matcher), radius, matcher, counts):
+        row_clusters.union(index[row1], index[row2])
+
+    return [[rows[i] for i in cluster] for cluster in row_clusters.iterate()]
+
+class StateStore:
+    ''' SQLite file of tile fingerprints and cluster output from a previous run.
+
+        State is discarded if the matcher, radius, zoom, or output schema have changed.
+    '''
+    def __init__(self, filename, matcher, radius, zoom=DEFAULT_ZOOM):
+        self.matcher, self.radius, self.zoom = matcher, radius, zoom
+        self.db = sqlite3.connect(filename)
+        self.db.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS settings (settings TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (row INTEGER, col INTEGER, fingerprint TEXT,
+                                              PRIMARY KEY (row, col));
+            CREATE TABLE IF NOT EXISTS members (hash TEXT PRIMARY KEY, row INTEGER, col INTEGER,
+                                                anchor_row INTEGER, anchor_col INTEGER);
+            CREATE INDEX IF NOT EXISTS members_tile ON members (row, col);
+            CREATE INDEX IF NOT EXISTS members_anchor ON members (anchor_row, anchor_col);
+            CREATE TABLE IF NOT EXISTS outputs (anchor_row INTEGER, anchor_col INTEGER,
+                                                position INTEGER, output TEXT);
+            CREATE INDEX IF NOT EXISTS outputs_anchor ON outputs (anchor_row, anchor_col);
+            ''')
+
+        settings = json.dumps(dict(matcher=matcher.name, radius=radius, zoom=zoom, schema=SCHEMA))
+        if self.db.execute('SELECT settings FROM settings').fetchall() != [(settings, )]:
+            with self.db:
+                for table in ('settings', 'tiles', 'members', 'outputs'):
+                    self.db.execute('DELETE FROM {}'.format(table))
+                self.db.execute('INSERT INTO settings VALUES (?)', (settings, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _select_tiles(self, query, tiles):
+        ''' Return a set of (row, col) tiles from a query joined to a set of tiles.
+        '''
+        self.db.execute('CREATE TEMPORARY TABLE IF NOT EXISTS selected (row INTEGER, col INTEGER)')
+        self.db.execute('DELETE FROM selected')
+        self.db.executemany('INSERT INTO selected VALUES (?, ?)', tiles)
+        return set(self.db.execute(query).fetchall())
+
+    def previous_anchors(self, batch, rows):
+        ''' Return a dictionary of previous anchor tiles for batch rows, if any.
+        '''
+        anchors = dict()
+
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            hashes = {batch.hashes[row]: row for row in chunk}
+            query = 'SELECT hash, anchor_row, anchor_col FROM members WHERE hash IN ({})'
+            for (hash, anchor_row, anchor_col) in self.db.execute(
+                    query.format(','.join('?' * len(hashes))), list(hashes)):
+                anchors[hashes[hash]] = (anchor_row, anchor_col)
+
+        return anchors
+
+    def update(self, batch, summarize, counts=None):
+        ''' Re-cluster changed tiles of a batch and store their output.
+
+            Accepts a function that summarizes a batch and lists of clustered
+            rows as a list of JSON-serializable output dictionaries, and an optional
+            Counter of pairs compared and matched. Returns counts of dirty
+            tiles and of all tiles.
+        '''
+        tiles = tile_rows(batch, self.zoom)
+        fingerprints = {tile: fingerprint(batch, rows) for (tile, rows) in tiles.items()}
+        previous = {(row, col): value for (row, col, value)
+                    in self.db.execute('SELECT row, col, fingerprint FROM tiles')}
+
+        dirty = {tile for tile in set(fingerprints) | set(previous)
+                 if fingerprints.get(tile) != previous.get(tile)}
+
+        # Old clusters with members in changed tiles must be replaced too.
+        dirty |= self._select_tiles('''SELECT DISTINCT anchor_row, anchor_col
+            FROM members JOIN selected USING (row, col)''', dirty)
+
+        reach = set()
+
+        while True:
+            # Match again from dirty tiles, their neighbors, and the neighbors
+            # of any tile with a member of an old cluster anchored in a dirty tile.
+            members = self._select_tiles('''SELECT DISTINCT members.row, members.col FROM members
+                JOIN selected ON anchor_row = selected.row AND anchor_col = selected.col''', dirty)
+            halo = neighbors(dirty | members | reach)
+            rows = sorted(row for tile in halo for row in tiles.get(tile, ()))
+            row_tiles = {row: tile for tile in halo for row in tiles.get(tile, ())}
+            anchors = self.previous_anchors(batch, rows)
+            changed, new_clusters = set(), list()
+
+            for cluster in cluster_rows(batch, rows, self.matcher, self.radius, counts):
+                anchor = row_tiles[cluster[0]]
+                old_anchors = {anchors.get(row) for row in cluster}
+
+                if anchor in dirty:
+                    new_clusters.append((anchor, cluster))
+
+                    # Long chains of matches may need a wider halo to be complete.
+                    cluster_tiles = {row_tiles[row] for row in cluster}
+                    if not neighbors(cluster_tiles) <= halo:
+                        reach |= cluster_tiles
+
+                if anchor in dirty or old_anchors & dirty or None in old_anchors:
+                    changed |= ({anchor} | old_anchors) - {None}
+
+            if changed <= dirty and neighbors(reach) <= halo:
+                break
+
+            dirty |= changed
+
+        with self.db:
+            self._select_tiles('SELECT row, col FROM selected', dirty)
+            self.db.execute('''DELETE FROM tiles WHERE (row, col) IN (SELECT row, col FROM selected)''')
+            self.db.execute('''DELETE FROM members WHERE (anchor_row, anchor_col)
+                IN (SELECT row, col FROM selected)''')
+            self.db.execute('''DELETE FROM outputs WHERE (anchor_row, anchor_col)
+                IN (SELECT row, col FROM selected)''')
+
+            self.db.executemany('INSERT INTO tiles VALUES (?, ?, ?)',
+                                ((row, col, fingerprints[(row, col)]) for (row, col)
+                                 in dirty if (row, col) in fingerprints))
+
+            positions = collections.Counter()
+            summaries = summarize(batch, [cluster for (_, cluster) in new_clusters]) if new_clusters else []
+
+            for (((anchor_row, anchor_col), cluster), summary) in zip(new_clusters, summaries):
+                self.db.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)',
+                                    ((batch.hashes[row], *row_tiles[row], anchor_row, anchor_col)
+                                     for row in cluster))
+                self.db.execute('INSERT INTO outputs VALUES (?, ?, ?, ?)',
+                                (anchor_row, anchor_col, positions[(anchor_row, anchor_col)],
+                                 json.dumps(summary)))
+                positions[(anchor_row, anchor_col)] += 1
+
+        return len(dirty & set(fingerprints)), len(fingerprints)
+
+    def iterate_outputs(self):
+        ''' Generate stored output dictionaries for all clusters, ordered by tile.
+        '''
+        query = 'SELECT output FROM outputs ORDER BY anchor_row, anchor_col, position'
+
+        for (output, ) in self.db.execute(query):
+            yield json.loads(output)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
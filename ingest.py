@@ -0,0 +1,214 @@
+''' Read OpenAddresses tile downloads into keyed address records.
+
+Each 1x1 degree tile is a zip file with an addresses.csv member. Rows are read
+in chunks of columns, with blank addresses and unreadable points removed in
+bulk, then assigned to areas with an AreaIndex, projected to web mercator, and
+written out as area-keyed records. Tiles are handled one per call, so that
+separate processes can read separate tiles at once.
+
+Chunks are read with the streaming CSV reader from pyarrow when it is
+installed, and otherwise with a plain tuple reader that only picks out the
+needed columns. GDAL is imported only where areas are used, so that reading
+tiles can be tested and benchmarked without it.
+
+    >>> lons, lats, columns = filter_chunk([('s', 's', 's'), ('a', 'b', 'c'), ('-122.1', '', '-122.2'),
+    ...                                     ('37.1', '37.2', '37.3'), ('1', '2', ''), ('Main St', 'Oak St', ''), ('', '', '')])
+    >>> lons.tolist(), columns[1]
+    ([-122.1], ['a'])
+'''
+import collections, cProfile, csv, hashlib, io, itertools, operator, os, tempfile, zipfile
+
+from expand import Address, mercator_arrays
+import records
+
+# Columns read from each tile, in the order of Address arguments.
+COLUMNS = ('OA:Source', 'HASH', 'LON', 'LAT', 'NUMBER', 'STREET', 'UNIT')
+
+def iterate_chunks(rows, size=10000):
+    ''' Generate lists of up to size rows at a time.
+    '''
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
+
+def parse_floats(values):
+    ''' Return a NumPy array of floats from strings, with NaN for unreadable values.
+
+        >>> parse_floats(['1.5', '', 'x', ' -2 ']).tolist()
+        [1.5, nan, nan, -2.0]
+    '''
+    import numpy
+
+    try:
+        return numpy.asarray(values, dtype=numpy.float64)
+    except ValueError:
+        floats = numpy.empty(len(values), dtype=numpy.float64)
+        for (i, value) in enumerate(values):
+            try:
+                floats[i] = float(value)
+            except ValueError:
+                floats[i] = numpy.nan
+        return floats
+
+def filter_chunk(columns):
+    ''' Return arrays of lons and lats and lists of other columns for readable rows.
+
+        Accepts a chunk of column values in COLUMNS order. Rows with no number
+        and no street, or without a finite point, are removed all at once.
+        Returns lons, lats, and lists of sources, hashes, numbers, streets,
+        and units.
+    '''
+    import numpy
+
+    sources, hashes, lons, lats, numbers, streets, units = columns
+    lons, lats = parse_floats(lons), parse_floats(lats)
+    numbers, streets = numpy.array(numbers, dtype=object), numpy.array(streets, dtype=object)
+    keep = numpy.isfinite(lons) & numpy.isfinite(lats) & ((numbers != '') | (streets != ''))
+    strings = (sources, hashes, numbers, streets, units)
+
+    if keep.all():
+        return lons, lats, [list(column) for column in strings]
+
+    return lons[keep], lats[keep], [numpy.array(column, dtype=object)[keep].tolist() for column in strings]
+
+def iterate_tuple_columns(addr_buff, size=10000):
+    ''' Generate row counts and chunks of columns from a binary CSV file.
+
+        Rows are read as plain tuples and only the needed columns are kept,
+        by index, without a dictionary for each row.
+    '''
+    rows = csv.reader(io.TextIOWrapper(addr_buff))
+    header = next(rows)
+    indexes = [header.index(column) for column in COLUMNS]
+    getter, width = operator.itemgetter(*indexes), max(indexes) + 1
+
+    for chunk in iterate_chunks(rows, size):
+        picked = [getter(row) if len(row) >= width else getter(row + [''] * width) for row in chunk]
+        yield len(chunk), list(zip(*picked))
+
+def iterate_arrow_columns(addr_buff, block_size=2**20):
+    ''' Generate row counts and chunks of columns from a binary CSV file with pyarrow.
+
+        Coordinates are converted to floats in Arrow when they all can be.
+    '''
+    import pyarrow, pyarrow.csv
+
+    string_types = {column: pyarrow.string() for column in COLUMNS}
+    batches = pyarrow.csv.open_csv(addr_buff,
+        read_options=pyarrow.csv.ReadOptions(block_size=block_size, use_threads=False),
+        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow.csv.ConvertOptions(include_columns=list(COLUMNS),
+                                                   column_types=string_types, strings_can_be_null=False))
+
+    for batch in batches:
+        columns = list()
+        for column in COLUMNS:
+            values = batch.column(column)
+            if column in ('LON', 'LAT'):
+                try:
+                    columns.append(values.cast(pyarrow.float64()).to_numpy())
+                    continue
+                except pyarrow.ArrowInvalid:
+                    pass
+            columns.append(values.to_pylist())
+        yield batch.num_rows, columns
+
+def iterate_columns(addr_buff):
+    ''' Generate row counts and chunks of columns from a binary CSV file, with pyarrow if available.
+    '''
+    try:
+        import pyarrow.csv
+    except ImportError:
+        return iterate_tuple_columns(addr_buff)
+    else:
+        return iterate_arrow_columns(addr_buff)
+
+def iterate_addresses(addr_path, areas, counts=None):
+    ''' Generate (geoid, Address) pairs for rows of a zipped tile within areas.
+
+        Accepts a dictionary of OGR area geometries keyed on geoid, and an
+        optional Counter of rows read, kept, and skipped.
+    '''
+    from areas import AreaIndex
+
+    counts = collections.Counter() if counts is None else counts
+    area_index = AreaIndex(areas)
+
+    # Stream CSV rows straight from the zip file.
+    with zipfile.ZipFile(addr_path) as addr_zip, addr_zip.open('addresses.csv') as addr_buff:
+        for (count, columns) in iterate_columns(addr_buff):
+            counts['rows in'] += count
+
+            # Skip blank addresses and unreadable points
+            lons, lats, (sources, hashes, numbers, streets, units) = filter_chunk(columns)
+            counts['rows skipped'] += count - len(lons)
+
+            xs, ys = mercator_arrays(lons, lats)
+            xs, ys = xs.round(1).tolist(), ys.round(1).tolist()
+            area_geoids = area_index.assign(lons, lats)
+
+            for (source, hash, lon, lat, x, y, number, street, unit, geoids) in zip(
+                    sources, hashes, lons.tolist(), lats.tolist(), xs, ys, numbers, streets, units, area_geoids):
+                if not geoids:
+                    # Skip addresses outside the local areas
+                    counts['rows outside areas'] += 1
+                    continue
+
+                address = Address(source, hash, lon, lat, x, y, number, street, unit)
+
+                for area_geoid in geoids:
+                    yield area_geoid, address
+
+def tile_fingerprint(addr_path, areas_wkb, format):
+    ''' Return a hex digest of a zipped tile, its areas, and a record format.
+
+        Records written for a tile are the same as long as its fingerprint is.
+    '''
+    digest = hashlib.sha1(format.encode('utf8'))
+
+    for geoid in sorted(areas_wkb):
+        digest.update(geoid.encode('utf8'))
+        digest.update(areas_wkb[geoid])
+
+    with open(addr_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024**2), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def process_tile(addr_path, areas_wkb, format, dirname, profile=False):
+    ''' Write area-keyed records for a zipped tile to a new temporary file.
+
+        Accepts a dictionary of area geometries as WKB keyed on geoid, since
+        OGR geometries cannot be sent between processes. Returns the name of
+        the temporary file, a Counter of rows read and records written, and
+        with profile, the name of a file of cProfile statistics for the tile.
+    '''
+    from osgeo import ogr
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+
+    areas = {geoid: ogr.CreateGeometryFromWkb(wkb) for (geoid, wkb) in areas_wkb.items()}
+    handle, filename = tempfile.mkstemp(dir=dirname, prefix='tile-', suffix=records.extension(format))
+    counts = collections.Counter()
+
+    with os.fdopen(handle, 'wb') as file:
+        writer = records.writer(file, format)
+        for (area_geoid, address) in iterate_addresses(addr_path, areas, counts):
+            writer.write(area_geoid, address.tolist())
+            counts['rows out'] += 1
+
+    if not profiler:
+        return filename, counts, None
+
+    profiler.disable()
+    profiler.dump_stats(filename + '.prof')
+    return filename, counts, filename + '.prof'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,188 @@
+''' Pluggable rules for deciding whether two nearby addresses match.
+
+A matcher decides which addresses can be compared at all, through a blocking
+key for AddressBatch rows and a partition key for raw Address arguments, and
+then whether two rows in a block match.
+
+The exact matcher compares number, token-normalized street name, and unit for
+equality, exactly like Address.matches(). The fuzzy matcher blocks on parsed
+house number and unit, so that "123A" and "123 A" or "Apt 1" and "#1" meet,
+then tries increasingly expensive tiers: exact equality, then equality of
+normalized street names, then a bounded edit distance between the name words
+of street names guarded by cheap length and prefix checks. Numbered words and
+pairs of standard words like "St" and "Ave" must always be equal, since
+"Highway 101" and "Highway 102" or "Oak St" and "Oak Ave" are different streets.
+'''
+import functools, re
+
+from normalize import normalize_street, lookup_token, token_map
+
+class ExactMatcher:
+    ''' Match on equal number, token-normalized street name, and unit.
+    '''
+    name = 'exact'
+
+    def block_key(self, batch, row):
+        ''' Return a blocking key for an AddressBatch row.
+        '''
+        number, unit = batch.columns['number'].codes, batch.columns['unit'].codes
+        return (number[row], batch.street_normal(row), unit[row])
+
+    def partition_key(self, addr_args):
+        ''' Return a string key for Address arguments equal within any block.
+        '''
+        number, street, unit = addr_args[6:9]
+        return '\0'.join((number, normalize_street(street), unit))
+
+    def matches(self, batch, row1, row2):
+        ''' Return true if two AddressBatch rows match.
+        '''
+        return batch.matches(row1, row2)
+
+@functools.lru_cache(maxsize=2**16)
+def normalize_number(number):
+    ''' Return a house number without case, spaces, or punctuation.
+
+        >>> normalize_number('123 a') == normalize_number('123-A') == '123A'
+        True
+    '''
+    return re.sub(r'[\s\-.,#]+', '', number or '').upper()
+
+@functools.lru_cache(maxsize=2**16)
+def normalize_unit(unit):
+    ''' Return a unit without designators like "Apt", "Unit", "Ste", or "#".
+
+        >>> normalize_unit('Apt. 4b') == normalize_unit('#4B') == normalize_unit('Unit 4-B') == '4B'
+        True
+    '''
+    unit = re.sub(r'^\s*(apartment|apt|unit|suite|ste|number|no|#)\b\.?', '', (unit or '').lower())
+    return re.sub(r'[\s\-.,#]+', '', unit).upper()
+
+@functools.lru_cache(maxsize=2**16)
+def street_words(street):
+    ''' Return a tuple of lowercase words in a street name.
+    '''
+    return tuple(street.lower().split())
+
+def similar_words(word1, word2, min_length, limit):
+    ''' Return edit distance between two street words that might be misspellings, or limit + 1.
+
+        Words with equal token-normalized values are equal. Words with
+        digits, two different standard words, and short words or words with
+        different first letters are never similar.
+
+        >>> similar_words('street', 'st', 4, 1), similar_words('main', 'mian', 4, 1), similar_words('nroth', 'north', 4, 1)
+        (0, 1, 1)
+        >>> similar_words('41st', '42nd', 4, 1), similar_words('101', '102', 4, 1), similar_words('elm', 'elk', 4, 1), similar_words('ave', 'st', 4, 1)
+        (2, 2, 2, 2)
+    '''
+    if lookup_token(word1, word1) == lookup_token(word2, word2):
+        return 0
+
+    if not (word1.isalpha() and word2.isalpha()) or (word1 in token_map and word2 in token_map):
+        return limit + 1
+
+    if min(len(word1), len(word2)) < min_length or word1[0] != word2[0]:
+        return limit + 1
+
+    return edit_distance(word1, word2, limit)
+
+def edit_distance(s1, s2, limit):
+    ''' Return edit distance between two strings, or limit + 1 if it is greater.
+
+        Counts insertions, deletions, substitutions, and adjacent transpositions,
+        and gives up on a row of the table as soon as it exceeds the limit.
+
+        >>> edit_distance('main', 'mian', 1), edit_distance('main', 'maine', 1), edit_distance('main', 'oak', 1)
+        (1, 1, 2)
+    '''
+    if abs(len(s1) - len(s2)) > limit:
+        return limit + 1
+
+    previous2, previous = None, list(range(len(s2) + 1))
+
+    for (i, c1) in enumerate(s1, 1):
+        current = [i] + [0] * len(s2)
+        for (j, c2) in enumerate(s2, 1):
+            cost = 0 if c1 == c2 else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and j > 1 and c1 == s2[j - 2] and s1[i - 2] == c2:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+
+    return min(previous[-1], limit + 1)
+
+class FuzzyMatcher(ExactMatcher):
+    ''' Match on parsed number and unit, and similar street names.
+
+        Street names with the same number of words may differ by up to
+        max_distance edits in total, only in words without digits of at least
+        min_length characters that share a first character.
+
+        >>> from expand import AddressBatch
+        >>> batch = AddressBatch()
+        >>> rows = [batch.append('src', h, 0, 0, 0, 0, n, s, u) for (h, n, s, u) in (
+        ...     ('a', '123A', 'Main Street', ''), ('b', '123 A', 'MIAN ST', ''),
+        ...     ('c', '123', 'Main St', 'Apt 1'), ('d', '123', 'Main St', '#1'),
+        ...     ('e', '123', 'Oak St', ''), ('f', '123', 'Elm St', ''), ('g', '123', 'Elk St', ''),
+        ...     ('h', '9', 'County Road 12', ''), ('i', '9', 'County Road 13', ''),
+        ...     ('j', '9', 'Highway 101', ''), ('k', '9', 'Highway 102', ''),
+        ...     ('l', '9', 'W 41 St', ''), ('m', '9', 'W 42 St', ''),
+        ...     ('n', '9', 'W 41st St', ''), ('o', '9', 'W 42nd St', ''),
+        ...     ('p', '9', 'Washington Ave', ''), ('q', '9', 'WASHINGOTN AVENUE', ''))]
+        >>> matcher = FuzzyMatcher()
+        >>> matcher.matches(batch, 0, 1), matcher.matches(batch, 2, 3), matcher.matches(batch, 15, 16)
+        (True, True, True)
+        >>> [matcher.matches(batch, row, row + 1) for row in (4, 5, 7, 9, 11, 13)]
+        [False, False, False, False, False, False]
+    '''
+    name = 'fuzzy'
+
+    def __init__(self, max_distance=1, min_length=4):
+        self.max_distance = max_distance
+        self.min_length = min_length
+
+    def block_key(self, batch, row):
+        return (normalize_number(batch.get('number', row)), normalize_unit(batch.get('unit', row)))
+
+    def partition_key(self, addr_args):
+        number, _, unit = addr_args[6:9]
+        return '\0'.join((normalize_number(number), normalize_unit(unit)))
+
+    def matches(self, batch, row1, row2):
+        # Tier 1: exact number, street, and unit.
+        if batch.matches(row1, row2):
+            return True
+
+        # Tier 2: parsed number and unit, with identical normalized streets.
+        if self.block_key(batch, row1) != self.block_key(batch, row2):
+            return False
+
+        street1, street2 = batch.street_normal(row1), batch.street_normal(row2)
+
+        if street1 == street2:
+            return True
+
+        # Tier 3: bounded edit distance between differing name words, after
+        # cheap word count, length, and prefix checks.
+        words1, words2 = street_words(batch.get('street', row1)), street_words(batch.get('street', row2))
+
+        if len(words1) != len(words2):
+            return False
+
+        distance = 0
+
+        for (word1, word2) in zip(words1, words2):
+            distance += similar_words(word1, word2, self.min_length, self.max_distance - distance)
+            if distance > self.max_distance:
+                return False
+
+        return True
+
+MATCHERS = {matcher.name: matcher for matcher in (ExactMatcher, FuzzyMatcher)}
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
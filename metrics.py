@@ -0,0 +1,161 @@
+''' Stage timings, counters, and reports shared by the pipeline scripts.
+
+Each script creates one Metrics object, wraps its main steps in stages, and
+counts rows, pairs, and matches as it goes. Stages record wall clock and CPU
+time of the thread that runs them, so downloads in threads can be timed too.
+A report can be written as JSON at the end of a run:
+
+    {
+      "script": "expand-reduce.py",
+      "argv": [...],
+      "wall": 12.3,
+      "stages": {"match": {"calls": 1, "wall": 9.8, "cpu": 9.7}, ...},
+      "counters": {"rows in": 280032, "pairs compared": 161944, ...},
+      "histograms": {"cluster size": {"1": 199990, "2": 3}},
+      "peak_rss_mb": 164.8,
+      "children": {"cpu": 0.0, "peak_rss_mb": 0.0}
+    }
+
+With a profile file name, stages marked as hot loops are also run under
+cProfile, and the combined statistics are saved for pstats or snakeviz.
+Worker processes can profile their own hot loops and add the statistics to
+the same file with add_profile().
+
+    >>> metrics = Metrics('example')
+    >>> with metrics.stage('count'):
+    ...     metrics.count('rows in', 3)
+    ...     for size in (1, 1, 2):
+    ...         metrics.observe('cluster size', size)
+    >>> report = metrics.report()
+    >>> report['stages']['count']['calls'], report['counters'], report['histograms']
+    (1, {'rows in': 3}, {'cluster size': {'1': 2, '2': 1}})
+'''
+import collections, contextlib, cProfile, datetime, json, os, pstats, resource, sys, threading, time
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    ''' Return peak resident set size in megabytes for this process or its children.
+    '''
+    maxrss = resource.getrusage(who).ru_maxrss
+
+    # Linux reports kilobytes, and macOS reports bytes.
+    return round(maxrss / (1024**2 if sys.platform == 'darwin' else 1024), 1)
+
+class Metrics:
+    ''' Collect per-stage times, counters, and histograms for one script run.
+
+        Safe to update from several threads.
+    '''
+    def __init__(self, script, profile_filename=None):
+        self.script = script
+        self.start = time.perf_counter()
+        self.started = datetime.datetime.now()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.profile_filename = profile_filename
+        self.profiler = cProfile.Profile() if profile_filename else None
+        self.profile_stats = pstats.Stats() if profile_filename else None
+
+    def elapsed(self):
+        ''' Return time since the run started as a timedelta, for log messages.
+        '''
+        return datetime.datetime.now() - self.started
+
+    @contextlib.contextmanager
+    def stage(self, name, hot=False):
+        ''' Time a stage of work, optionally profiling it as a hot loop.
+
+            Hot stages are only profiled in the main thread, and should not
+            be nested inside one another.
+        '''
+        profile = hot and self.profiler and threading.current_thread() is threading.main_thread()
+        wall, cpu = time.perf_counter(), time.thread_time()
+
+        if profile:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                self.profiler.disable()
+
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+
+            with self.lock:
+                stage = self.stages.setdefault(name, dict(calls=0, wall=0., cpu=0.))
+                stage['calls'] += 1
+                stage['wall'] += wall
+                stage['cpu'] += cpu
+
+    def count(self, name, value=1):
+        ''' Add to a named counter, like rows in or pairs compared.
+        '''
+        with self.lock:
+            self.counters[name] += value
+
+    def update(self, counts):
+        ''' Add a dictionary of counts, for example from another process.
+        '''
+        with self.lock:
+            self.counters.update(counts)
+
+    def add_profile(self, filename):
+        ''' Add cProfile statistics saved to a file by another process, and remove the file.
+        '''
+        with self.lock:
+            self.profile_stats.add(filename)
+        os.remove(filename)
+
+    def observe(self, name, value):
+        ''' Add one value to a named histogram of exact values, like cluster sizes.
+        '''
+        with self.lock:
+            self.histograms[name][value] += 1
+
+    def report(self):
+        ''' Return a JSON-serializable dictionary of everything recorded.
+        '''
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return {
+            'script': self.script,
+            'argv': sys.argv[1:],
+            'wall': round(time.perf_counter() - self.start, 3),
+            'stages': {name: dict(calls=stage['calls'], wall=round(stage['wall'], 3),
+                                  cpu=round(stage['cpu'], 3))
+                       for (name, stage) in self.stages.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: {str(value): count for (value, count) in sorted(histogram.items())}
+                           for (name, histogram) in self.histograms.items()},
+            'peak_rss_mb': peak_rss_mb(),
+            'children': {'cpu': round(children.ru_utime + children.ru_stime, 3),
+                         'peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)},
+            }
+
+    def write(self, report_filename=None):
+        ''' Write a JSON report to a file if named, and save any profile.
+        '''
+        if report_filename:
+            with open(report_filename, 'w') as file:
+                json.dump(self.report(), file, indent=2)
+
+        if self.profiler:
+            if self.profiler.getstats():
+                self.profile_stats.add(self.profiler)
+            self.profile_stats.dump_stats(self.profile_filename)
+
+def add_arguments(parser):
+    ''' Add --report and --profile options to a script's argument parser.
+    '''
+    parser.add_argument('--report',
+                        help='File to write a JSON report of stage times, counts, '
+                             'and peak memory to.')
+
+    parser.add_argument('--profile',
+                        help='File to save cProfile statistics for the hot loops to, '
+                             'for reading with pstats.')
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
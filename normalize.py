@@ -0,0 +1,123 @@
+''' Token normalization of U.S. English street names.
+
+Street names are lowercased, split into tokens, and common tokens like
+"Av"/"Ave"/"Avenue", "E"/"East", or "2nd"/"Second" are replaced with identical
+opaque values. The same raw street string recurs thousands of times in an
+area, so normalized values are kept in a bounded LRU cache.
+'''
+import functools, hashlib, sys
+
+# Living on borrowed data.
+tokens = [
+    ["10th","Tenth"],["11th","Eleventh"],["12th","Twelfth"],["13th","Thirteenth"],
+    ["14th","Fourteenth"],["15th","Fifteenth"],["16th","Sixteenth"],["17th","Seventeenth"],
+    ["18th","Eighteenth"],["19th","Nineteenth"],["1st","First"],["20th","Twentieth"],
+    ["2nd","Second"],["3rd","Third"],["4th","Fourth"],["5th","Fifth"],["6th","Sixth"],
+    ["7th","Seventh"],["8th","Eighth"],["9th","Ninth"],["Accs","Access"],["Alwy","Alleyway"],
+    ["Aly","Ally","Alley"],["Ambl","Amble"],["App","Approach"],["Apt","Apartment"],
+    ["Apts","Apartments"],["Arc","Arcade"],["Artl","Arterial"],["Arty","Artery"],
+    ["Ave","Avenue","Av"],["Ba","Banan"],["Bch","Beach"],["Bg","Burg"],["Bgs","Burgs"],
+    ["Blf","Bluff"],["Blk","Block"],["Br","Brace","Branch"],["Brg","Bridge"],
+    ["Brk","Break","Brook"],["Brks","Brooks"],["Btm","Bottom"],["Bvd","Blvd","Boulevard"],
+    ["Bwlk","Boardwalk"],["Byp","Bypa","Bypass"],["Byu","Bayou"],["Bywy","Byway"],
+    ["Bzr","Bazaar"],["Cantt","Cantonment"],["Cct","Circuit"],["Ch","Chase","Church"],
+    ["Chk","Chowk"],["Cir","Circle"],["Cirs","Circles"],["Cl","Close","Clinic"],
+    ["Clb","Club"],["Clf","Cliff"],["Clfs","Cliffs"],["Cll","Calle"],["Cly","Colony"],
+    ["Cmn","Common"],["Cnl","Canal"],["Cnr","Cor","Corner"],["Coll","College"],
+    ["Con","Concourse"],["Const","Constituency"],["Corpn","Corporation"],["Cp","Camp"],
+    ["Cpe","Cape"],["Cplx","Complex"],["Cps","Copse"],["Crcs","Circus"],["Crk","Creek"],
+    ["Crse","Course"],["Crst","Crest"],["Csac","Cul-de-sac"],["Cswy","Causeway"],
+    ["Ct","Court"],["Ctr","Center","Centre"],["Ctrs","Centers"],["Cts","Courts"],
+    ["Ctyd","Courtyard"],["Curv","Curve"],["Cutt","Cutting"],["Cv","Cove"],["Cyn","Canyon"],
+    ["Dl","Dale"],["Dm","Dam"],["Dr","Drive"],["Drs","Drives"],["Dt","District"],
+    ["Dv","Divide"],["Dvwy","Driveway"],["E","East"],["Elb","Elbow"],["Ent","Entrance"],
+    ["Esp","Esplanade"],["Est","Estate"],["Ests","Estates"],["Exp","Expy","Expressway"],
+    ["Ext","Extension"],["Exts","Extensions"],["Fawy","Fairway"],["Fld","Field"],
+    ["Flds","Fields"],["Fls","Falls"],["Flt","Flat"],["Flts","Flats"],["Folw","Follow"],
+    ["Form","Formation"],["Frd","Ford"],["Frg","Forge"],["Frgs","Forges"],["Frk","Fork"],
+    ["Frst","Forest"],["Frtg","Frontage"],["Fry","Ferry"],["Ft","Feet","Fort"],
+    ["Ftwy","Footway"],["Fwy","Freeway"],["Gdns","Gardens"],["Gen","General"],["Gl","Galli"],
+    ["Glde","Glade"],["Govt","Government"],["Gr","Grove"],["Gra","Grange"],["Grd","Grade"],
+    ["Grn","Green"],["Gte","Gate"],["Hbr","Harbor"],["Hbrs","Harbors"],["Hird","Highroad"],
+    ["Hl","Hill"],["Hls","Hills"],["Holw","Hollow"],["Hosp","Hospital"],["Htl","Hotel"],
+    ["Hts","Heights"],["Hvn","Haven"],["Hwy","Highway"],["I","Interstate"],
+    ["Ind","Industrial"],["Intg","Interchange"],["Is","Island"],["Iss","Islands"],
+    ["Jcts","Junctions"],["Jn","Jct","Jnc","Junction"],["Jr","Junior"],["Knl","Knoll"],
+    ["Knls","Knolls"],["Ky","Key"],["Kys","Keys"],["Lck","Lock"],["Lcks","Locks"],
+    ["Ldg","Lodge"],["Lf","Loaf"],["Lgt","Light"],["Lgts","Lights"],["Lk","Lake"],
+    ["Lks","Lakes"],["Lkt","Lookout"],["Ln","Lane"],["Lndg","Landing"],["Lnwy","Laneway"],
+    ["Lt","Lieutenant"],["Lyt","Layout"],["Maj","Major"],["Mal","Mall"],
+    ["Mcplty","Municpality"],["Mdw","Meadow"],["Mdws","Meadows"],["Mg","Marg"],
+    ["Mhd","Moorhead"],["Mkt","Market"],["Ml","Mill"],["Mndr","Meander"],["Mnr","Manor"],
+    ["Mnrs","Manors"],["Mq","Mosque"],["Msn","Mission"],["Mt","Mount"],["Mtn","Mountain"],
+    ["Mtwy","Motorway"],["N","North"],["Nck","Neck"],["NE","Northeast"],["Ngr","Nagar"],
+    ["Nl","Nalla"],["NW","Northwest"],["Off","Office"],["Orch","Orchard"],["Otlk","Outlook"],
+    ["Ovps","Overpass"],["Pchyt","Panchayat"],["Pde","Parade"],["Pf","Platform"],
+    ["Ph","Phase"],["Piaz","Piazza"],["Pk","Peak"],["Pkt","Pocket"],["Pl","Place"],
+    ["Pln","Plain"],["Plns","Plains"],["Plz","Plza","Plaza"],["Pr","Prairie"],
+    ["Prom","Promenade"],["Prt","Port"],["Prts","Ports"],["Psge","Passage"],
+    ["Pt","Pnt","Point"],["Pts","Points"],["Pvt","Private"],["Pway","Pathway"],
+    ["Pwy","Pkwy","Parkway"],["Qdrt","Quadrant"],["Qtrs","Quarters"],["Qys","Quays"],
+    ["R","Riv","River"],["Radl","Radial"],["Rd","Road"],["Rdg","Rdge","Ridge"],
+    ["Rdgs","Ridges"],["Rds","Roads"],["Rly","Railway"],["Rmbl","Ramble"],["Rnch","Ranch"],
+    ["Rpd","Rapid"],["Rpds","Rapids"],["Rst","Rest"],["Rt","Restaurant"],["Rte","Route"],
+    ["Rtt","Retreat"],["Rty","Rotary"],["S","South"],["Sbwy","Subway"],["Sch","School"],
+    ["SE","Southeast"],["Sgt","Sergeant"],["Shl","Shoal"],["Shls","Shoals"],["Shr","Shore"],
+    ["Shrs","Shores"],["Shun","Shunt"],["Skwy","Skyway"],["Smt","Summit"],["Spg","Spring"],
+    ["Spgs","Springs"],["Sq","Square"],["Sqs","Squares"],["Sr","Senior"],
+    ["St","Saint","Street"],["Sta","Stn","Station"],["Std","Stadium"],["Stg","Stage"],
+    ["Strm","Stream"],["Sts","Streets"],["Svwy","Serviceway"],["SW","Southwest"],
+    ["Tce","Ter","Terrace"],["Tfwy","Trafficway"],["Thfr","Thoroughfare"],["Thwy","Thruway"],
+    ["Tlwy","Tollway"],["Tpke","Turnpike"],["Tpl","Temple"],["Trce","Trace"],["Trk","Track"],
+    ["Trl","Trail","Tr"],["Tunl","Tunnel"],["Twn","Town"],["Un","Union"],["Univ","University"],
+    ["Unp","Upas","Underpass"],["Uns","Unions"],["Via","Viad","Viaduct"],["Vis","Vsta","Vista"],
+    ["Vl","Ville"],["Vlg","Vill","Village"],["Vlgs","Villages"],["Vly","Valley"],
+    ["Vlys","Valleys"],["Vw","View"],["Vws","Views"],["W","West"],["Whrf","Wharf"],
+    ["Wkwy","Walkway"],["X","Cr","Cres","Crss","Cross","Crescent"],["Xing","Crossing"],
+    ["Wy","Way"],
+    ]
+
+# Prepare a map from common street name tokens to opaque hashed values.
+token_map = dict()
+
+for token in tokens:
+    normal = ', '.join(sorted(token)).encode('utf8')
+    value = hashlib.sha1(normal).hexdigest()[:5]
+    token_map.update({opt.lower(): value for opt in token})
+
+# Bound lookup method, precompiled once for the hot loop below.
+lookup_token = token_map.get
+
+# Number of distinct raw street names to remember normalized values for.
+cache_size = 2**16
+
+def normalize_street_uncached(street):
+    ''' Return an opaque token-normalized representation of a street name.
+    '''
+    return sys.intern(''.join([lookup_token(s, s) for s in street.lower().split()]))
+
+@functools.lru_cache(maxsize=cache_size)
+def normalize_street(street):
+    ''' Return an opaque token-normalized representation of a street name.
+
+        Results are cached on the raw street string.
+
+        >>> normalize_street('E 5th St') == normalize_street('East Fifth Street')
+        True
+    '''
+    return normalize_street_uncached(street)
+
+def normalize_streets(streets):
+    ''' Return a list of normalized representations of a column of street names.
+
+        Each distinct street name is normalized only once.
+
+        >>> normalize_streets(['Main St', 'Main Street', 'Main St']) == [normalize_street('Main St')] * 3
+        True
+    '''
+    normals = {street: normalize_street(street) for street in dict.fromkeys(streets)}
+    return [normals[street] for street in streets]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,214 @@
+''' Batched writers for deduped cluster output in several file formats.
+
+Each cluster is summarized as a dictionary by expand-reduce.py, and writers
+buffer these into batches before writing them in bulk:
+
+- csv: the original CSV columns, one row per cluster.
+- geojson: newline-delimited GeoJSON point features, one per line.
+- gpkg: a GeoPackage point layer, written in one transaction per batch.
+- parquet: an Apache Parquet table with one row group per batch.
+- arrow: an Arrow IPC file, which can be memory-mapped without parsing.
+
+All but CSV include maximum distance from the center in OA:MAX_RADIUS, the
+number of distinct sources in OA:SOURCES, and the hashes of member addresses
+for each cluster as a list in OA:HASHES. GeoPackage output requires GDAL, and Parquet and Arrow
+output require pyarrow, which are otherwise optional here.
+
+    >>> import io
+    >>> file = io.StringIO()
+    >>> writer = GeoJSONWriter(file)
+    >>> writer.write({'NUMBER': '1', 'STREET': 'Main St', 'UNIT': '', 'LON': -122.0,
+    ...               'LAT': 37.0, 'OA:COUNT': 2, 'OA:RADIUS': 1, 'OA:HASHES': ['a', 'b']})
+    >>> writer.close()
+    >>> json.loads(file.getvalue())['properties']['OA:HASHES']
+    ['a', 'b']
+'''
+import csv, json, os
+
+FIELDS = ('NUMBER', 'STREET', 'UNIT', 'LAT', 'LON', 'OA:COUNT', 'OA:RADIUS')
+
+# Fields of point features, with coordinates in the geometry instead.
+PROPERTIES = ('NUMBER', 'STREET', 'UNIT', 'OA:COUNT', 'OA:RADIUS', 'OA:MAX_RADIUS',
+              'OA:SOURCES', 'OA:HASHES')
+
+# Integer fields of point features; the rest are strings.
+INTEGERS = ('OA:COUNT', 'OA:RADIUS', 'OA:MAX_RADIUS', 'OA:SOURCES')
+
+# Number of clusters written at once, and rows in each Parquet row group.
+BATCH_SIZE = 2**16
+
+FORMATS = ('csv', 'geojson', 'gpkg', 'parquet', 'arrow')
+
+EXTENSIONS = {'.csv': 'csv', '.geojson': 'geojson', '.geojsonl': 'geojson',
+              '.ndjson': 'geojson', '.gpkg': 'gpkg', '.parquet': 'parquet',
+              '.arrow': 'arrow', '.feather': 'arrow'}
+
+def guess_format(filename):
+    ''' Return an output format for a file name, CSV unless the extension is known.
+
+        >>> guess_format('addresses-06075.parquet'), guess_format('addresses-06075.txt')
+        ('parquet', 'csv')
+    '''
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower(), 'csv')
+
+class BatchWriter:
+    ''' Buffer cluster dictionaries and write them batch_size at a time.
+    '''
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.batch = list()
+
+    def write(self, output):
+        self.batch.append(output)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.write_batch(self.batch)
+            self.batch = list()
+
+    def write_batch(self, outputs):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+class CSVWriter(BatchWriter):
+    ''' Write clusters to a text file as CSV rows with the original columns.
+    '''
+    def __init__(self, file, batch_size=BATCH_SIZE):
+        BatchWriter.__init__(self, batch_size)
+        self.out = csv.writer(file)
+        self.out.writerow(FIELDS)
+
+    def write_batch(self, outputs):
+        self.out.writerows([['' if output[field] is None else output[field] for field in FIELDS]
+                            for output in outputs])
+
+class GeoJSONWriter(BatchWriter):
+    ''' Write clusters to a text file as newline-delimited GeoJSON point features.
+    '''
+    def __init__(self, file, batch_size=BATCH_SIZE):
+        BatchWriter.__init__(self, batch_size)
+        self.file = file
+
+    def write_batch(self, outputs):
+        self.file.write(''.join(json.dumps({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [output['LON'], output['LAT']]},
+            'properties': {field: output.get(field) for field in PROPERTIES},
+            }) + '\n' for output in outputs))
+
+class GeoPackageWriter(BatchWriter):
+    ''' Write clusters to a new GeoPackage point layer with GDAL, one transaction per batch.
+    '''
+    def __init__(self, filename, batch_size=BATCH_SIZE):
+        from osgeo import ogr, osr
+
+        BatchWriter.__init__(self, batch_size)
+        self.ogr = ogr
+        sref = osr.SpatialReference(); sref.ImportFromEPSG(4326)
+        sref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        # Replace any existing file, as with other formats.
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        self.datasource = ogr.GetDriverByName('GPKG').CreateDataSource(filename)
+        self.layer = self.datasource.CreateLayer('addresses', srs=sref, geom_type=ogr.wkbPoint)
+
+        for field in PROPERTIES:
+            if field in INTEGERS:
+                self.layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+            else:
+                defn = ogr.FieldDefn(field, ogr.OFTString)
+                if field == 'OA:HASHES':
+                    defn.SetSubType(ogr.OFSTJSON)
+                self.layer.CreateField(defn)
+
+        self.defn = self.layer.GetLayerDefn()
+
+    def write_batch(self, outputs):
+        self.datasource.StartTransaction()
+
+        for output in outputs:
+            feature = self.ogr.Feature(self.defn)
+            point = self.ogr.Geometry(self.ogr.wkbPoint)
+            point.AddPoint_2D(output['LON'], output['LAT'])
+            feature.SetGeometry(point)
+            for field in PROPERTIES:
+                value = output.get(field)
+                if value is None:
+                    feature.SetFieldNull(field)
+                elif field == 'OA:HASHES':
+                    feature.SetField(field, json.dumps(value))
+                else:
+                    feature.SetField(field, value)
+            self.layer.CreateFeature(feature)
+
+        self.datasource.CommitTransaction()
+
+    def close(self):
+        BatchWriter.close(self)
+        self.layer, self.datasource = None, None
+
+class ArrowWriter(BatchWriter):
+    ''' Write clusters to a Parquet or Arrow IPC file with pyarrow, one record batch at a time.
+    '''
+    def __init__(self, filename, format, batch_size=BATCH_SIZE):
+        import pyarrow, pyarrow.ipc, pyarrow.parquet
+
+        BatchWriter.__init__(self, batch_size)
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('NUMBER', pyarrow.string()), ('STREET', pyarrow.string()), ('UNIT', pyarrow.string()),
+            ('LON', pyarrow.float64()), ('LAT', pyarrow.float64()),
+            ('OA:COUNT', pyarrow.int64()), ('OA:RADIUS', pyarrow.int64()),
+            ('OA:MAX_RADIUS', pyarrow.int64()), ('OA:SOURCES', pyarrow.int64()),
+            ('OA:HASHES', pyarrow.list_(pyarrow.string())),
+            ])
+
+        if format == 'parquet':
+            self.out = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.out = pyarrow.ipc.new_file(filename, self.schema)
+
+    def write_batch(self, outputs):
+        columns = [[output.get(field.name) for output in outputs] for field in self.schema]
+        self.out.write_batch(self.pyarrow.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        BatchWriter.close(self)
+        self.out.close()
+
+class FileWriter:
+    ''' Open a text file for a writer class, and close it with the writer.
+    '''
+    def __init__(self, filename, Writer, batch_size):
+        self.file = open(filename, 'w', newline='')
+        self.writer = Writer(self.file, batch_size)
+
+    def write(self, output):
+        self.writer.write(output)
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+def writer(filename, format, batch_size=BATCH_SIZE):
+    ''' Return a writer with write() and close() methods for a new output file.
+
+        Raises ImportError if the format needs a missing optional package.
+    '''
+    if format == 'gpkg':
+        return GeoPackageWriter(filename, batch_size)
+    elif format in ('parquet', 'arrow'):
+        return ArrowWriter(filename, format, batch_size)
+    elif format == 'geojson':
+        return FileWriter(filename, GeoJSONWriter, batch_size)
+    return FileWriter(filename, CSVWriter, batch_size)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,10 +3,14 @@
 
 Reads shapes from geodata/tl_2016_us_state.shp and geodata/tl_2016_us_cbsa.shp,
 splits them into 1x1 degree boxes, subtracts CBSA areas from states, and writes
-a unified shapefile.
+a unified shapefile. Boxes are cut in parallel processes, see quilt.py, and
+written in box order by this process alone.
 '''
 from osgeo import ogr, osr
-import collections, math, sys
+import argparse, concurrent.futures, metrics, quilt
+
+# Layers in the order their pieces are written within each box.
+LAYERS = [('cbsa', 'geodata/tl_2016_us_cbsa.shp'), ('state', 'geodata/tl_2016_us_state.shp')]
 
 def create_output_ds(filename):
     '''
@@ -19,7 +23,7 @@ def create_output_ds(filename):
         ogr.FieldDefn('lon', ogr.OFTInteger), ogr.FieldDefn('lat', ogr.OFTInteger),
         ogr.FieldDefn('geoid', ogr.OFTString), ogr.FieldDefn('name', ogr.OFTString)
         ])
-    
+
     return out_ds, out_layer
 
 def add_feature(layer, geom, lon, lat, geoid, name):
@@ -34,63 +38,41 @@ def add_feature(layer, geom, lon, lat, geoid, name):
     feature.SetField('name', name)
     layer.CreateFeature(feature)
 
-def create_box_geom(x, y):
-    '''
-    '''
-    wkt_tpl = 'POLYGON(({x1} {y1},{x1} {y2},{x2} {y2},{x2} {y1},{x1} {y1}))'
-    wkt = wkt_tpl.format(x1=int(x), y1=int(y), x2=int(x+1), y2=int(y+1))
-    return ogr.CreateGeometryFromWkt(wkt)
+parser = argparse.ArgumentParser(description='Combine State and CBSA areas into a continuous output quilt.')
+parser.add_argument('output', help='Shapefile for combined areas.')
 
-def iterate_boxes(feature):
-    '''
-    '''
-    xmin, xmax, ymin, ymax = feature.GetGeometryRef().GetEnvelope()
-    
-    x = math.floor(xmin)
-    while x < xmax:
-        y = math.floor(ymin)
-        while y < ymax:
-            yield (x, y)
-            y += 1
-        x += 1
+parser.add_argument('--workers', default=4, type=int,
+                    help='Number of processes cutting boxes at once. Default value 4.')
+
+metrics.add_arguments(parser)
+
+args = parser.parse_args()
+run_metrics = metrics.Metrics('prepare-areas.py', args.profile)
+
+with run_metrics.stage('index'):
+    tasks = quilt.index_boxes(LAYERS, run_metrics.counters)
+
+run_metrics.count('boxes', len(tasks))
+out_ds, out_layer = create_output_ds(args.output)
 
-out_ds, out_layer = create_output_ds(*sys.argv[1:])
-states_ds = ogr.Open('geodata/tl_2016_us_state.shp')
-cbsa_ds = ogr.Open('geodata/tl_2016_us_cbsa.shp')
-boxed_geoms = collections.defaultdict(list)
+def write_pieces(results):
+    for (pieces, counts) in results:
+        run_metrics.update(counts)
+        for (wkb, x, y, geoid, name) in pieces:
+            add_feature(out_layer, ogr.CreateGeometryFromWkb(wkb), x, y, geoid, name)
+            run_metrics.count('rows out')
 
-for cbsa_feature in cbsa_ds.GetLayer(0):
-    print(cbsa_feature.GetField('NAME'), file=sys.stderr)
-    
-    for (x, y) in iterate_boxes(cbsa_feature):
-        box_geom = create_box_geom(x, y)
-        cbsa_geom = cbsa_feature.GetGeometryRef()
-        
-        if not box_geom.Intersects(cbsa_geom):
-            continue
-        
-        boxed_geom = box_geom.Intersection(cbsa_geom)
-        boxed_geoms[(x, y)].append(boxed_geom)
-        
-        add_feature(out_layer, boxed_geom, x, y,
-            cbsa_feature.GetField('GEOID'), cbsa_feature.GetField('NAME'))
+if args.workers > 1:
+    # Pieces come back in box order, and only this process writes them.
+    with run_metrics.stage('boxes'), concurrent.futures.ProcessPoolExecutor(
+            args.workers, initializer=quilt.load_areas, initargs=(LAYERS, )) as pool:
+        write_pieces(pool.map(quilt.cut_box, tasks, chunksize=4))
+else:
+    quilt.load_areas(LAYERS)
+    with run_metrics.stage('boxes', hot=True):
+        write_pieces(map(quilt.cut_box, tasks))
 
-for state_feature in states_ds.GetLayer(0):
-    print(state_feature.GetField('NAME'), file=sys.stderr)
-    
-    for (x, y) in iterate_boxes(state_feature):
-        box_geom = create_box_geom(x, y)
-        state_geom = state_feature.GetGeometryRef()
-        
-        if not box_geom.Intersects(state_geom):
-            continue
-        
-        boxed_geom = box_geom.Intersection(state_geom)
-        for other_geom in boxed_geoms[(x, y)]:
-            # Substract CBSA areas from state area
-            boxed_geom = boxed_geom.Difference(other_geom)
-        
-        add_feature(out_layer, boxed_geom, x, y,
-            state_feature.GetField('GEOID'), state_feature.GetField('NAME'))
+with run_metrics.stage('sync'):
+    out_ds.SyncToDisk()
 
-out_ds.SyncToDisk()
+run_metrics.write(args.report)
@@ -0,0 +1,142 @@
+''' Cut State and CBSA areas into 1x1 degree boxes of a continuous quilt.
+
+Boxes are independent, so each one can be cut in a separate process. An
+envelope index maps every box to the areas whose bounding boxes touch it, so
+boxes with no areas are never visited and each box only tests its candidates.
+Within a box, CBSA pieces are unioned once and subtracted from each state
+piece with a single Difference, instead of one Difference per CBSA.
+
+Area shapes are loaded once per worker process, since OGR geometries cannot
+be sent between processes, and tasks name areas by layer and feature ID.
+'''
+from osgeo import ogr
+import collections, math
+
+# Area geometries, geoids, and names by (layer, feature ID), loaded per process.
+loaded_areas = dict()
+
+def create_box_geom(x, y):
+    ''' Return a 1x1 degree OGR polygon with its lower left corner at x, y.
+    '''
+    wkt_tpl = 'POLYGON(({x1} {y1},{x1} {y2},{x2} {y2},{x2} {y1},{x1} {y1}))'
+    wkt = wkt_tpl.format(x1=int(x), y1=int(y), x2=int(x+1), y2=int(y+1))
+    return ogr.CreateGeometryFromWkt(wkt)
+
+def iterate_boxes(geom):
+    ''' Generate (x, y) corners of 1x1 degree boxes touching a geometry's envelope.
+    '''
+    xmin, xmax, ymin, ymax = geom.GetEnvelope()
+
+    x = math.floor(xmin)
+    while x < xmax:
+        y = math.floor(ymin)
+        while y < ymax:
+            yield (x, y)
+            y += 1
+        x += 1
+
+def iterate_features(layers):
+    ''' Generate (layer, feature ID, geometry, geoid, name) for features of named datasources.
+
+        Accepts a list of (layer, filename) pairs.
+    '''
+    for (layer, filename) in layers:
+        datasource = ogr.Open(filename)
+        for feature in datasource.GetLayer(0):
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            yield (layer, feature.GetFID(), geom.Clone(),
+                   feature.GetField('GEOID'), feature.GetField('NAME'))
+
+def load_areas(layers):
+    ''' Load area geometries from (layer, filename) pairs into this process.
+
+        Used as a process pool initializer.
+    '''
+    loaded_areas.clear()
+
+    for (layer, fid, geom, geoid, name) in iterate_features(layers):
+        loaded_areas[(layer, fid)] = geom, geoid, name
+
+def index_boxes(layers, counts=None):
+    ''' Return an envelope index of boxes to the areas that may overlap them.
+
+        Returns a list of ((x, y), [(layer, feature ID), ...]) tasks sorted by
+        box, with areas in layer order. Adds numbers of features read from
+        each layer to an optional Counter.
+    '''
+    boxes = collections.defaultdict(list)
+
+    for (layer, fid, geom, _, _) in iterate_features(layers):
+        if counts is not None:
+            counts['{} features in'.format(layer)] += 1
+        for box in iterate_boxes(geom):
+            boxes[box].append((layer, fid))
+
+    return sorted(boxes.items())
+
+def iterate_polygons(geom):
+    ''' Generate polygons in a geometry, skipping points and lines left over from clipping.
+    '''
+    geom_type = ogr.GT_Flatten(geom.GetGeometryType())
+
+    if geom_type == ogr.wkbPolygon:
+        yield geom
+    elif geom_type in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geom.GetGeometryCount()):
+            yield from iterate_polygons(geom.GetGeometryRef(i))
+
+def union_pieces(pieces):
+    ''' Return one geometry covering a list of area pieces.
+    '''
+    if len(pieces) == 1:
+        return pieces[0]
+
+    multipolygon = ogr.Geometry(ogr.wkbMultiPolygon)
+    for piece in pieces:
+        for polygon in iterate_polygons(piece):
+            multipolygon.AddGeometry(polygon)
+
+    return multipolygon.UnionCascaded()
+
+def clip_areas(box_geom, keys, counts):
+    ''' Generate (key, piece) pairs for loaded areas that intersect a box.
+    '''
+    for key in keys:
+        geom = loaded_areas[key][0]
+
+        if not box_geom.Intersects(geom):
+            # The area's envelope touches the box, but its shape does not.
+            counts['areas outside box'] += 1
+            continue
+
+        yield key, box_geom.Intersection(geom)
+
+def cut_box(task):
+    ''' Return quilt pieces and counts for one box and its candidate areas.
+
+        Pieces are (WKB, x, y, geoid, name) tuples: CBSA areas clipped to the
+        box, then state areas clipped to the box without any CBSA area.
+    '''
+    (x, y), keys = task
+    box_geom, counts = create_box_geom(x, y), collections.Counter()
+    cbsa_keys = [key for key in keys if key[0] == 'cbsa']
+    state_keys = [key for key in keys if key[0] != 'cbsa']
+
+    cbsa_pieces = list(clip_areas(box_geom, cbsa_keys, counts))
+    state_pieces = list(clip_areas(box_geom, state_keys, counts))
+
+    if cbsa_pieces and state_pieces:
+        # Substract CBSA areas from state areas with one difference each
+        cbsa_geom = union_pieces([piece for (_, piece) in cbsa_pieces])
+        state_pieces = [(key, piece.Difference(cbsa_geom)) for (key, piece) in state_pieces]
+        counts['differences'] += len(state_pieces)
+
+    pieces = list()
+
+    for (key, piece) in cbsa_pieces + state_pieces:
+        _, geoid, name = loaded_areas[key]
+        pieces.append((bytes(piece.ExportToWkb()), x, y, geoid, name))
+
+    return pieces, counts
@@ -0,0 +1,309 @@
+''' Read and write keyed OpenAddresses records between pipeline stages.
+
+Two formats are supported. The "json" format is the original one, with text
+lines of a key followed by a JSON array of Address arguments:
+
+    {key} [{source}, {hash}, {lon}, {lat}, {x}, {y}, {number}, {street}, {unit}, ...]
+
+The "binary" format is a stream of length-prefixed records. A stream begins
+with a header of magic bytes and a format version, followed by records that
+each start with a one-byte type and a four-byte little-endian payload length:
+
+    S: string table entry, UTF-8 text assigned the next string index.
+    A: address, with key and string field indexes, four 64-bit float
+       coordinates (lon, lat, x, y), and the UTF-8 address hash.
+
+String indexes are local to the stream following each header, so streams
+written by separate processes or appended to one file can be concatenated.
+Binary files are read through a memory map without copying them into memory.
+'''
+import collections, fcntl, json, mmap, struct
+
+FORMATS = ('json', 'binary')
+
+MAGIC, VERSION = b'OADB', 1
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<cI')
+ADDRESS = struct.Struct('<IddddIIIIIIII')
+NONE = 0xFFFFFFFF
+
+STRING_TYPE, ADDRESS_TYPE = b'S', b'A'
+
+def extension(format):
+    ''' Return a filename extension for a record format.
+    '''
+    return '.bin' if format == 'binary' else '.txt'
+
+class JSONWriter:
+    ''' Write keyed Address arguments as lines of text to a binary file.
+    '''
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, key, addr_args):
+        self.file.write('{} {}\n'.format(key, json.dumps(addr_args)).encode('utf8'))
+
+class BinaryWriter:
+    ''' Write keyed Address arguments as binary records to a binary file.
+
+        With max_strings, a new stream is started whenever the string table
+        would grow beyond that many entries.
+
+        >>> import io
+        >>> buffer = io.BytesIO()
+        >>> writer = BinaryWriter(buffer)
+        >>> writer.write('06037', ['src', 'abc', -118.2, 34.0, -13158000.0, 4028000.0, '1', 'Main St', ''])
+        >>> list(read_stream(io.BytesIO(buffer.getvalue())))
+        [('06037', ['src', 'abc', -118.2, 34.0, -13158000.0, 4028000.0, '1', 'Main St', '', None, None, None, None])]
+    '''
+    def __init__(self, file, max_strings=None):
+        self.file = file
+        self.strings = dict()
+        self.max_strings = max_strings
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def string_index(self, value):
+        if value is None:
+            return NONE
+
+        try:
+            return self.strings[value]
+        except KeyError:
+            encoded = value.encode('utf8')
+            self.file.write(RECORD.pack(STRING_TYPE, len(encoded)) + encoded)
+            index = self.strings[value] = len(self.strings)
+            return index
+
+    def write(self, key, addr_args):
+        if self.max_strings and len(self.strings) + 9 > self.max_strings:
+            # Start a new stream with an empty string table to bound memory.
+            self.strings = dict()
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+
+        source, hash, lon, lat, x, y, number, street, unit, *extras = addr_args
+        city, district, region, postcode = (list(extras) + [None] * 4)[:4]
+        indexes = [self.string_index(value) for value in
+                   (key, source, number, street, unit, city, district, region, postcode)]
+        encoded_hash = hash.encode('utf8')
+        payload = ADDRESS.pack(indexes[0], lon, lat, x, y, *indexes[1:]) + encoded_hash
+        self.file.write(RECORD.pack(ADDRESS_TYPE, len(payload)) + payload)
+
+def writer(file, format):
+    ''' Return a writer for a binary file object in the given format.
+    '''
+    if format == 'binary':
+        return BinaryWriter(file)
+    return JSONWriter(file)
+
+class WriterPool:
+    ''' Buffered writers for many files of records, with a bounded number open.
+
+        Records are buffered per file and written in batches. Least recently
+        used files are closed when too many are open, and opened again for
+        appending as needed. With lock, each batch is written as a stream of
+        its own under an exclusive lock, so that separate processes can
+        append to one file.
+
+        >>> import tempfile, os
+        >>> dirname = tempfile.mkdtemp()
+        >>> pool = WriterPool('binary', max_open=1, batch_size=1)
+        >>> for key in ('a', 'b', 'a'):
+        ...     pool.write(os.path.join(dirname, key + '.bin'), key, ['src', key, 0., 0., 0., 0., '1', 'Main St', ''])
+        >>> pool.close()
+        >>> pool.filenames() == [os.path.join(dirname, 'a.bin'), os.path.join(dirname, 'b.bin')]
+        True
+        >>> len(list(read_binary(os.path.join(dirname, 'a.bin'))))
+        2
+
+        Locked pools in separate processes can take turns on one file:
+
+        >>> pools = WriterPool('binary', batch_size=1, lock=True), WriterPool('binary', batch_size=1, lock=True)
+        >>> for (i, pool) in enumerate(pools * 2):
+        ...     pool.write(os.path.join(dirname, 'c.bin'), str(i), ['src', str(i), 0., 0., 0., 0., str(i), 'Main St', ''])
+        >>> for pool in pools:
+        ...     pool.close()
+        >>> [(key, addr_args[1], addr_args[6]) for (key, addr_args) in read_binary(os.path.join(dirname, 'c.bin'))]
+        [('0', '0', '0'), ('1', '1', '1'), ('2', '2', '2'), ('3', '3', '3')]
+    '''
+    def __init__(self, format, max_open=64, batch_size=1000, max_buffered=100000, lock=False):
+        self.format = format
+        self.max_open, self.batch_size, self.max_buffered = max_open, batch_size, max_buffered
+        self.lock = lock
+        self.handles = collections.OrderedDict()
+        self.buffers = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.buffered = 0
+
+    def write(self, filename, key, addr_args):
+        ''' Buffer one keyed record for a file.
+        '''
+        buffer = self.buffers.setdefault(filename, list())
+        buffer.append((key, addr_args))
+        self.counts[filename] = self.counts.get(filename, 0) + 1
+        self.buffered += 1
+
+        if len(buffer) >= self.batch_size:
+            self.flush(filename)
+        elif self.buffered >= self.max_buffered:
+            for filename in list(self.buffers):
+                self.flush(filename)
+
+    def flush(self, filename):
+        ''' Write out buffered records for one file.
+        '''
+        buffer = self.buffers.pop(filename, None)
+        if not buffer:
+            return
+
+        file, out = self.open(filename)
+        if self.lock:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            # Others may have appended streams of their own since the last
+            # batch, so each batch starts a stream with its own string table.
+            out = writer(file, self.format)
+        for (key, addr_args) in buffer:
+            out.write(key, addr_args)
+        file.flush()
+        if self.lock:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+        self.buffered -= len(buffer)
+
+    def open(self, filename):
+        ''' Return an open file and writer for a file name, closing others if needed.
+        '''
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+            return self.handles[filename]
+
+        while len(self.handles) >= self.max_open:
+            _, (file, _) = self.handles.popitem(last=False)
+            file.close()
+
+        # Locked writers are created per batch, under the lock.
+        file = open(filename, 'ab')
+        self.handles[filename] = file, None if self.lock else writer(file, self.format)
+        return self.handles[filename]
+
+    def close(self):
+        ''' Write out all buffered records and close all files.
+        '''
+        for filename in list(self.buffers):
+            self.flush(filename)
+
+        for (file, _) in self.handles.values():
+            file.close()
+
+        self.handles.clear()
+
+    def filenames(self):
+        ''' Return a list of written file names in the order first written.
+        '''
+        return list(self.counts)
+
+def read_buffer(buffer):
+    ''' Generate (key, Address arguments) pairs from a buffer of binary records.
+
+        Raises ValueError unless a non-empty buffer starts with a stream header,
+        or if it ends partway through a record.
+
+        >>> list(read_buffer(b'06037 ["src", "abc", -118.2, 34.0]'))
+        Traceback (most recent call last):
+        ValueError: Not a binary records file, missing b'OADB' header
+        >>> import io
+        >>> file = io.BytesIO()
+        >>> BinaryWriter(file).write('06037', ['src', 'abc', -118.2, 34.0, 0, 0, '1', 'Main St', ''])
+        >>> len(list(read_buffer(file.getvalue())))
+        1
+        >>> list(read_buffer(file.getvalue()[:-2]))
+        Traceback (most recent call last):
+        ValueError: Truncated binary record at byte 47
+    '''
+    if len(buffer) and buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a binary records file, missing {!r} header'.format(MAGIC))
+
+    offset, strings = 0, list()
+
+    while offset < len(buffer):
+        if buffer[offset:offset + len(MAGIC)] == MAGIC:
+            try:
+                _, version = HEADER.unpack_from(buffer, offset)
+            except struct.error:
+                raise ValueError('Truncated binary record at byte {}'.format(offset)) from None
+            if version != VERSION:
+                raise ValueError('Unknown record format version {}'.format(version))
+            offset, strings = offset + HEADER.size, list()
+            continue
+
+        try:
+            kind, length = RECORD.unpack_from(buffer, offset)
+        except struct.error:
+            raise ValueError('Truncated binary record at byte {}'.format(offset)) from None
+
+        if offset + RECORD.size + length > len(buffer):
+            raise ValueError('Truncated binary record at byte {}'.format(offset))
+
+        start, offset = offset + RECORD.size, offset + RECORD.size + length
+
+        if kind == STRING_TYPE:
+            strings.append(str(buffer[start:offset], 'utf8'))
+
+        elif kind == ADDRESS_TYPE:
+            key, lon, lat, x, y, *indexes = ADDRESS.unpack_from(buffer, start)
+            source, number, street, unit, city, district, region, postcode = \
+                [None if index == NONE else strings[index] for index in indexes]
+            hash = str(buffer[start + ADDRESS.size:offset], 'utf8')
+            yield strings[key], [source, hash, lon, lat, x, y, number, street,
+                                 unit, city, district, region, postcode]
+
+        else:
+            raise ValueError('Unknown record type {}'.format(kind))
+
+def read_stream(file):
+    ''' Generate (key, Address arguments) pairs from a binary file object.
+
+        Used for pipes and other files that cannot be memory-mapped.
+    '''
+    yield from read_buffer(memoryview(file.read()))
+
+def read_binary(filename):
+    ''' Generate (key, Address arguments) pairs from a binary records file.
+    '''
+    with open(filename, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes cannot be mapped.
+            yield from read_stream(file)
+            return
+
+        with buffer:
+            view = memoryview(buffer)
+            try:
+                yield from read_buffer(view)
+            finally:
+                view.release()
+
+def read_json(filename):
+    ''' Generate (key, Address arguments) pairs from a text file of JSON lines.
+
+        Lines that cannot be parsed are skipped.
+    '''
+    with open(filename) as file:
+        for line in file:
+            try:
+                key, addr_args = line.split(' ', 1)
+                yield key, json.loads(addr_args)
+            except ValueError:
+                continue
+
+def read(filename, format):
+    ''' Generate (key, Address arguments) pairs from a file in the given format.
+    '''
+    if format == 'binary':
+        return read_binary(filename)
+    return read_json(filename)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,257 @@
+''' In-memory dedupe index and HTTP service for online duplicate lookups.
+
+A DedupeIndex holds addresses in an AddressBatch with the same blocking keys
+and radius grid as expand-reduce.py, so that an incoming address only has to
+be compared to nearby candidates in its own block. Blocks are keyed on the
+matcher's partition key, which is equal for any two addresses that share a
+blocking key. Inserted addresses are merged into clusters as they arrive, with
+the same results as a batch run over all of them at once.
+
+    >>> from matchers import ExactMatcher
+    >>> index = DedupeIndex(ExactMatcher(), 76.4)
+    >>> index.insert(address_args({'OA:Source': 'src1', 'HASH': 'a', 'LON': -122.2, 'LAT': 37.8,
+    ...                                'NUMBER': '1', 'STREET': 'Main St'}))['count']
+    1
+    >>> index.insert(address_args({'OA:Source': 'src2', 'HASH': 'b', 'LON': -122.2001, 'LAT': 37.8,
+    ...                                'NUMBER': '1', 'STREET': 'MAIN STREET'}))['hashes']
+    ['a', 'b']
+    >>> result = index.lookup(address_args({'LON': -122.2, 'LAT': 37.8001, 'NUMBER': '1', 'STREET': 'Main Street'}))
+    >>> result['duplicate'], result['matches'], result['sources']
+    (True, ['a', 'b'], 2)
+    >>> index.lookup(address_args({'LON': -122.2, 'LAT': 37.8, 'NUMBER': '2', 'STREET': 'Main St'}))['duplicate']
+    False
+
+The HTTP service accepts JSON addresses with OpenAddresses column names, or
+lists of them, and answers with JSON results for each:
+
+    POST /lookup   {"LON": ..., "LAT": ..., "NUMBER": ..., "STREET": ..., "UNIT": ...}
+    POST /insert   {..., "HASH": ..., "OA:Source": ...}
+    GET  /status
+
+    >>> import threading, urllib.request
+    >>> server = make_server(index, '127.0.0.1', 0)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> url = 'http://127.0.0.1:{}/lookup'.format(server.server_port)
+    >>> body = json.dumps({'LON': -122.2, 'LAT': 37.8, 'NUMBER': '1', 'STREET': 'Main St'})
+    >>> json.load(urllib.request.urlopen(url, body.encode('utf8')))['count']
+    2
+    >>> server.shutdown()
+'''
+import http.server, json, math, threading
+
+from expand import Address, AddressBatch, mercator
+import clusters
+
+class DedupeIndex:
+    ''' Blocking and spatial index of clustered addresses, with lookups and inserts.
+
+        Safe to share between threads.
+    '''
+    def __init__(self, matcher, radius):
+        self.matcher, self.radius = matcher, radius
+        self.batch = AddressBatch()
+        self.clusters = clusters.Clusters()
+
+        # Grid cells of rows by (column, row) within each block, and member
+        # rows of each cluster by root row.
+        self.blocks = dict()
+        self.members = dict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.batch)
+
+    def candidates(self, key, x, y):
+        ''' Return rows in a block within radius of a Mercator point, in insertion order.
+        '''
+        cells, radius = self.blocks.get(key), self.radius
+        if not cells:
+            return []
+
+        xs, ys, rows = self.batch.xs, self.batch.ys, list()
+        col, row = math.floor(x / radius), math.floor(y / radius)
+
+        for dcol in (-1, 0, 1):
+            for drow in (-1, 0, 1):
+                for other in cells.get((col + dcol, row + drow), ()):
+                    dx, dy = xs[other] - x, ys[other] - y
+                    if dx * dx + dy * dy <= radius * radius:
+                        rows.append(other)
+
+        return sorted(rows)
+
+    def cluster(self, row, matches=()):
+        ''' Return a result dictionary for the cluster containing a row.
+        '''
+        rows = self.members[self.clusters.find(row)]
+        stats = clusters.statistics(self.batch, [rows])
+        hashes = self.batch.hashes
+
+        return {
+            'duplicate': len(matches) > 0,
+            'matches': [hashes[match] for match in matches],
+            'hashes': [hashes[member] for member in rows],
+            'count': len(rows),
+            'sources': int(stats['sources'][0]),
+            'lon': float(stats['lon'][0]),
+            'lat': float(stats['lat'][0]),
+            'radius': int(stats['radius'][0]) if len(rows) > 1 else None,
+            }
+
+    def lookup(self, addr_args):
+        ''' Return a result for the cluster an address would join, without inserting it.
+
+            An address matching no others gets a result for itself alone.
+        '''
+        key, x, y = self.matcher.partition_key(addr_args), addr_args[4], addr_args[5]
+
+        with self.lock:
+            rows = self.candidates(key, x, y)
+
+            # Compare to candidates in a small batch of their own, leaving
+            # the index unchanged.
+            probe = self.batch.subset(rows)
+            probe_row = probe.append(*addr_args)
+            matches = [row for (i, row) in enumerate(rows) if i == probe_row
+                       or self.matcher.matches(probe, i, probe_row)]
+
+            if not matches:
+                return dict(duplicate=False, matches=[], hashes=[addr_args[1]], count=1, sources=1,
+                            lon=addr_args[2], lat=addr_args[3], radius=None)
+
+            # Matched clusters would merge, so report the largest one.
+            roots = {self.clusters.find(row): row for row in matches}
+            largest = max(roots, key=lambda root: len(self.members[root]))
+            return self.cluster(roots[largest], matches)
+
+    def _add(self, addr_args):
+        ''' Add a new address to the index and its clusters, and return its row and matched rows.
+        '''
+        key, x, y = self.matcher.partition_key(addr_args), addr_args[4], addr_args[5]
+        rows = self.candidates(key, x, y)
+        row = self.batch.append(*addr_args)
+        self.clusters.extend(len(self.batch))
+        self.members[row] = [row]
+        matches = [other for other in rows if self.matcher.matches(self.batch, other, row)]
+
+        for other in matches:
+            root1, root2 = self.clusters.find(row), self.clusters.find(other)
+            if root1 != root2:
+                self.clusters.union(root1, root2)
+                root, merged = (root1, root2) if self.clusters.find(root1) == root1 else (root2, root1)
+                self.members[root] = sorted(self.members[root] + self.members.pop(merged))
+
+        cells = self.blocks.setdefault(key, dict())
+        cells.setdefault((math.floor(x / self.radius), math.floor(y / self.radius)), []).append(row)
+
+        return row, matches
+
+    def insert(self, addr_args):
+        ''' Add an address to the index, merge it into matching clusters, and return a result.
+
+            An address already in the index by hash is not added again.
+        '''
+        with self.lock:
+            if addr_args[1] in self.batch.hash_index:
+                return self.cluster(self.batch.hash_index[addr_args[1]])
+
+            return self.cluster(*self._add(addr_args))
+
+    def load(self, lines):
+        ''' Add addresses from an iterable of (key, Address arguments) pairs, as in mapped files.
+
+            Keys are ignored, as are addresses already in the index or
+            unreadable. Returns the number of addresses added.
+        '''
+        count = 0
+
+        with self.lock:
+            for (_, addr_args) in lines:
+                try:
+                    if addr_args[1] not in self.batch.hash_index:
+                        self._add(addr_args)
+                        count += 1
+                except:
+                    continue
+
+        return count
+
+def address_args(properties):
+    ''' Return Address arguments for a dictionary with OpenAddresses column names.
+
+        Other fields are read as strings, with null for empty. Raises
+        ValueError for a missing, unreadable, or non-finite point.
+
+        >>> address_args({'LON': '-122.2', 'LAT': 37.8, 'NUMBER': 123, 'STREET': 'Main St', 'UNIT': None})[6:9]
+        ['123', 'Main St', '']
+        >>> address_args({'LON': 'nan', 'LAT': 37.8})
+        Traceback (most recent call last):
+        ValueError: Point must have finite LON and LAT
+    '''
+    lon, lat = float(properties['LON']), float(properties['LAT'])
+    if not (math.isfinite(lon) and math.isfinite(lat)):
+        raise ValueError('Point must have finite LON and LAT')
+
+    source, hash, number, street, unit = [
+        '' if properties.get(field) is None else str(properties[field])
+        for field in ('OA:Source', 'HASH', 'NUMBER', 'STREET', 'UNIT')
+        ]
+
+    x, y = mercator(lon, lat)
+    address = Address(source, hash, lon, lat, round(x, 1), round(y, 1), number, street, unit)
+    return address.tolist()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    ''' JSON request handler for lookups and inserts on a server's DedupeIndex.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.respond(404, dict(error='Not found'))
+
+        index = self.server.index
+        self.respond(200, dict(addresses=len(index), clusters=len(index.members),
+                               matcher=index.matcher.name, radius=index.radius))
+
+    def do_POST(self):
+        if self.path not in ('/lookup', '/insert'):
+            return self.respond(404, dict(error='Not found'))
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            addresses = [address_args(properties) for properties in (body if isinstance(body, list) else [body])]
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            return self.respond(400, dict(error='Bad address: {}'.format(error)))
+
+        if self.path == '/insert' and not all(addr_args[1] for addr_args in addresses):
+            return self.respond(400, dict(error='Inserted addresses need a HASH.'))
+
+        method = self.server.index.insert if self.path == '/insert' else self.server.index.lookup
+        results = [method(addr_args) for addr_args in addresses]
+
+        if self.server.metrics:
+            self.server.metrics.count(self.path.strip('/') + 's', len(results))
+            self.server.metrics.count('duplicates', sum(result['duplicate'] for result in results))
+
+        self.respond(200, results if isinstance(body, list) else results[0])
+
+def make_server(index, host, port, run_metrics=None):
+    ''' Return a threading HTTP server for a DedupeIndex, not yet started.
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.index, server.metrics = index, run_metrics
+    return server
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,197 @@
+''' Synthetic OpenAddresses data for benchmarks that need no network access.
+
+Rows look like the addresses.csv member of an OpenAddresses tile download,
+with a few knobs for the properties that matter most to dedupe performance:
+
+- density: addresses per square kilometer, which sets pairs per match radius.
+- duplicates: fraction of addresses repeated by other sources nearby.
+- sources: number of sources an address can be repeated by.
+- variation: fraction of repeats spelled differently, mostly in the street name.
+- blanks: fraction of rows with no address or no readable point.
+
+Rows can be written to a zipped tile for ingest.py, or converted directly to
+the geoid-keyed records that address-areas.py writes, for address-map.py.
+
+    >>> rows = list(iterate_rows(1000, seed=1, duplicates=.5, sources=3))
+    >>> len(rows) > 1000, len({row['OA:Source'] for row in rows})
+    (True, 3)
+    >>> addresses = list(iterate_records(rows, '06075'))
+    >>> addresses[0][0], len(addresses[0][1]), len(addresses) < len(rows)
+    ('06075', 13, True)
+'''
+import csv, io, math, random, zipfile
+
+from expand import Address, mercator_arrays
+from normalize import tokens
+import ingest, records
+
+COLUMNS = ['LON', 'LAT', 'NUMBER', 'STREET', 'UNIT', 'CITY', 'DISTRICT',
+           'REGION', 'POSTCODE', 'ID', 'HASH', 'OA:Source']
+
+# Interchangeable spellings of street name tokens, like "N" and "North".
+spellings = {option.lower(): token for token in tokens for option in token}
+
+def street_names(count, seed=0):
+    ''' Return a list of street names drawn from a Zipf-like distribution.
+
+        Common names are far more frequent than rare ones, as in real areas
+        where a few long streets carry most of the addresses.
+    '''
+    rand = random.Random(seed)
+    names = ['Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake',
+             'Hill', 'Park', 'Walnut', 'Sunset', 'Lincoln', 'Jackson', 'Church',
+             'Highland', 'Ridge', 'Meadow', 'Forest', 'Spring', 'Mill', 'River',
+             'Martin Luther King Jr', 'Saint Mary', 'Mount Vernon']
+    names += ['{}{}'.format(n, {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10 if n // 10 != 1 else 0, 'th'))
+              for n in range(1, 100)]
+    kinds = ['St', 'Street', 'Ave', 'Avenue', 'Rd', 'Road', 'Dr', 'Drive', 'Ln',
+             'Lane', 'Ct', 'Court', 'Blvd', 'Way', 'Pl', 'Cir', 'Pkwy', 'Hwy']
+    prefixes = ['', '', '', '', 'N ', 'S ', 'E ', 'W ', 'North ', 'South ', 'East ', 'West ']
+
+    vocabulary = ['{}{} {}'.format(p, n, k) for n in names for k in kinds for p in prefixes]
+    rand.shuffle(vocabulary)
+    vocabulary = [street.upper() if rand.random() < .3 else street for street in vocabulary]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+
+    return rand.choices(vocabulary, weights, k=count)
+
+def misspell(rand, street):
+    ''' Return a street name with one typo in its first word.
+    '''
+    name, _, rest = street.partition(' ')
+    if len(name) < 4:
+        return street
+    i = rand.randrange(1, len(name) - 1)
+    if rand.random() < .5:
+        name = name[:i] + name[i + 1] + name[i] + name[i + 2:]
+    else:
+        name = name[:i] + name[i + 1:]
+    return ' '.join((name, rest)) if rest else name
+
+def respell(rand, street):
+    ''' Return a street name with equivalent tokens spelled differently.
+
+        The result normalizes to the same value, like "N 2nd St" for "North
+        Second Street", but with a different case half of the time.
+
+        >>> from normalize import normalize_street
+        >>> street = respell(random.Random(0), 'North Second Street')
+        >>> normalize_street(street) == normalize_street('North Second Street')
+        True
+    '''
+    words = list()
+
+    for word in street.split():
+        options = spellings.get(word.lower(), [word])
+        words.append(rand.choice(options) if rand.random() < .5 else word)
+
+    street = ' '.join(words)
+    return rand.choice((street, street.upper(), street.title()))
+
+def iterate_rows(count, seed=0, density=2000, duplicates=.3, sources=3, variation=.2,
+                 blanks=.01, lon=-122.42, lat=37.77):
+    ''' Generate dictionaries of OpenAddresses CSV columns for count addresses.
+
+        Addresses are spread uniformly over a square around a center point
+        with about density addresses per square kilometer. A fraction of them
+        are repeated by up to sources - 1 other sources with a few meters of
+        jitter, and a fraction of those repeats are spelled differently. Most
+        use equivalent street tokens, and the rest have a street typo, a space
+        before a number suffix, or a "#" unit, which only the fuzzy matcher
+        can see past. Repeats follow the original row, and share its ID so
+        that matches can be scored.
+    '''
+    rand = random.Random(seed)
+    streets = street_names(count, seed)
+    side = math.sqrt(count / density)
+    span_lat = side / 111.32
+    span_lon = side / (111.32 * math.cos(math.radians(lat)))
+    source_names = ['us/ca/source-{}'.format(i) for i in range(sources)]
+
+    for (entity, street) in enumerate(streets):
+        row_lon = lon + (rand.random() - .5) * span_lon
+        row_lat = lat + (rand.random() - .5) * span_lat
+        number = str(rand.randrange(1, 4000)) + rand.choice(('', '', '', '', '', 'A'))
+        unit = rand.choice(('', '', '', '', '', '', 'Apt 1', 'Unit 2', '3'))
+
+        copies = 1
+        if sources > 1 and rand.random() < duplicates:
+            copies = rand.randrange(2, sources + 1)
+
+        for (copy, source) in enumerate(rand.sample(source_names, copies)):
+            copy_lon, copy_lat, copy_street = row_lon, row_lat, street
+            copy_number, copy_unit = number, unit
+            if copy > 0:
+                copy_lon, copy_lat = row_lon + rand.gauss(0, .00003), row_lat + rand.gauss(0, .00003)
+                if rand.random() < variation:
+                    spelling = rand.random()
+                    if spelling < .2:
+                        copy_street = misspell(rand, street)
+                    elif spelling < .3 and number[-1].isalpha():
+                        copy_number = number[:-1] + ' ' + number[-1]
+                    elif spelling < .4 and unit:
+                        copy_unit = '#' + unit.split()[-1]
+                    else:
+                        copy_street = respell(rand, street)
+
+            row = dict(LON='{:.7f}'.format(copy_lon), LAT='{:.7f}'.format(copy_lat),
+                       NUMBER=copy_number, STREET=copy_street, UNIT=copy_unit, CITY='', DISTRICT='',
+                       REGION='CA', POSTCODE='', ID=str(entity), HASH='{:016x}'.format(rand.getrandbits(64)))
+            row['OA:Source'] = source
+
+            if rand.random() < blanks:
+                if rand.random() < .5:
+                    row.update(NUMBER='', STREET='')
+                else:
+                    row.update(LON='', LAT='')
+
+            yield row
+
+def write_csv(rows, file):
+    ''' Write row dictionaries to a text file as OpenAddresses CSV.
+    '''
+    writer = csv.DictWriter(file, COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+def write_zip(rows, filename):
+    ''' Write row dictionaries to a zipped tile with an addresses.csv member, for ingest.py.
+    '''
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as addr_zip:
+        with addr_zip.open('addresses.csv', 'w') as addr_buff:
+            with io.TextIOWrapper(addr_buff, newline='') as file:
+                write_csv(rows, file)
+
+def iterate_records(rows, geoid, size=10000):
+    ''' Generate (geoid, Address arguments) pairs from row dictionaries.
+
+        Rows are filtered and projected in chunks with the same functions as
+        ingest.py, with every address assigned to a single area, so no area
+        shapes or GDAL are needed.
+    '''
+    for chunk in ingest.iterate_chunks(iter(rows), size):
+        columns = [[row[column] for row in chunk] for column in ingest.COLUMNS]
+        lons, lats, (sources, hashes, numbers, streets, units) = ingest.filter_chunk(columns)
+        xs, ys = mercator_arrays(lons, lats)
+        xs, ys = xs.round(1).tolist(), ys.round(1).tolist()
+
+        for (source, hash, lon, lat, x, y, number, street, unit) in zip(
+                sources, hashes, lons.tolist(), lats.tolist(), xs, ys, numbers, streets, units):
+            yield geoid, Address(source, hash, lon, lat, x, y, number, street, unit).tolist()
+
+def write_records(rows, geoid, file, format):
+    ''' Write row dictionaries to a binary file as geoid-keyed records.
+
+        Returns the number of records written.
+    '''
+    writer, count = records.writer(file, format), 0
+
+    for (key, addr_args) in iterate_records(rows, geoid):
+        writer.write(key, addr_args)
+        count += 1
+
+    return count
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
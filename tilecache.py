@@ -0,0 +1,187 @@
+''' On-disk cache for OpenAddresses tile index downloads.
+
+Responses are saved under a directory as one data file per URL, named for a
+SHA-1 hash of the URL, with a small JSON file of metadata alongside:
+
+    {url hash}.data
+    {url hash}.json: {"url": ..., "etag": ..., "last_modified": ..., "size": ..., "used": ...}
+
+Cached files are revalidated with conditional requests, so an unchanged tile
+costs a "304 Not Modified" response instead of a full download. Least recently
+used files are evicted once the cache grows beyond a size limit. In offline
+mode no requests are made at all, and only cached files are available.
+
+    >>> import http.server, threading, tempfile, os, functools
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> with open(os.path.join(tmpdir, 'tile.zip'), 'wb') as file:
+    ...     _ = file.write(b'tile data')
+    >>> handler = functools.partial(QuietHandler, directory=tmpdir)
+    >>> server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> url = 'http://127.0.0.1:{}/tile.zip'.format(server.server_port)
+    >>> cache = TileCache(os.path.join(tmpdir, 'cache'))
+    >>> open(cache.fetch(url), 'rb').read(), cache.last_status
+    (b'tile data', 200)
+    >>> open(cache.fetch(url), 'rb').read(), cache.last_status
+    (b'tile data', 304)
+    >>> open(TileCache(cache.dirname, offline=True).fetch(url), 'rb').read()
+    b'tile data'
+    >>> server.shutdown()
+'''
+import collections, hashlib, http.server, json, os, tempfile, threading, time
+
+import requests
+
+class OfflineMiss(Exception):
+    ''' Raised for a URL that is not cached in offline mode.
+    '''
+    pass
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    ''' Static file handler that does not log requests to stderr.
+    '''
+    def log_message(self, *args):
+        pass
+
+class TileCache:
+    ''' Size-bounded LRU cache of downloaded files keyed by URL.
+
+        Safe to share between threads. Fetched files are pinned against
+        eviction from the start of each fetch until released, once for each
+        fetch, so they can be read after other fetches.
+    '''
+    def __init__(self, dirname, max_size=10 * 1024**3, offline=False, session=None):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.offline = offline
+        self.session = session or requests.Session()
+        self.last_status = None
+        self.pinned = collections.Counter()
+        self.lock = threading.Lock()
+
+        os.makedirs(dirname, exist_ok=True)
+
+    def _paths(self, url):
+        ''' Return data and metadata file paths for a URL.
+        '''
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        base = os.path.join(self.dirname, key)
+        return base + '.data', base + '.json'
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        handle, tmp_path = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        with os.fdopen(handle, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, meta_path)
+
+    def fetch(self, url):
+        ''' Return the path of a local file with the current contents of a URL.
+
+            A cached copy is revalidated with its ETag or Last-Modified value,
+            and is downloaded again only if it has changed.
+        '''
+        data_path, meta_path = self._paths(url)
+
+        # Pin before looking at the cached copy, so that other threads
+        # cannot evict it between revalidating and reading it.
+        with self.lock:
+            self.pinned[data_path] += 1
+
+        try:
+            meta = self._read_meta(meta_path) if os.path.exists(data_path) else None
+
+            if self.offline:
+                if meta is None:
+                    raise OfflineMiss('{} is not cached'.format(url))
+                self.last_status = None
+            else:
+                meta = self._download(url, data_path, meta)
+        except:
+            self.release(data_path)
+            raise
+
+        with self.lock:
+            meta['used'] = time.time()
+            self._write_meta(meta_path, meta)
+            self.evict()
+
+        return data_path
+
+    def release(self, data_path):
+        ''' Unpin a fetched file so that it can be evicted.
+        '''
+        with self.lock:
+            self.pinned[data_path] -= 1
+            if self.pinned[data_path] <= 0:
+                del self.pinned[data_path]
+
+    def _download(self, url, data_path, meta):
+        ''' Conditionally download a URL to a data file, and return new metadata.
+        '''
+        headers = dict()
+
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        with self.session.get(url, headers=headers, stream=True) as resp:
+            self.last_status = resp.status_code
+
+            if resp.status_code == 304 and meta is not None:
+                return meta
+
+            resp.raise_for_status()
+
+            # Stream to a temporary file so a failed download leaves no partial data.
+            handle, tmp_path = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as file:
+                    for chunk in resp.iter_content(chunk_size=1024**2):
+                        file.write(chunk)
+                os.replace(tmp_path, data_path)
+            except:
+                os.remove(tmp_path)
+                raise
+
+            return dict(url=url, etag=resp.headers.get('ETag'),
+                        last_modified=resp.headers.get('Last-Modified'),
+                        size=os.path.getsize(data_path))
+
+    def evict(self):
+        ''' Remove least recently used files until the cache fits its size limit.
+
+            Pinned files are never removed.
+        '''
+        entries, total = list(), 0
+
+        for name in os.listdir(self.dirname):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.dirname, name)
+            data_path = meta_path[:-len('.json')] + '.data'
+            meta = self._read_meta(meta_path) or dict()
+            size = meta.get('size', 0)
+            entries.append((meta.get('used', 0), data_path, meta_path, size))
+            total += size
+
+        for (_, data_path, meta_path, size) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if data_path in self.pinned:
+                continue
+            for path in (data_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()